@@ -0,0 +1,150 @@
+"""Helpers shared by the benchmark scripts.
+
+Benchmarks start the real server as a subprocess inside a throw-away working
+directory, so users.json, channels.json and the logs never touch the repository.
+Process statistics are read from /proc and therefore require Linux.
+"""
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(REPO_ROOT, "server")
+CLIENT_DIR = os.path.join(REPO_ROOT, "client")
+SERVER_MAIN = os.path.join(SERVER_DIR, "main.py")
+
+
+def use_server_modules():
+    """Makes the flat server modules (channel_manager, logger, ...) importable."""
+    for path in (SERVER_DIR, REPO_ROOT):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerProcess:
+    """Runs server/main.py in a temporary working directory.
+
+    files maps paths relative to the working directory (e.g. "server/channels.json")
+    to str or bytes content written before the server starts.
+    """
+
+    def __init__(self, mode="selector", env=None, workdir=None, files=None):
+        self.port = free_port()
+        self.workdir = workdir or tempfile.mkdtemp(prefix="chatbench-")
+        self._own_workdir = workdir is None
+        self.env = dict(os.environ)
+        self.env.update({
+            "CHAT_SERVER_MODE": mode,
+            "CHAT_SERVER_HOST": "127.0.0.1",
+            "CHAT_SERVER_PORT": str(self.port),
+        })
+        self.env.update(env or {})
+        self.files = files or {}
+        self.proc = None
+
+    def __enter__(self):
+        for relpath, content in self.files.items():
+            path = os.path.join(self.workdir, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb" if isinstance(content, bytes) else "w") as f:
+                f.write(content)
+        self.proc = subprocess.Popen(
+            [sys.executable, SERVER_MAIN], cwd=self.workdir, env=self.env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__(None, None, None)
+        raise RuntimeError("Server did not start listening in time")
+
+    def __exit__(self, *exc):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self._own_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def connect(self, timeout=10):
+        return socket.create_connection(("127.0.0.1", self.port), timeout=timeout)
+
+    def status(self):
+        """Returns {"rss_kb": ..., "peak_rss_kb": ..., "threads": ...} for the server process."""
+        result = {}
+        with open(f"/proc/{self.proc.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    result["rss_kb"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    result["peak_rss_kb"] = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    result["threads"] = int(line.split()[1])
+        return result
+
+    def reset_peak_rss(self):
+        """Restarts peak_rss_kb from the current RSS (Linux clear_refs)."""
+        with open(f"/proc/{self.proc.pid}/clear_refs", "w") as f:
+            f.write("5")
+
+    def cpu_seconds(self):
+        """User + system CPU time consumed by the server process so far."""
+        with open(f"/proc/{self.proc.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        return (int(fields[11]) + int(fields[12])) / ticks
+
+
+def channels_file(channels):
+    """Builds channels.json content: channels maps name -> list of message dicts."""
+    data = {"channels": {
+        name: {"host": "system", "participants": [], "messages": messages}
+        for name, messages in channels.items()
+    }}
+    return json.dumps(data)
+
+
+def make_messages(count, channel="General", start=0):
+    """Synthetic chat history with realistic field sizes."""
+    base = datetime.datetime(2024, 1, 1)
+    return [
+        {
+            "username": f"user{i % 50}",
+            "message": f"Message {i} in {channel}: the quick brown fox jumps over the lazy dog",
+            "timestamp": (base + datetime.timedelta(milliseconds=i)).isoformat(timespec="microseconds") + "Z",
+        }
+        for i in range(start, start + count)
+    ]
+
+
+def send_request(sock, request):
+    sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+
+
+def read_response(sock, buffer=b""):
+    """Reads one newline-terminated JSON document. Returns (obj, remaining_buffer)."""
+    while b"\n" not in buffer:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        buffer += chunk
+    line, _, rest = buffer.partition(b"\n")
+    return json.loads(line), rest
@@ -0,0 +1,108 @@
+"""Microbenchmark: fanout of one push to 1k / 10k recipients.
+
+Runs the server modules in-process with fake sockets that accept every send(),
+so only the server-side fanout cost is measured:
+
+* legacy    - the old livestream loop: scan every connected socket, test its user
+              against the channel's member set, serialize the payload for each
+              recipient
+* broadcast - broadcast.broadcast_to_channel: subscribers from the
+              channel -> sessions index, payload encoded once per protocol
+
+Every run has --connected clients connected in total, the recipients being
+the subscribers of one channel.
+
+    python benchmarks/bench_broadcast.py --recipients 1000,10000 --connected 20000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from _harness import use_server_modules
+
+os.chdir(tempfile.mkdtemp(prefix="chatbench-")) # The server logger writes logs/ in the cwd
+use_server_modules()
+import outbound  # noqa: E402
+from broadcast import broadcast_to_channel, subscribe_client  # noqa: E402
+from sessions import sessions  # noqa: E402
+from shared import channel_subscribers  # noqa: E402
+
+
+class FakeSocket:
+    """Stands in for a client socket whose kernel buffer always has room."""
+    __slots__ = ("sent",)
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def shutdown(self, how):
+        pass
+
+
+PAYLOAD = {
+    "type": "channel", "action": "new_message", "channel_name": "Room",
+    "message_data": {"username": "System", "message": "LIVESTREAM_START", "streamer": "alice",
+                     "host": "192.168.1.20", "port": 6001, "timestamp": "2025-05-08T03:00:00.000000Z", "seq": 12345},
+}
+
+
+def setup(recipients, connected):
+    sessions.clear()
+    channel_subscribers.clear()
+    sockets = [FakeSocket() for _ in range(connected)]
+    members = set()
+    for i, sock in enumerate(sockets):
+        name = f"user{i}"
+        sessions.bind(sessions.open(sock, ("10.0.0.1", i)), name, "authenticated")
+        if i < recipients:
+            members.add(name)
+            subscribe_client(sock, "Room")
+        else:
+            subscribe_client(sock, f"Other{i % 100}")
+    return sockets, members
+
+
+def legacy(members, streamer):
+    # The loop formerly in handle_livestream_request (over socket -> username)
+    for target_socket, target_username in ((s.sock, s.username) for s in sessions.all()):
+        if target_username in members and target_username != streamer:
+            outbound.send_message(target_socket, PAYLOAD, push=True)
+
+
+def run(recipients, connected, rounds):
+    sockets, members = setup(recipients, connected)
+    legacy_times, broadcast_times = [], []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        legacy(members, "nobody")
+        legacy_times.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        broadcast_to_channel("Room", PAYLOAD)
+        broadcast_times.append(time.perf_counter() - t0)
+    for sock in sockets:
+        outbound.forget(sock)
+    return min(legacy_times), min(broadcast_times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", default="1000,10000")
+    parser.add_argument("--connected", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.connected} connected clients, best of {args.rounds}")
+    print(f"{'recipients':>10} {'legacy ms':>10} {'broadcast ms':>13} {'us/recipient':>13} {'speedup':>8}")
+    for recipients in (int(n) for n in args.recipients.split(",")):
+        legacy_s, broadcast_s = run(recipients, max(args.connected, recipients), args.rounds)
+        print(f"{recipients:>10} {legacy_s * 1000:>10.2f} {broadcast_s * 1000:>13.2f} "
+              f"{broadcast_s * 1e6 / recipients:>13.2f} {legacy_s / broadcast_s:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Stress test of channel locking: many writers, many channels, no lost messages.
+
+Runs the server's channel handlers in-process. --threads writer threads each
+store --messages chat messages with save_message (waiting for each reply, as a
+client would) into one of --channels channels, while --readers threads keep
+calling list_channels and sync_from_server (one pair every --read-interval ms).
+Reported:
+
+* throughput of the writers in messages/s
+* reader latency (p50 / p99 / max), i.e. how long reads were held up by writers
+* lost / duplicated messages: every channel must hold each writer's messages
+  exactly once, numbered 1..N without gaps, both in memory and after the store
+  has been flushed and loaded again from disk
+
+    python benchmarks/bench_channel_locking.py --threads 64 --channels 16 --messages 200
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from _harness import use_server_modules
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--threads", type=int, default=64)
+parser.add_argument("--channels", type=int, default=16)
+parser.add_argument("--messages", type=int, default=200, help="save_message calls per writer thread")
+parser.add_argument("--readers", type=int, default=4)
+parser.add_argument("--read-interval", type=float, default=1.0, help="ms between two reads of a reader")
+parser.add_argument("--storage", default="log", choices=("json", "log", "sqlite"))
+args = parser.parse_args()
+
+os.chdir(tempfile.mkdtemp(prefix="chatbench-")) # The server writes logs/ and server/ in the cwd
+os.environ["CHAT_CHANNEL_STORAGE"] = args.storage # Read by config at import
+use_server_modules()
+import channel_manager  # noqa: E402
+from sessions import sessions  # noqa: E402
+
+
+class SinkSocket:
+    """Stands in for a client connection: accepts every frame and counts the replies.
+
+    With keep, the NDJSON frames are kept until taken with replies().
+    """
+
+    def __init__(self, keep=False):
+        self.frames = 0
+        self.received = bytearray() if keep else None
+        self.changed = threading.Condition()
+
+    def send(self, data):
+        with self.changed:
+            self.frames += 1
+            if self.received is not None:
+                self.received += data
+            self.changed.notify_all()
+        return len(data)
+
+    def replies(self):
+        """The replies received since the last call (pushes are skipped)."""
+        with self.changed:
+            lines, self.received[:] = bytes(self.received).split(b"\n"), b""
+        return [reply for reply in map(json.loads, filter(None, lines)) if "status" in reply]
+
+    def wait_frames(self, count, timeout=30):
+        with self.changed:
+            if not self.changed.wait_for(lambda: self.frames >= count, timeout):
+                raise TimeoutError(f"no reply after {timeout} s")
+
+    def getpeername(self):
+        return ("127.0.0.1", 0)
+
+    def fileno(self):
+        return -1
+
+
+def writer(index, count, errors):
+    name = f"writer{index}"
+    channel = f"bench{index % args.channels}"
+    sock = SinkSocket()
+    sessions.bind(sessions.open(sock, ("127.0.0.1", index)), name, "authenticated", "online")
+    try:
+        for i in range(count):
+            response = channel_manager.save_message(sock, {"channel_name": channel, "username": name,
+                                                           "message": f"{name} {i}"}, name)
+            if response is not None: # Replied at once instead of after the commit
+                assert response["status"] == "success", response
+            else:
+                sock.wait_frames(i + 1)
+    except Exception as e:
+        errors.append(e)
+
+
+def reader(stop, latencies, errors):
+    sock = SinkSocket(keep=True)
+    sessions.open(sock, ("127.0.0.1", 0))
+    cursors = {}
+    i = 0
+    try:
+        while not stop.is_set():
+            channel = f"bench{i % args.channels}"
+            i += 1
+            t0 = time.perf_counter()
+            listed = channel_manager.list_channels(sock)
+            synced = channel_manager.handle_sync_from_server(sock, {"channel_name": channel, "username": "host",
+                                                                     "since": cursors.get(channel, 0)})
+            if synced is None: # Sent by the handler (cached reply)
+                synced = sock.replies()[-1]
+            latencies.append(time.perf_counter() - t0)
+            assert listed["status"] == "success" and synced["status"] == "success", (listed, synced)
+            seqs = [msg["seq"] for msg in synced["messages"]]
+            assert seqs == list(range(cursors.get(channel, 0) + 1, synced["cursor"] + 1)), "gap in sync"
+            cursors[channel] = synced["cursor"]
+            time.sleep(args.read_interval / 1000)
+    except Exception as e:
+        errors.append(e)
+
+
+def check(channels, expected):
+    """Returns (lost, duplicated, gaps) over all bench channels."""
+    lost = duplicated = gaps = 0
+    for c in range(args.channels):
+        messages = channels[f"bench{c}"]["messages"]
+        texts = [msg["message"] for msg in messages]
+        seen = set(texts)
+        duplicated += len(texts) - len(seen)
+        lost += sum(1 for text in expected[c] if text not in seen)
+        gaps += sum(1 for i, msg in enumerate(messages) if msg.get("seq") != i + 1)
+    return lost, duplicated, gaps
+
+
+def main():
+    for c in range(args.channels):
+        channel_manager.create_channel(None, {"channel_name": f"bench{c}", "username": "host"})
+    expected = {c: [] for c in range(args.channels)}
+    for t in range(args.threads):
+        expected[t % args.channels].extend(f"writer{t} {i}" for i in range(args.messages))
+
+    errors, latencies = [], []
+    stop = threading.Event()
+    readers = [threading.Thread(target=reader, args=(stop, latencies, errors)) for _ in range(args.readers)]
+    writers = [threading.Thread(target=writer, args=(t, args.messages, errors)) for t in range(args.threads)]
+    for t in readers:
+        t.start()
+    start = time.perf_counter()
+    for t in writers:
+        t.start()
+    for t in writers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for t in readers:
+        t.join()
+
+    total = args.threads * args.messages
+    in_memory = check(channel_manager.load_channels()["channels"], expected)
+    channel_manager.flush_channels()
+    on_disk = check(channel_manager.create_storage_backend(args.storage).load()["channels"], expected)
+
+    latencies.sort()
+    print(f"{args.threads} writers x {args.messages} messages into {args.channels} channels, "
+          f"{args.readers} readers, {args.storage} storage, group commit {'on' if channel_manager.GROUP_COMMIT else 'off'}")
+    print(f"throughput:     {total / elapsed:.0f} msgs/s ({total} messages in {elapsed:.2f} s)")
+    if latencies:
+        print(f"reads:          {len(latencies)}, p50 {statistics.median(latencies) * 1000:.2f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+    print(f"in memory:      lost {in_memory[0]}, duplicated {in_memory[1]}, seq gaps {in_memory[2]}")
+    print(f"after reload:   lost {on_disk[0]}, duplicated {on_disk[1]}, seq gaps {on_disk[2]}")
+    if errors:
+        print(f"{len(errors)} error(s), first: {errors[0]!r}")
+    ok = not errors and in_memory == (0, 0, 0) and on_disk == (0, 0, 0)
+    print(json.dumps({"ok": ok}))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""How many idle chat clients does the server hold, threaded vs selector mode?
+
+Opens N guest sessions against a fresh server in each mode, keeps them idle,
+then reports server RSS, thread count and the round-trip time of one extra
+request issued while all the idle clients are connected.
+
+    python benchmarks/bench_connections.py --clients 2000
+"""
+import argparse
+import time
+
+from _harness import ServerProcess, send_request, read_response
+
+
+def run(mode, clients):
+    with ServerProcess(mode=mode) as server:
+        baseline = server.status()
+        sockets = []
+        start = time.perf_counter()
+        try:
+            for i in range(clients):
+                try:
+                    sock = server.connect()
+                    send_request(sock, {"type": "auth", "action": "visitor_login", "visitor_name": f"idle{i}"})
+                    read_response(sock)
+                except OSError as e:
+                    print(f"  [{mode}] stopped at {i} clients: {e}")
+                    break
+                sockets.append(sock)
+            connect_time = time.perf_counter() - start
+            time.sleep(1) # Let the server settle
+            loaded = server.status()
+
+            probe = server.connect()
+            t0 = time.perf_counter()
+            send_request(probe, {"type": "auth", "action": "visitor_login", "visitor_name": "probe"})
+            read_response(probe)
+            probe_ms = (time.perf_counter() - t0) * 1000
+            probe.close()
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    return {
+        "mode": mode,
+        "clients": len(sockets),
+        "connect_s": connect_time,
+        "rss_mb": loaded["rss_kb"] / 1024,
+        "rss_per_client_kb": (loaded["rss_kb"] - baseline["rss_kb"]) / max(1, len(sockets)),
+        "threads": loaded["threads"],
+        "probe_ms": probe_ms,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--modes", default="threaded,selector")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'clients':>9}{'threads':>9}{'RSS MB':>9}{'KB/client':>11}{'connect s':>11}{'probe ms':>10}")
+    for mode in args.modes.split(","):
+        r = run(mode, args.clients)
+        print(f"{r['mode']:<10}{r['clients']:>9}{r['threads']:>9}{r['rss_mb']:>9.1f}"
+              f"{r['rss_per_client_kb']:>11.1f}{r['connect_s']:>11.2f}{r['probe_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Cost of one sync_from_server call: full history vs cursor ("since") delta.
+
+A fresh server is seeded with a channel of H messages. One client joins it and
+then measures, over several rounds:
+
+* full  - sync_from_server without a cursor (what every 3 s poll used to do)
+* delta - sync_from_server with the cursor of the previous reply, after one new
+          message was stored
+
+    python benchmarks/bench_delta_sync.py --history 100000 --rounds 5
+"""
+import argparse
+import time
+
+from _harness import ServerProcess, send_request, read_response, channels_file, make_messages
+
+
+def timed_sync(sock, name, since=None):
+    request = {"type": "channel", "action": "sync_from_server", "channel_name": "General", "username": name}
+    if since is not None:
+        request["since"] = since
+    t0 = time.perf_counter()
+    send_request(sock, request)
+    # Count the raw reply bytes too
+    buffer = b""
+    while b"\n" not in buffer:
+        buffer += sock.recv(1 << 20)
+    elapsed = time.perf_counter() - t0
+    response, _ = read_response(sock, buffer)
+    return response, elapsed, len(buffer)
+
+
+def run(history, rounds):
+    files = {"server/channels.json": channels_file({"General": make_messages(history)})}
+    with ServerProcess(files=files) as server:
+        sock = server.connect(timeout=120)
+        name = "bench"
+        send_request(sock, {"type": "auth", "action": "register", "username": name, "password": "pw"})
+        read_response(sock)
+        send_request(sock, {"type": "auth", "action": "login", "username": name, "password": "pw"})
+        read_response(sock)
+        send_request(sock, {"type": "channel", "action": "join_channel", "channel_name": "General", "username": name})
+        read_response(sock)
+
+        full_times, full_bytes, delta_times, delta_bytes = [], [], [], []
+        cursor = None
+        for i in range(rounds):
+            response, elapsed, size = timed_sync(sock, name)
+            full_times.append(elapsed)
+            full_bytes.append(size)
+            cursor = response["cursor"]
+
+            send_request(sock, {"type": "channel", "action": "save_message", "channel_name": "General",
+                                "username": name, "message": f"new message {i}"})
+            read_response(sock)
+            response, elapsed, size = timed_sync(sock, name, since=cursor)
+            assert len(response["messages"]) == 1, response
+            delta_times.append(elapsed)
+            delta_bytes.append(size)
+        sock.close()
+    return min(full_times), full_bytes[-1], min(delta_times), delta_bytes[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    full_s, full_b, delta_s, delta_b = run(args.history, args.rounds)
+    print(f"{args.history} messages in channel, best of {args.rounds}")
+    print(f"{'sync':<6} {'time ms':>10} {'reply bytes':>12}")
+    print(f"{'full':<6} {full_s * 1000:>10.1f} {full_b:>12}")
+    print(f"{'delta':<6} {delta_s * 1000:>10.1f} {delta_b:>12}")
+
+
+if __name__ == "__main__":
+    main()
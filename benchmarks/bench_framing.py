@@ -0,0 +1,118 @@
+"""Microbenchmark: NDJSONFramer vs the parsers it replaced.
+
+A sync_from_server response with N messages is cut into 4096-byte chunks (the
+old recv size) and fed to:
+  * legacy server parser - raw_decode over each chunk on its own; anything split
+    across chunks is lost, so the "ok" column shows whether the payload survived
+  * legacy client parser - brace counting one byte at a time over the whole
+    buffer after every chunk (quadratic); skipped above --client-limit messages
+  * NDJSONFramer          - the shared incremental framer
+
+    python benchmarks/bench_framing.py --sizes 500,2000,20000,100000
+"""
+import argparse
+import json
+import sys
+import time
+
+from _harness import REPO_ROOT
+
+sys.path.insert(0, REPO_ROOT)
+from common.framing import NDJSONFramer, decode_json  # noqa: E402
+
+CHUNK = 4096
+
+
+def make_payload(count):
+    messages = [{"username": f"user{i % 50}", "message": f"message number {i} " + "lorem ipsum " * 4,
+                 "timestamp": f"2025-05-08T03:{(i // 60) % 60:02d}:{i % 60:02d}.000000Z"} for i in range(count)]
+    return (json.dumps({"status": "success", "messages": messages}) + "\n").encode("utf-8")
+
+
+def chunks(payload):
+    return [payload[i:i + CHUNK] for i in range(0, len(payload), CHUNK)]
+
+
+def legacy_server_parser(parts):
+    """The per-chunk raw_decode loop formerly in handle_client."""
+    found = []
+    decoder = json.JSONDecoder()
+    for data in parts:
+        data_str = data.decode("utf-8", errors="ignore")
+        pos = 0
+        while pos < len(data_str):
+            while pos < len(data_str) and data_str[pos].isspace():
+                pos += 1
+            if pos == len(data_str):
+                break
+            try:
+                req, length = decoder.raw_decode(data_str[pos:])
+                found.append(req)
+                pos += length
+            except json.JSONDecodeError:
+                break
+    return found
+
+
+def legacy_client_parser(parts):
+    """The brace-counting scan formerly in receive_json_response."""
+    buffer = b""
+    for chunk in parts:
+        buffer += chunk
+        first_brace = buffer.find(b"{")
+        brace_count = 0
+        in_string = False
+        for i in range(first_brace, len(buffer)):
+            char = buffer[i:i + 1].decode("utf-8", errors="ignore")
+            if char == '"':
+                if i > first_brace and buffer[i - 1:i] != b"\\":
+                    in_string = not in_string
+            elif not in_string:
+                if char == "{":
+                    brace_count += 1
+                elif char == "}":
+                    brace_count -= 1
+                    if brace_count == 0:
+                        return [json.loads(buffer[first_brace:i + 1].decode("utf-8"))]
+    return []
+
+
+def framer_parser(parts):
+    framer = NDJSONFramer()
+    found = []
+    for chunk in parts:
+        found.extend(decode_json(frame) for frame in framer.feed(chunk))
+    return found
+
+
+def measure(parser, parts, expected_count):
+    start = time.perf_counter()
+    result = parser(parts)
+    elapsed = time.perf_counter() - start
+    ok = len(result) == 1 and len(result[0].get("messages", [])) == expected_count
+    return elapsed, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="500,2000,20000,100000")
+    parser.add_argument("--client-limit", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'messages':>9}{'bytes':>12}  {'legacy server':>18}  {'legacy client':>18}  {'framer':>12}{'MB/s':>8}")
+    for count in (int(x) for x in args.sizes.split(",")):
+        payload = make_payload(count)
+        parts = chunks(payload)
+        srv_t, srv_ok = measure(legacy_server_parser, parts, count)
+        if count <= args.client_limit:
+            cli_t, cli_ok = measure(legacy_client_parser, parts, count)
+            cli = f"{cli_t * 1000:9.1f} ms {'ok' if cli_ok else 'LOST':>4}"
+        else:
+            cli = f"{'skipped':>17}"
+        frm_t, frm_ok = measure(framer_parser, parts, count)
+        print(f"{count:>9}{len(payload):>12}  {srv_t * 1000:9.1f} ms {'ok' if srv_ok else 'LOST':>4}  {cli}  "
+              f"{frm_t * 1000:7.1f} ms {'ok' if frm_ok else 'LOST':>2}{len(payload) / frm_t / 1e6:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Group commit: durable save_message throughput against concurrency.
+
+A fresh server (--storage log or sqlite) is started per configuration; C clients
+each store --messages chat messages one after the other (request, wait for
+reply) in the same channel. Reported per run: messages/s, reply latency
+p50/p99, and from the server log after shutdown the number of commits (fsync'd
+writes) and the average batch size.
+
+Configurations:
+
+* off        - CHAT_GROUP_COMMIT=0: replies before the write-behind flush (not durable)
+* group      - the defaults: commit as soon as the writer is free; messages
+               stored during a write form the next batch
+* window     - group commit holding each batch open for 5 ms
+
+With one client every commit holds a single message, so that row is the cost of
+making each message durable on its own.
+
+    python benchmarks/bench_group_commit.py --clients 1,16,64 --messages 200
+"""
+import argparse
+import ast
+import os
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from _harness import ServerProcess, send_request, read_response
+
+CONFIGS = {
+    "off": {"CHAT_GROUP_COMMIT": "0"},
+    "group": {"CHAT_GROUP_COMMIT": "1"},
+    "window": {"CHAT_GROUP_COMMIT": "1", "CHAT_GROUP_COMMIT_INTERVAL_MS": "5"},
+}
+
+
+def client(server, index, count, latencies, errors, ready, go):
+    try:
+        sock = server.connect(timeout=120)
+        name = f"bench{index}"
+        buffer = b""
+        for request in (
+            {"type": "auth", "action": "register", "username": name, "password": "pw"},
+            {"type": "auth", "action": "login", "username": name, "password": "pw"},
+        ):
+            send_request(sock, request)
+            _, buffer = read_response(sock, buffer)
+        ready.release()
+        go.wait()
+        for i in range(count):
+            t0 = time.perf_counter()
+            send_request(sock, {"type": "channel", "action": "save_message", "channel_name": "General",
+                                "username": name, "message": f"bench message {i}"})
+            response, buffer = read_response(sock, buffer)
+            assert response.get("status") == "success", response
+            latencies.append(time.perf_counter() - t0)
+        sock.close()
+    except Exception as e:
+        errors.append(e)
+        ready.release()
+
+
+def commit_stats(workdir):
+    with open(os.path.join(workdir, "logs", "server.log"), encoding="utf-8") as f:
+        found = re.findall(r"Group commit stats: (\{.*\})", f.read())
+    return ast.literal_eval(found[-1]) if found else None
+
+
+def run(config, storage, clients, count):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    try:
+        env = dict(CONFIGS[config], CHAT_CHANNEL_STORAGE=storage)
+        latencies, errors = [], []
+        ready, go = threading.Semaphore(0), threading.Event()
+        with ServerProcess(workdir=workdir, env=env) as server:
+            threads = [threading.Thread(target=client, args=(server, i, count, latencies, errors, ready, go))
+                       for i in range(clients)]
+            for t in threads:
+                t.start()
+            for _ in threads:
+                ready.acquire()
+            start = time.perf_counter()
+            go.set()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+        stats = commit_stats(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0
+    p50 = statistics.median(latencies) if latencies else 0.0
+    return len(latencies) / elapsed, p50, p99, stats, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", default="1,16,64")
+    parser.add_argument("--messages", type=int, default=200, help="save_message calls per client")
+    parser.add_argument("--configs", default=",".join(CONFIGS))
+    parser.add_argument("--storage", default="log", choices=("log", "sqlite"))
+    args = parser.parse_args()
+
+    print(f"{args.messages} sequential save_message calls per client, {args.storage} storage")
+    print(f"{'config':>8} {'clients':>8} {'msgs/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'commits':>8} {'avg batch':>10}")
+    for clients in (int(n) for n in args.clients.split(",")):
+        for config in args.configs.split(","):
+            rate, p50, p99, stats, errors = run(config, args.storage, clients, args.messages)
+            commits = f"{stats['commits']:>8}" if stats else f"{'-':>8}"
+            batch = f"{stats['avg_batch']:>10.1f}" if stats else f"{'-':>10}"
+            print(f"{config:>8} {clients:>8} {rate:>9.0f} {p50 * 1000:>8.2f} {p99 * 1000:>8.2f} "
+                  f"{commits} {batch}" + (f"  {len(errors)} error(s): {errors[0]}" if errors else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Joining a channel: full sync_from_server vs the newest get_history page.
+
+A fresh server is seeded with one channel holding H messages, for every H in
+--sizes. A participant then measures, as request -> complete reply (median of
+--repeat):
+
+* sync       - sync_from_server without a cursor: the whole history, as the
+               client did on every join
+* newest     - get_history with no bounds: the newest --limit messages (join)
+* older      - get_history before=H/2: a page from the middle (scroll-up)
+* ts-first   - get_history before=<timestamp of message H/2>, first call: builds
+               the channel's timestamp index
+* ts         - the same page once the index exists
+
+and the reply size. Page reads should stay flat as H grows.
+
+    python benchmarks/bench_history.py --sizes 1000,10000,100000 --limit 50
+"""
+import argparse
+import json
+import shutil
+import statistics
+import tempfile
+import time
+
+from _harness import ServerProcess, channels_file, make_messages, send_request
+
+
+def timed(sock, reader, request, repeat):
+    times, size = [], 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        send_request(sock, request)
+        line = reader.readline()
+        times.append(time.perf_counter() - t0)
+        size = len(line)
+        response = json.loads(line)
+        assert response.get("status") == "success", response
+    return statistics.median(times), size
+
+
+def run(size, limit, repeat):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    messages = make_messages(size)
+    files = {"server/channels.json": channels_file({"General": messages})}
+    try:
+        with ServerProcess(workdir=workdir, files=files) as server:
+            sock = server.connect(timeout=120)
+            reader = sock.makefile("rb")
+            for request in (
+                {"type": "auth", "action": "register", "username": "bench", "password": "pw"},
+                {"type": "auth", "action": "login", "username": "bench", "password": "pw"},
+                {"type": "channel", "action": "join_channel", "channel_name": "General", "username": "bench"},
+            ):
+                send_request(sock, request)
+                reader.readline()
+            base = {"type": "channel", "channel_name": "General", "username": "bench"}
+            middle_ts = messages[size // 2]["timestamp"]
+            rows = [
+                ("sync", timed(sock, reader, dict(base, action="sync_from_server"), repeat)),
+                ("newest", timed(sock, reader, dict(base, action="get_history", limit=limit), repeat)),
+                ("older", timed(sock, reader, dict(base, action="get_history", limit=limit, before=size // 2), repeat)),
+                ("ts-first", timed(sock, reader, dict(base, action="get_history", limit=limit, before=middle_ts), 1)),
+                ("ts", timed(sock, reader, dict(base, action="get_history", limit=limit, before=middle_ts), repeat)),
+            ]
+            sock.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"page size {args.limit}, median of {args.repeat} requests")
+    print(f"{'history':>8} {'read':>9} {'ms':>9} {'reply KB':>10}")
+    for size in (int(n) for n in args.sizes.split(",")):
+        for label, (seconds, nbytes) in run(size, args.limit, args.repeat):
+            print(f"{size:>8} {label:>9} {seconds * 1000:>9.2f} {nbytes / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
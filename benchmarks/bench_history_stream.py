@@ -0,0 +1,113 @@
+"""Large catch-up syncs: one sync_from_server reply vs a streamed one.
+
+A fresh server is seeded with one channel of H messages for every H in --sizes,
+and a participant fetches the whole history with sync_from_server (no cursor),
+once as a single reply and once with "stream": true (history_chunk frames of
+CHAT_HISTORY_CHUNK_MESSAGES). Reported per transfer:
+
+* first ms   - request -> first message decoded by the client (what it can
+               render first)
+* total ms   - request -> final reply decoded
+* server MB  - growth of the server's peak RSS during the transfer
+* client MB  - peak Python allocations of the client while receiving (tracemalloc)
+
+The client reads slowly if --client-delay-ms is set (sleep per 64 KB read), as
+over a slow link, which is when a single reply sits in server memory longest.
+
+    python benchmarks/bench_history_stream.py --sizes 10000,100000,300000
+"""
+import argparse
+import json
+import shutil
+import socket
+import tempfile
+import time
+import tracemalloc
+
+from _harness import ServerProcess, channels_file, make_messages, send_request
+
+
+def receive(sock, delay):
+    """Yields decoded newline-delimited frames, reading 64 KB at a time."""
+    buffer = bytearray()
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        buffer += chunk
+        if delay:
+            time.sleep(delay)
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            yield json.loads(bytes(buffer[start:end]))
+            start = end + 1
+        del buffer[:start]
+
+
+def transfer(server, sock, frames, stream, delay):
+    request = {"type": "channel", "action": "sync_from_server", "channel_name": "General", "username": "bench"}
+    if stream:
+        request["stream"] = True
+    server.reset_peak_rss()
+    before_kb = server.status()["rss_kb"]
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    first = None
+    received = 0
+    send_request(sock, request)
+    for frame in frames:
+        messages = frame.get("messages", [])
+        if messages and first is None:
+            first = time.perf_counter() - t0
+        received += len(messages)
+        if "status" in frame:
+            break
+    total = time.perf_counter() - t0
+    client_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    server_peak_kb = server.status()["peak_rss_kb"] - before_kb
+    return first or total, total, server_peak_kb / 1024, client_peak / 2 ** 20, received
+
+
+def run(size, delay):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    files = {"server/channels.json": channels_file({"General": make_messages(size)})}
+    rows = []
+    try:
+        with ServerProcess(workdir=workdir, files=files) as server:
+            sock = server.connect(timeout=300)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+            frames = receive(sock, delay)
+            for request in (
+                {"type": "auth", "action": "register", "username": "bench", "password": "pw"},
+                {"type": "auth", "action": "login", "username": "bench", "password": "pw"},
+                {"type": "channel", "action": "join_channel", "channel_name": "General", "username": "bench"},
+            ):
+                send_request(sock, request)
+                next(frames)
+            for stream in (False, True):
+                rows.append(("stream" if stream else "single",) + transfer(server, sock, frames, stream, delay))
+            sock.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,300000")
+    parser.add_argument("--client-delay-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    print(f"{'history':>8} {'reply':>7} {'first ms':>9} {'total ms':>9} {'server MB':>10} {'client MB':>10}")
+    for size in (int(n) for n in args.sizes.split(",")):
+        for label, first, total, server_mb, client_mb, received in run(size, args.client_delay_ms / 1000):
+            assert received == size + 1, (label, received) # + the join message
+            print(f"{size:>8} {label:>7} {first * 1000:>9.1f} {total * 1000:>9.1f} {server_mb:>10.1f} {client_mb:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
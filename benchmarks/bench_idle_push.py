@@ -0,0 +1,109 @@
+"""Server cost of idle chat clients: 3-second polling vs push fanout.
+
+N guest sessions join General, which already holds a history of H messages,
+and then stay idle for the measurement window:
+
+* poll - every client sends sync_from_server every 3 seconds, as the UI did
+         before pushes (start_auto_sync)
+* push - clients only wait for pushes; nobody types, so nothing is sent
+
+Reports the server CPU time consumed during the window and the bytes the
+clients sent and received.
+
+    python benchmarks/bench_idle_push.py --clients 500 --history 200 --duration 30
+"""
+import argparse
+import json
+import selectors
+import time
+
+from _harness import ServerProcess, send_request, read_response, channels_file, make_messages
+
+POLL_INTERVAL = 3.0
+
+
+def open_sessions(server, clients):
+    sockets = []
+    for i in range(clients):
+        sock = server.connect()
+        name = f"idle{i}"
+        send_request(sock, {"type": "auth", "action": "visitor_login", "visitor_name": name})
+        read_response(sock)
+        send_request(sock, {"type": "channel", "action": "join_channel", "channel_name": "General", "username": name})
+        read_response(sock)
+        sockets.append((sock, name))
+    return sockets
+
+
+def idle(sockets, mode, duration):
+    """Runs all clients from one selector loop. Returns (bytes_sent, bytes_received)."""
+    selector = selectors.DefaultSelector()
+    next_poll = {}
+    start = time.monotonic()
+    for index, (sock, name) in enumerate(sockets):
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, name)
+        next_poll[sock] = start + POLL_INTERVAL * index / len(sockets) # Spread polls like real clients
+    sent = received = 0
+    deadline = start + duration
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        if mode == "poll":
+            for sock, name in sockets:
+                if next_poll[sock] <= now:
+                    data = (json.dumps({"type": "channel", "action": "sync_from_server",
+                                        "channel_name": "General", "username": name}) + "\n").encode("utf-8")
+                    sock.sendall(data)
+                    sent += len(data)
+                    next_poll[sock] = now + POLL_INTERVAL
+        timeout = min(deadline, min(next_poll.values()) if mode == "poll" else deadline) - now
+        for key, _ in selector.select(max(0.0, min(timeout, 0.5))):
+            try:
+                chunk = key.fileobj.recv(1 << 20)
+            except BlockingIOError:
+                continue
+            received += len(chunk)
+    selector.close()
+    return sent, received
+
+
+def run(mode, clients, history, duration):
+    files = {"server/channels.json": channels_file({"General": make_messages(history)})}
+    with ServerProcess(files=files) as server:
+        sockets = open_sessions(server, clients)
+        try:
+            time.sleep(1) # Let the server settle
+            cpu_before = server.cpu_seconds()
+            sent, received = idle(sockets, mode, duration)
+            cpu = server.cpu_seconds() - cpu_before
+        finally:
+            for sock, _ in sockets:
+                sock.close()
+    return {
+        "mode": mode,
+        "cpu_s": cpu,
+        "cpu_pct": 100.0 * cpu / duration,
+        "up_kb_s": sent / 1024 / duration,
+        "down_kb_s": received / 1024 / duration,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--history", type=int, default=200, help="messages already stored in General")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of idle time measured")
+    parser.add_argument("--modes", default="poll,push")
+    args = parser.parse_args()
+
+    print(f"{args.clients} idle clients, {args.history} messages of history, {args.duration:.0f}s window")
+    print(f"{'mode':<6} {'server CPU s':>13} {'CPU %':>7} {'up KB/s':>9} {'down KB/s':>10}")
+    for mode in args.modes.split(","):
+        r = run(mode, args.clients, args.history, args.duration)
+        print(f"{r['mode']:<6} {r['cpu_s']:>13.2f} {r['cpu_pct']:>7.1f} {r['up_kb_s']:>9.1f} {r['down_kb_s']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Log throughput, the cost of disabled / sampled records, and the latency logging adds to requests.
+
+logger   - --lines log_info calls spread over 1 and --threads threads, with
+           * sync:     the former logger (open, append, close, print and
+                       getsize for every line), reproduced here as a baseline
+           * buffered: common/log_writer.LogWriter as used by server/logger.py
+           Reported: lines/s until every line is in the file, and the p50 / p99
+           time of one log call (what a request thread waits for).
+gating   - ns per call on one thread for a record that embeds a request dict:
+           an f-string at an enabled level, the same f-string at a disabled
+           level, "%s" arguments at a disabled level, and an event sampled 1 in 100.
+requests - a server with --clients connections doing list_channels as fast as
+           they get replies (every request logs a few lines on the server).
+           Reported: req/s, p50 / p99 latency, server CPU per request. Run it
+           on two checkouts to compare loggers end to end.
+
+Console output of both loggers goes to /dev/null.
+
+    python benchmarks/bench_logging.py --lines 200000 --threads 8
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from _harness import REPO_ROOT, ServerProcess, send_request
+
+sys.path.insert(0, REPO_ROOT)
+from common.log_writer import LogWriter, Logger, DEBUG, INFO
+
+MAX_LOG_SIZE = 10 * 1024 * 1024
+
+
+def sync_logger(path):
+    """The logger before LogWriter: every line opens, appends, closes, prints and stats the file."""
+    def log_info(message):
+        with open(path, "a") as log_file:
+            log_file.write(f"[INFO] {datetime.now()} - {message}\n")
+        print(f"[INFO] {message}")
+        if os.path.exists(path) and os.path.getsize(path) > MAX_LOG_SIZE:
+            with open(path, "w") as log_file:
+                log_file.write(f"[INFO] {datetime.now()} - Log cleared due to size limit\n")
+            print("[INFO] Log file cleared due to size limit")
+    return log_info, lambda: None
+
+
+def buffered_logger(path):
+    writer = LogWriter(path, MAX_LOG_SIZE, backups=5)
+    return lambda message: writer.write("INFO", message), writer.close
+
+
+LOGGERS = {"sync": sync_logger, "buffered": buffered_logger}
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    saved = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = saved
+
+
+def run_logger(name, lines, threads):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    log_info, close = LOGGERS[name](os.path.join(workdir, "bench.log"))
+    per_thread = lines // threads
+    samples = [[] for _ in range(threads)]
+
+    def produce(latencies):
+        clock = time.perf_counter
+        for i in range(per_thread):
+            t0 = clock()
+            log_info(f"Received request from 127.0.0.1:5{i % 1000:04d}: list_channels")
+            latencies.append(clock() - t0)
+
+    try:
+        with quiet_stdout():
+            workers = [threading.Thread(target=produce, args=(samples[i],)) for i in range(threads)]
+            t0 = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            close() # Until every line is written
+            elapsed = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    latencies = sorted(value for thread_samples in samples for value in thread_samples)
+    return len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def run_gating(calls):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    writer = LogWriter(os.path.join(workdir, "bench.log"), echo=False)
+    logger = Logger(writer, "INFO", sample={"get_user_status": 100})
+
+    def log_info(message, *args, **fields): # As in server/logger.py
+        if logger.threshold <= INFO:
+            logger.log(INFO, "INFO", message, args, False, fields)
+
+    def log_debug(message, *args, **fields):
+        if logger.threshold <= DEBUG:
+            logger.log(DEBUG, "DEBUG", message, args, False, fields)
+
+    request = {"type": "channel", "action": "sync_from_server", "channel_name": "General",
+               "username": "bench", "since": 1234, "stream": True}
+    cases = {
+        "f-string, enabled": lambda: log_info(f"Received request from {addr}: {request}"),
+        "f-string, disabled": lambda: log_debug(f"Received request from {addr}: {request}"),
+        "lazy, disabled": lambda: log_debug("Received request from %s: %s", addr, request),
+        "sampled 1/100": lambda: log_info("Handled %s request from %s", "get_user_status", "bench",
+                                          event="get_user_status", user="bench", latency_ms=0.1),
+    }
+    addr = "127.0.0.1:50000"
+    results = {}
+    try:
+        for name, call in cases.items():
+            t0 = time.perf_counter()
+            for _ in range(calls):
+                call()
+            results[name] = (time.perf_counter() - t0) / calls
+            writer.flush(60)
+    finally:
+        writer.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def run_requests(clients, duration):
+    latencies, stop = [], threading.Event()
+    with ServerProcess() as server:
+        def client(i):
+            sock = server.connect()
+            reader = sock.makefile("rb")
+
+            def call(request):
+                send_request(sock, request)
+                while True:
+                    message = json.loads(reader.readline())
+                    if "status" in message:
+                        return message
+            call({"type": "auth", "action": "register", "username": f"bench{i}", "password": "pw"})
+            call({"type": "auth", "action": "login", "username": f"bench{i}", "password": "pw"})
+            ready.wait()
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                call({"type": "channel", "action": "list_channels"})
+                latencies.append(time.perf_counter() - t0)
+            sock.close()
+
+        ready = threading.Event()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        for t in threads:
+            t.start()
+        time.sleep(1.0)
+        cpu0 = server.cpu_seconds()
+        ready.set()
+        time.sleep(duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        cpu = server.cpu_seconds() - cpu0
+    latencies.sort()
+    return (len(latencies) / duration, statistics.median(latencies), latencies[int(len(latencies) * 0.99)],
+            cpu / len(latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--sections", default="logger,gating,requests")
+    args = parser.parse_args()
+    sections = args.sections.split(",")
+
+    if "logger" in sections:
+        print(f"{'logger':>9} {'threads':>8} {'lines/s':>10} {'p50 us':>8} {'p99 us':>8}")
+        for name in LOGGERS:
+            for threads in sorted({1, args.threads}):
+                rate, p50, p99 = run_logger(name, args.lines, threads)
+                print(f"{name:>9} {threads:>8} {rate:>10.0f} {p50 * 1e6:>8.2f} {p99 * 1e6:>8.2f}")
+    if "gating" in sections:
+        for name, seconds in run_gating(args.lines).items():
+            print(f"{name:>20}: {seconds * 1e9:>8.0f} ns/call")
+    if "requests" in sections:
+        rate, p50, p99, cpu = run_requests(args.clients, args.duration)
+        print(f"{args.clients} clients, list_channels: {rate:.0f} req/s, p50 {p50 * 1000:.3f} ms, "
+              f"p99 {p99 * 1000:.3f} ms, server cpu {cpu * 1e6:.0f} us/req")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Reconnect storm: logins per second against the number of registered users.
+
+A fresh server is seeded with a users.json of U users. Then --clients client
+threads log in --logins distinct users between them as fast as they can, each
+login on a new connection that is closed right after the reply (so every login
+is followed by a disconnection, as after a server restart). Reported: logins/s
+and median / p99 login latency.
+
+Before the in-memory user registry each login and each disconnection loaded
+users.json and rewrote it, so the cost grew with U.
+
+    python benchmarks/bench_login_storm.py --users 1000,10000 --clients 32 --logins 2000
+"""
+import argparse
+import json
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from _harness import ServerProcess, send_request, read_response
+
+
+def users_file(count):
+    return json.dumps({"users": [{"username": f"user{i}", "password": f"pw{i}", "status": "offline"}
+                                 for i in range(count)]}, indent=4)
+
+
+def client(server, names, latencies, errors):
+    try:
+        for name in names:
+            t0 = time.perf_counter()
+            sock = server.connect(timeout=60)
+            send_request(sock, {"type": "auth", "action": "login", "username": name, "password": f"pw{name[4:]}"})
+            response, _ = read_response(sock)
+            latencies.append(time.perf_counter() - t0)
+            sock.close()
+            assert response.get("status") == "success", response
+    except Exception as e:
+        errors.append(e)
+
+
+def run(users, clients, logins, env):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    try:
+        latencies, errors = [], []
+        names = [f"user{i % users}" for i in range(logins)]
+        with ServerProcess(workdir=workdir, env=env, files={"server/users.json": users_file(users)}) as server:
+            server.connect(timeout=120).close() # Wait until it accepts connections
+            threads = [threading.Thread(target=client, args=(server, names[c::clients], latencies, errors))
+                       for c in range(clients)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0
+    return len(latencies) / elapsed, statistics.median(latencies) if latencies else 0.0, p99, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1000,10000")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--logins", type=int, default=2000)
+    parser.add_argument("--storage", default="json", choices=("json", "sqlite"), help="CHAT_USER_STORAGE")
+    args = parser.parse_args()
+
+    env = {"CHAT_USER_STORAGE": args.storage}
+    print(f"{args.logins} logins from {args.clients} concurrent clients, {args.storage} user storage")
+    print(f"{'users':>8} {'logins/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for users in (int(n) for n in args.users.split(",")):
+        rate, p50, p99, errors = run(users, args.clients, args.logins, env)
+        print(f"{users:>8} {rate:>9.0f} {p50 * 1000:>8.2f} {p99 * 1000:>8.2f}"
+              + (f"  {len(errors)} error(s): {errors[0]!r}" if errors else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Channel storage backends: channels.json vs the segmented message log.
+
+For a channel of H messages, runs the server's storage code in-process and
+measures, best of --rounds:
+
+* flush  - one write-behind round after --batch new messages were stored
+           (json rewrites the whole document, log appends the new records)
+* tail   - reading the newest --batch messages back from disk (json parses
+           the whole file, log seeks with its sparse index and maps the
+           records, as a streamed catch-up does, then decodes them)
+
+    python benchmarks/bench_message_log.py --history 10000,100000,1000000 --batch 100
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from _harness import use_server_modules, make_messages
+
+os.chdir(tempfile.mkdtemp(prefix="chatbench-")) # The server logger writes logs/ in the cwd
+use_server_modules()
+from channel_store import ChannelStore, JsonFileBackend  # noqa: E402
+from message_log import MessageLogBackend  # noqa: E402
+
+
+def seed(history):
+    os.makedirs("server", exist_ok=True)
+    messages = make_messages(history)
+    for index, message in enumerate(messages):
+        message["seq"] = index + 1
+    with open("server/channels.json", "w", encoding="utf-8") as f:
+        json.dump({"channels": {"General": {"host": "system", "participants": [], "messages": messages,
+                                            "last_seq": history}}}, f)
+
+
+def append(store, batch, start):
+    with store.lock:
+        channel = store.load()["channels"]["General"]
+        for message in make_messages(batch, start=start):
+            channel["last_seq"] += 1
+            message["seq"] = channel["last_seq"]
+            channel["messages"].append(message)
+    store.mark_dirty(batch)
+
+
+def timed(fn, rounds):
+    best = None
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(history, batch, rounds):
+    results = {}
+    for name in ("json", "log"):
+        seed(history)
+        directory = f"server/channel_log_{history}"
+        if name == "json":
+            backend = JsonFileBackend("server/channels.json")
+        else:
+            backend = MessageLogBackend(directory, "server/channels.json")
+        store = ChannelStore(backend, flush_interval=3600, dirty_threshold=1 << 30)
+        store.load() # The log migrates channels.json here, once
+
+        counter = [history]
+
+        def flush():
+            append(store, batch, counter[0]) # Not timed separately: in-memory only
+            counter[0] += batch
+            store.flush()
+        flush_s = timed(flush, rounds)
+
+        if name == "json":
+            def tail():
+                with open("server/channels.json", encoding="utf-8") as f:
+                    messages = json.load(f)["channels"]["General"]["messages"]
+                return messages[-batch:]
+        else:
+            messages = store.data["channels"]["General"]["messages"]
+            log, written = backend.logged_records("General", messages)
+
+            def tail():
+                return [json.loads(bytes(payload)) for payloads in log.payload_chunks(written - batch, written, batch)
+                        for payload in payloads]
+            assert tail() == messages[-batch:]
+        tail_s = timed(tail, rounds)
+        store.close()
+        results[name] = (flush_s, tail_s)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", default="10000,100000,1000000")
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{args.batch} new / newest messages, best of {args.rounds}")
+    print(f"{'history':>8} {'backend':>8} {'flush ms':>10} {'tail ms':>10}")
+    for history in (int(n) for n in args.history.split(",")):
+        for name, (flush_s, tail_s) in run(history, args.batch, args.rounds).items():
+            print(f"{history:>8} {name:>8} {flush_s * 1000:>10.2f} {tail_s * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Cost of caching messages typed while offline, against the number already cached.
+
+For every N in --sizes, N messages are saved to the client's offline cache one
+after the other, then read back for syncing:
+
+* json     - the former cache, reproduced here as a baseline: a linear duplicate
+             scan, then client_cache.json rewritten with indent=4 per message
+* journal  - client/offline_cache.OfflineJournal: one record appended and fsync'd
+* nofsync  - the journal with CHAT_CLIENT_CACHE_FSYNC=0 (flush, no fsync)
+
+Reported: ms per save for the last 100 saves (grows with N for json), total
+seconds, file size, and ms to read the pending messages back (json.load of the
+whole file vs. batches of 500 from the journal).
+
+    python benchmarks/bench_offline_cache.py --sizes 1000,5000
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from _harness import REPO_ROOT, CLIENT_DIR
+
+sys.path[:0] = [CLIENT_DIR, REPO_ROOT]
+from offline_cache import OfflineJournal
+
+
+class JsonCache:
+    """save_local_message / save_local_cache before the journal."""
+
+    def __init__(self, path):
+        self.path = path
+        self.channels = {}
+
+    def save(self, channel_name, message):
+        messages = self.channels.setdefault(channel_name, {"messages": []})["messages"]
+        if any(m.get("timestamp") == message["timestamp"] and m.get("username") == message["username"]
+               and m.get("message") == message["message"] for m in messages):
+            return
+        messages.append(message)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.channels, f, ensure_ascii=False, indent=4)
+
+    def read_back(self, channel_name):
+        with open(self.path, encoding="utf-8") as f:
+            return len(json.load(f)[channel_name]["messages"])
+
+    def close(self):
+        pass
+
+
+class JournalCache:
+    def __init__(self, path, fsync=True):
+        self.journal = OfflineJournal(path, fsync=fsync)
+
+    def save(self, channel_name, message):
+        self.journal.append(channel_name, message)
+
+    def read_back(self, channel_name):
+        return sum(len(batch) for batch, _ in self.journal.pending(channel_name, 500))
+
+    def close(self):
+        self.journal.close()
+
+
+CACHES = {
+    "json": lambda path: JsonCache(path + ".json"),
+    "journal": lambda path: JournalCache(path + ".journal"),
+    "nofsync": lambda path: JournalCache(path + ".journal", fsync=False),
+}
+
+
+def run(name, count):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    cache = CACHES[name](os.path.join(workdir, "client_cache"))
+    base = datetime.datetime(2024, 1, 1)
+    timings = []
+    try:
+        t0 = time.perf_counter()
+        for i in range(count):
+            message = {"username": "alice", "message": f"Offline message {i}: the quick brown fox jumps over the lazy dog",
+                       "timestamp": (base + datetime.timedelta(milliseconds=i)).isoformat() + "Z"}
+            t1 = time.perf_counter()
+            cache.save("General", message)
+            timings.append(time.perf_counter() - t1)
+        total = time.perf_counter() - t0
+        size = sum(os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir))
+        t1 = time.perf_counter()
+        assert cache.read_back("General") == count
+        read_ms = (time.perf_counter() - t1) * 1000
+        cache.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    last = timings[-100:]
+    return sum(last) / len(last) * 1000, total, size, read_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,5000")
+    args = parser.parse_args()
+    print(f"{'cached':>7} {'cache':>8} {'ms/save':>8} {'total s':>8} {'KB':>8} {'read ms':>8}")
+    for count in (int(size) for size in args.sizes.split(",")):
+        for name in CACHES:
+            per_save, total, size, read_ms = run(name, count)
+            print(f"{count:>7} {name:>8} {per_save:>8.3f} {total:>8.2f} {size / 1024:>8.0f} {read_ms:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
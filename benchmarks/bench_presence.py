@@ -0,0 +1,122 @@
+"""Channel presence at scale: list scans vs sets with a user -> channels index.
+
+Seeds --channels channels and --users users, every user a member of
+--memberships random channels (half of them online), then times, per
+operation in microseconds:
+
+* status   - a user goes online / offline (update_user_channel_presence)
+* leave    - a user disconnects and is removed from every list
+* join     - a user is listed in one more channel (join_channel)
+* list     - the online / offline lists of a channel (get_user_status)
+
+"before" is the list-based code that presence.py replaced, reproduced below;
+it visits every channel on status changes and disconnections.
+
+    python benchmarks/bench_presence.py --channels 10000 --users 50000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from _harness import use_server_modules
+
+os.chdir(tempfile.mkdtemp(prefix="chatbench-"))
+use_server_modules()
+import presence  # noqa: E402
+from shared import channel_users  # noqa: E402
+
+
+# --- The previous implementation (lists in channel_users, no reverse index) ---
+def legacy_status(lists_by_channel, username, online):
+    for channel_data in lists_by_channel.values():
+        online_list = channel_data.setdefault("online", [])
+        offline_list = channel_data.setdefault("offline", [])
+        if username in online_list:
+            online_list.remove(username)
+        if username in offline_list:
+            offline_list.remove(username)
+        if online:
+            if username not in online_list:
+                online_list.append(username)
+        elif username not in offline_list:
+            offline_list.append(username)
+
+def legacy_leave(lists_by_channel, username):
+    for channel_data in lists_by_channel.values():
+        if username in channel_data.get("online", []):
+            channel_data["online"].remove(username)
+        if username in channel_data.get("offline", []):
+            channel_data["offline"].remove(username)
+
+def legacy_join(lists_by_channel, channel_name, username):
+    lists = lists_by_channel.setdefault(channel_name, {"online": [], "offline": []})
+    if username in lists["offline"]:
+        lists["offline"].remove(username)
+    if username not in lists["online"]:
+        lists["online"].append(username)
+    lists["online"] = list(set(lists["online"]))
+    lists["offline"] = list(set(lists["offline"]))
+
+def legacy_list(lists_by_channel, channel_name):
+    lists = lists_by_channel.get(channel_name, {})
+    return list(set(lists.get("online", []))), list(set(lists.get("offline", [])))
+
+
+def seed(channels, users, memberships):
+    rng = random.Random(1)
+    legacy = {}
+    presence.clear_presence()
+    for u in range(users):
+        name = f"user{u}"
+        online = u % 2 == 0
+        for c in rng.sample(range(channels), memberships):
+            channel = f"channel{c}"
+            presence.set_channel_presence(channel, name, online)
+            lists = legacy.setdefault(channel, {"online": [], "offline": []})
+            lists["online" if online else "offline"].append(name)
+    return legacy
+
+
+def per_op_us(fn, names):
+    t0 = time.perf_counter()
+    for i, name in enumerate(names):
+        fn(i, name)
+    return (time.perf_counter() - t0) / len(names) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--memberships", type=int, default=4, help="channels per user")
+    parser.add_argument("--ops", type=int, default=200, help="operations timed per row (the old code is slow)")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    legacy = seed(args.channels, args.users, args.memberships)
+    print(f"{args.channels} channels, {args.users} users, {args.memberships} channels per user "
+          f"(seeded in {time.perf_counter() - t0:.1f} s); microseconds per operation")
+    names = [f"user{u}" for u in range(0, args.users, max(1, args.users // args.ops))][:args.ops]
+    channels = [f"channel{c}" for c in range(len(names))]
+
+    rows = (
+        ("status", lambda i, n: legacy_status(legacy, n, i % 2 == 1),
+                   lambda i, n: presence.update_user_presence(n, i % 2 == 1)),
+        ("join", lambda i, n: legacy_join(legacy, channels[-1 - i], n),
+                 lambda i, n: presence.set_channel_presence(channels[-1 - i], n, True)),
+        ("list", lambda i, n: legacy_list(legacy, channels[i]),
+                 lambda i, n: presence.channel_presence(channels[i])),
+        ("leave", lambda i, n: legacy_leave(legacy, n),
+                  lambda i, n: presence.remove_user(n)),
+    )
+    print(f"{'operation':<10} {'before us':>12} {'after us':>10} {'speedup':>9}")
+    for label, before, after in rows:
+        before_us, after_us = per_op_us(before, names), per_op_us(after, names)
+        print(f"{label:<10} {before_us:>12.1f} {after_us:>10.2f} {before_us / after_us:>8.0f}x")
+    assert all(lists["online"] or lists["offline"] for lists in channel_users.values())
+
+
+if __name__ == "__main__":
+    main()
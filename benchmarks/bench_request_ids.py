@@ -0,0 +1,124 @@
+"""Head-of-line blocking: a save_message sent right behind a large sync_from_server.
+
+One connection sends, --rounds times, a sync_from_server of the whole history
+(--messages stored messages) immediately followed by a save_message, both with a
+request_id, and waits for both replies. Reported: median / p95 time until the
+save_message reply arrives, and until the sync reply (or stream) has arrived.
+
+Cases:
+  in order  - CHAT_REQUEST_WORKERS=0: requests run one after the other on the
+              connection's reader, as before request ids
+  workers   - requests with ids run on the worker pool, replies come back as each
+              request finishes
+  streamed  - workers, and the sync is streamed in history_chunk frames, which
+              tagged replies overtake in the connection's outbound queue
+
+The response cache is disabled so every sync is built and encoded.
+
+    python benchmarks/bench_request_ids.py --messages 50000 --rounds 20
+"""
+import argparse
+import re
+import statistics
+import threading
+import time
+
+from _harness import ServerProcess, channels_file, make_messages, send_request
+
+CASES = {
+    "in order": ({"CHAT_REQUEST_WORKERS": "0"}, False),
+    "workers": ({"CHAT_REQUEST_WORKERS": "8"}, False),
+    "streamed": ({"CHAT_REQUEST_WORKERS": "8"}, True),
+}
+
+_REQUEST_ID = re.compile(rb'"request_id": (\d+)\}$')
+
+
+class Replies:
+    """Reads NDJSON replies on a thread and records when each request_id arrived."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.arrived = {}
+        self.condition = threading.Condition()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        pieces = [] # Of the line being received
+        while True:
+            try:
+                data = self.sock.recv(1 << 20)
+            except OSError:
+                return
+            if not data:
+                return
+            now = time.perf_counter()
+            *ends, rest = data.split(b"\n")
+            for end in ends:
+                line = b"".join(pieces) + end if pieces else end
+                pieces = []
+                match = _REQUEST_ID.search(line, max(0, len(line) - 40)) # No need to parse large replies
+                if match:
+                    with self.condition:
+                        self.arrived[int(match.group(1))] = now
+                        self.condition.notify_all()
+            if rest:
+                pieces.append(rest)
+
+    def wait(self, request_id, timeout=60):
+        with self.condition:
+            self.condition.wait_for(lambda: request_id in self.arrived, timeout)
+            return self.arrived[request_id]
+
+
+def run_case(env, stream, messages, rounds):
+    env = dict(env, CHAT_RESPONSE_CACHE_MAX_BYTES="0")
+    files = {"server/channels.json": channels_file({"General": make_messages(messages)})}
+    save_latencies, sync_latencies = [], []
+    with ServerProcess(env=env, files=files) as server:
+        sock = server.connect(timeout=None)
+        replies = Replies(sock)
+        ids = iter(range(1, 1000000))
+
+        def call(request):
+            request_id = next(ids)
+            send_request(sock, dict(request, request_id=request_id))
+            return request_id
+        replies.wait(call({"type": "auth", "action": "visitor_login", "visitor_name": "bench"}))
+        replies.wait(call({"type": "channel", "action": "join_channel", "channel_name": "General",
+                           "username": "bench"}))
+        sync = {"type": "channel", "action": "sync_from_server", "channel_name": "General", "username": "bench"}
+        if stream:
+            sync["stream"] = True
+        for i in range(rounds):
+            t0 = time.perf_counter()
+            sync_id = call(sync)
+            save_id = call({"type": "channel", "action": "save_message", "channel_name": "General",
+                            "username": "bench", "message": f"hello {i}"})
+            save_latencies.append(replies.wait(save_id) - t0)
+            sync_latencies.append(replies.wait(sync_id) - t0)
+        sock.close()
+    return save_latencies, sync_latencies
+
+
+def summary(values):
+    values = sorted(values)
+    return statistics.median(values) * 1000, values[int(len(values) * 0.95)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages in the channel, {args.rounds} rounds")
+    print(f"{'case':>9} {'save p50 ms':>12} {'save p95 ms':>12} {'sync p50 ms':>12} {'sync p95 ms':>12}")
+    for name, (env, stream) in CASES.items():
+        save, sync = run_case(env, stream, args.messages, args.rounds)
+        print(f"{name:>9} {summary(save)[0]:>12.1f} {summary(save)[1]:>12.1f} "
+              f"{summary(sync)[0]:>12.1f} {summary(sync)[1]:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Hot channel reads with and without the encoded-response cache.
+
+A fresh server is seeded with one channel of --history messages. --clients
+members of the channel then repeat, as fast as they get replies:
+
+* history   - sync_from_server without a cursor (the whole history)
+* presence  - get_user_status of the channel (--clients names online)
+
+Optionally a writer stores one message every --write-interval-ms, which bumps
+the channel version and invalidates both views. Reported per configuration:
+requests/s, median latency, server CPU ms per request, and the cache counters
+the server logs at shutdown.
+
+    python benchmarks/bench_response_cache.py --clients 32 --history 1000 --write-interval-ms 100
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from _harness import ServerProcess, channels_file, make_messages, send_request
+
+VIEWS = {
+    "history": lambda name: {"type": "channel", "action": "sync_from_server", "channel_name": "General",
+                             "username": name},
+    "presence": lambda name: {"type": "get_user_status", "channel": "General"},
+}
+
+
+def connect(server, name):
+    sock = server.connect(timeout=120)
+    reader = sock.makefile("rb")
+
+    def call(request):
+        send_request(sock, request)
+        while True:
+            message = json.loads(reader.readline())
+            if "status" in message: # Skip pushes
+                return message
+
+    for request in (
+        {"type": "auth", "action": "register", "username": name, "password": "pw"},
+        {"type": "auth", "action": "login", "username": name, "password": "pw"},
+        {"type": "channel", "action": "join_channel", "channel_name": "General", "username": name},
+    ):
+        call(request)
+    return sock, call
+
+
+def cache_stats(workdir):
+    with open(os.path.join(workdir, "logs", "server.log"), encoding="utf-8") as f:
+        found = re.findall(r"Response cache stats: (\{.*\})", f.read())
+    return ast.literal_eval(found[-1]) if found else None
+
+
+def run(view, cached, clients, history, duration, write_interval):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    env = {} if cached else {"CHAT_RESPONSE_CACHE_MAX_BYTES": "0"}
+    files = {"server/channels.json": channels_file({"General": make_messages(history)})}
+    latencies, stop = [], threading.Event()
+    try:
+        with ServerProcess(workdir=workdir, env=env, files=files) as server:
+            connections = [connect(server, f"bench{i}") for i in range(clients)]
+            writer = connect(server, "writer") if write_interval else None
+
+            def reader(name, call):
+                request = VIEWS[view](name)
+                while not stop.is_set():
+                    t0 = time.perf_counter()
+                    response = call(request)
+                    latencies.append(time.perf_counter() - t0)
+                    assert response.get("status") == "success", response
+
+            def write_loop():
+                i = 0
+                while not stop.wait(write_interval):
+                    writer[1]({"type": "channel", "action": "save_message", "channel_name": "General",
+                               "username": "writer", "message": f"invalidate {i}"})
+                    i += 1
+
+            threads = [threading.Thread(target=reader, args=(f"bench{i}", call))
+                       for i, (_, call) in enumerate(connections)]
+            if writer:
+                threads.append(threading.Thread(target=write_loop))
+            cpu0 = server.cpu_seconds()
+            for t in threads:
+                t.start()
+            time.sleep(duration)
+            stop.set()
+            for t in threads:
+                t.join()
+            cpu = server.cpu_seconds() - cpu0
+            for sock, _ in connections + ([writer] if writer else []):
+                sock.close()
+        stats = cache_stats(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return len(latencies) / duration, statistics.median(latencies), cpu / max(1, len(latencies)), stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--history", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--write-interval-ms", type=float, default=0, help="0: no writer")
+    parser.add_argument("--views", default=",".join(VIEWS))
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients, {args.history} messages, writer every "
+          f"{args.write_interval_ms or '-'} ms, {args.duration:.0f} s per row")
+    print(f"{'view':>9} {'cache':>6} {'req/s':>8} {'p50 ms':>8} {'cpu ms/req':>11} {'hit rate':>9}")
+    for view in args.views.split(","):
+        for cached in (False, True):
+            rate, p50, cpu, stats = run(view, cached, args.clients, args.history, args.duration,
+                                        args.write_interval_ms / 1000)
+            hit_rate = f"{stats['hit_rate']:>9.3f}" if cached and stats else f"{'-':>9}"
+            print(f"{view:>9} {'on' if cached else 'off':>6} {rate:>8.0f} {p50 * 1000:>8.2f} {cpu * 1000:>11.3f} {hit_rate}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""save_message throughput against the size of the channel history.
+
+A fresh server is seeded with one channel of H messages, then a single client
+stores --messages chat messages one after the other (request, wait for reply).
+Throughput and median latency are reported per history size. When the server has
+stopped, channels.json is read back to check every stored message was persisted.
+
+Before the in-memory channel store every save reloaded and rewrote the whole
+channels.json, so the cost grew with H; with write-behind it should not.
+
+    python benchmarks/bench_save_message.py --history 1000,10000,100000 --messages 300
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from _harness import ServerProcess, send_request, read_response, channels_file, make_messages
+
+
+def run(history, count):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    try:
+        files = {"server/channels.json": channels_file({"General": make_messages(history)})}
+        with ServerProcess(workdir=workdir, files=files) as server:
+            sock = server.connect(timeout=120)
+            name = "bench"
+            for request in (
+                {"type": "auth", "action": "register", "username": name, "password": "pw"},
+                {"type": "auth", "action": "login", "username": name, "password": "pw"},
+                {"type": "channel", "action": "join_channel", "channel_name": "General", "username": name},
+            ):
+                send_request(sock, request)
+                read_response(sock)
+
+            latencies = []
+            start = time.perf_counter()
+            for i in range(count):
+                t0 = time.perf_counter()
+                send_request(sock, {"type": "channel", "action": "save_message", "channel_name": "General",
+                                    "username": name, "message": f"bench message {i}"})
+                response, _ = read_response(sock)
+                assert response.get("status") == "success", response
+                latencies.append(time.perf_counter() - t0)
+            elapsed = time.perf_counter() - start
+            sock.close()
+        # The server has been stopped (SIGTERM): everything must be on disk now
+        with open(os.path.join(workdir, "server", "channels.json"), encoding="utf-8") as f:
+            stored = json.load(f)["channels"]["General"]["messages"]
+        persisted = sum(1 for msg in stored if msg.get("message", "").startswith("bench message "))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return count / elapsed, statistics.median(latencies), persisted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", default="1000,10000,100000")
+    parser.add_argument("--messages", type=int, default=300)
+    args = parser.parse_args()
+
+    print(f"{args.messages} sequential save_message calls per run")
+    print(f"{'history':>8} {'msgs/s':>9} {'p50 ms':>8} {'persisted':>10}")
+    for history in (int(n) for n in args.history.split(",")):
+        rate, p50, persisted = run(history, args.messages)
+        print(f"{history:>8} {rate:>9.0f} {p50 * 1000:>8.2f} {persisted:>6}/{args.messages}")
+
+
+if __name__ == "__main__":
+    main()
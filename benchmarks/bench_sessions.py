@@ -0,0 +1,111 @@
+"""Per-connection state: parallel dicts vs the session registry.
+
+In-process microbenchmark of what every request pays before reaching its handler,
+and of the memory each connection keeps:
+
+* lookup  - the state a request reads: address, username, role, status,
+            wire protocol and subscribed channel. Before, that was getpeername()
+            plus one lookup in connected_clients, user_roles, user_status,
+            client_protocols and client_channels; now it is one sessions.get().
+* memory  - bytes per connection for --connections logged-in connections
+            (tracemalloc), dict entries vs a __slots__ Session plus two index
+            entries
+
+    python benchmarks/bench_sessions.py --connections 10000
+"""
+import argparse
+import os
+import socket
+import tempfile
+import time
+import tracemalloc
+
+from _harness import use_server_modules
+
+os.chdir(tempfile.mkdtemp(prefix="chatbench-"))
+use_server_modules()
+from sessions import SessionRegistry  # noqa: E402
+
+
+class Conn:
+    """Hashable stand-in for a socket in the memory test (no file descriptor needed)."""
+    __slots__ = ()
+
+
+def legacy_state(count, sockets):
+    connected_clients, user_roles, user_status, client_protocols, client_channels = {}, {}, {}, {}, {}
+    for i, sock in enumerate(sockets):
+        name = f"user{i}"
+        connected_clients[sock] = name
+        user_roles[name] = "authenticated"
+        user_status[name] = "online"
+        client_protocols[sock] = "json"
+        client_channels[sock] = f"channel{i % 100}"
+    return connected_clients, user_roles, user_status, client_protocols, client_channels
+
+
+def registry_state(count, sockets):
+    registry = SessionRegistry()
+    for i, sock in enumerate(sockets):
+        session = registry.open(sock, ("10.0.0.1", 40000 + i % 20000))
+        registry.bind(session, f"user{i}", "authenticated", "online")
+        session.channel = f"channel{i % 100}"
+    return registry
+
+
+def bytes_per_connection(build, count):
+    sockets = [Conn() for _ in range(count)]
+    names = [f"user{i}" for i in range(count)] # Interned outside the measurement in both cases
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = build(count, sockets)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del state, names
+    return used / count
+
+
+def lookup_ns(rounds):
+    a, b = socket.socketpair()
+    try:
+        connected_clients, user_roles, user_status, client_protocols, client_channels = legacy_state(1, [a])
+        registry = registry_state(1, [a])
+
+        def legacy():
+            address = a.getpeername() if a and a.fileno() != -1 else "Unknown Address"
+            user = connected_clients.get(a)
+            return (address, user, user_roles.get(user), user_status.get(user, "offline"),
+                    client_protocols.get(a, "json"), client_channels.get(a))
+
+        def session():
+            s = registry.get(a)
+            return s.address, s.username, s.role, s.status, s.protocol, s.channel
+
+        results = []
+        for fn in (legacy, session):
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                fn()
+            results.append((time.perf_counter() - t0) / rounds * 1e9)
+        return results
+    finally:
+        a.close()
+        b.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=200000)
+    args = parser.parse_args()
+
+    legacy_ns, session_ns = lookup_ns(args.rounds)
+    legacy_bytes = bytes_per_connection(legacy_state, args.connections)
+    session_bytes = bytes_per_connection(registry_state, args.connections)
+    print(f"{'':<24} {'dicts':>10} {'sessions':>10}")
+    print(f"{'per-request lookup ns':<24} {legacy_ns:>10.0f} {session_ns:>10.0f}")
+    print(f"{'bytes per connection':<24} {legacy_bytes:>10.0f} {session_bytes:>10.0f}   ({args.connections} connections)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""One stalled subscriber must not slow down the sender or the other subscribers.
+
+S subscribers of General stop reading (small receive buffer, never recv) while
+one healthy subscriber keeps reading. A sender then stores M messages with
+save_message, waiting for each reply. Reported per slow-consumer policy:
+
+* sender round-trip of save_message (median / p99 / max)
+* how many pushes the healthy subscriber received
+* what the stalled subscribers find once they finally read: delivered pushes,
+  resync notices, or a closed connection
+
+    python benchmarks/bench_slow_consumer.py --stalled 5 --messages 2000
+"""
+import argparse
+import socket
+import statistics
+import time
+
+from _harness import ServerProcess, send_request, read_response
+
+PAYLOAD = "x" * 2000 # Large enough to fill the stalled clients' socket buffers quickly
+
+
+def session(server, name, rcvbuf=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.settimeout(30)
+    sock.connect(("127.0.0.1", server.port))
+    for request in (
+        {"type": "auth", "action": "register", "username": name, "password": "pw"},
+        {"type": "auth", "action": "login", "username": name, "password": "pw"},
+        {"type": "channel", "action": "join_channel", "channel_name": "General", "username": name},
+    ):
+        send_request(sock, request)
+        response, rest = read_response(sock)
+        while response.get("type"): # Skip pushes about earlier joins
+            response, rest = read_response(sock, rest)
+    return sock
+
+
+def drain(sock, idle_timeout=2.0):
+    """Reads everything the server sends until it goes quiet. Returns (pushes, resyncs, closed)."""
+    sock.settimeout(idle_timeout)
+    buffer = b""
+    closed = False
+    while True:
+        try:
+            chunk = sock.recv(1 << 20)
+        except socket.timeout:
+            break
+        except OSError:
+            closed = True
+            break
+        if not chunk:
+            closed = True
+            break
+        buffer += chunk
+    lines = buffer.split(b"\n")
+    pushes = sum(1 for line in lines if b'"new_message"' in line)
+    resyncs = sum(1 for line in lines if b'"resync"' in line)
+    return pushes, resyncs, closed
+
+
+def run(policy, stalled, messages):
+    env = {"CHAT_SLOW_CONSUMER_POLICY": policy}
+    with ServerProcess(env=env) as server:
+        stalled_socks = [session(server, f"stalled{i}", rcvbuf=4096) for i in range(stalled)]
+        healthy = session(server, "healthy")
+        sender = session(server, "sender")
+
+        times = []
+        rest = b""
+        timed_out = False
+        for i in range(messages):
+            t0 = time.perf_counter()
+            send_request(sender, {"type": "channel", "action": "save_message", "channel_name": "General",
+                                  "username": "sender", "message": f"{i} {PAYLOAD}"})
+            try:
+                response, rest = read_response(sender, rest)
+                while response.get("type"):
+                    response, rest = read_response(sender, rest)
+            except socket.timeout:
+                timed_out = True
+                break
+            times.append(time.perf_counter() - t0)
+
+        healthy_pushes = drain(healthy)[0]
+        stalled_results = [drain(sock) for sock in stalled_socks]
+        for sock in stalled_socks + [healthy, sender]:
+            sock.close()
+
+    times.sort()
+    return {
+        "policy": policy,
+        "sent": len(times),
+        "timed_out": timed_out,
+        "median_ms": statistics.median(times) * 1000 if times else float("nan"),
+        "p99_ms": times[int(len(times) * 0.99) - 1] * 1000 if times else float("nan"),
+        "max_ms": times[-1] * 1000 if times else float("nan"),
+        "healthy": healthy_pushes,
+        "stalled_pushes": sum(r[0] for r in stalled_results) / max(1, stalled),
+        "stalled_resyncs": sum(r[1] for r in stalled_results) / max(1, stalled),
+        "stalled_closed": sum(1 for r in stalled_results if r[2]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stalled", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--policies", default="drop,coalesce,disconnect")
+    args = parser.parse_args()
+
+    print(f"{args.stalled} stalled subscribers, {args.messages} messages of ~2 KB")
+    print(f"{'policy':<11} {'stored':>6} {'median ms':>10} {'p99 ms':>8} {'max ms':>8} {'healthy rx':>11} "
+          f"{'stalled rx':>11} {'resyncs':>8} {'closed':>7}")
+    any_timeout = False
+    for policy in args.policies.split(","):
+        r = run(policy, args.stalled, args.messages)
+        any_timeout = any_timeout or r["timed_out"]
+        stored = f"{r['sent']}" + ("*" if r["timed_out"] else "")
+        print(f"{r['policy']:<11} {stored:>6} {r['median_ms']:>10.2f} {r['p99_ms']:>8.2f} {r['max_ms']:>8.1f} "
+              f"{r['healthy']:>11} {r['stalled_pushes']:>11.0f} {r['stalled_resyncs']:>8.0f} {r['stalled_closed']:>7}")
+    if any_timeout:
+        print("* sender timed out waiting for a reply")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""JSON files vs the SQLite (WAL) repository at 10k users and 1M messages.
+
+Runs the server's storage code in-process on seeded data and measures the
+median cost of:
+
+* register    - register() of a new user
+* credentials - credentials(), what UserRegistry reads once at startup
+* append      - one new message made durable (one write-behind flush of the
+                channel store)
+
+plus --threads handler threads registering users concurrently against
+SQLite, to show the writes hold up under concurrency. Logins and status
+changes never reach the repository (see UserRegistry).
+
+    python benchmarks/bench_sqlite.py --users 10000 --messages 1000000
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from _harness import use_server_modules, make_messages
+
+os.chdir(tempfile.mkdtemp(prefix="chatbench-")) # The server logger writes logs/ in the cwd
+use_server_modules()
+from channel_store import ChannelStore, JsonFileBackend  # noqa: E402
+from repository import JsonUserRepository, SqliteRepository  # noqa: E402
+
+
+def seed(users, messages):
+    os.makedirs("server", exist_ok=True)
+    with open("server/users.json", "w") as f:
+        json.dump({"users": [{"username": f"user{i}", "password": "pw"}
+                             for i in range(users)]}, f, indent=4)
+    history = make_messages(messages)
+    for index, message in enumerate(history):
+        message["seq"] = index + 1
+    with open("server/channels.json", "w") as f:
+        json.dump({"channels": {"General": {"host": "system", "participants": [], "messages": history,
+                                            "last_seq": messages}}}, f)
+
+
+def median_ms(fn, rounds):
+    times = []
+    for i in range(rounds):
+        t0 = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times) * 1000
+
+
+def append_one(store, i):
+    with store.lock:
+        channel = store.load()["channels"]["General"]
+        message = make_messages(1, start=10_000_000 + i)[0]
+        channel["last_seq"] += 1
+        message["seq"] = channel["last_seq"]
+        channel["messages"].append(message)
+    store.mark_dirty()
+    store.flush()
+
+
+def concurrent(repo, threads, per_thread):
+    errors = []
+
+    def worker(t):
+        try:
+            for i in range(per_thread):
+                assert repo.register(f"thread{t}-{i}", "pw")
+        except Exception as e:
+            errors.append(e)
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - t0
+    return threads * per_thread / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    seed(args.users, args.messages)
+    json_users = JsonUserRepository("server/users.json")
+    t0 = time.perf_counter()
+    sqlite = SqliteRepository("server/chat.db", legacy_channels_path="server/channels.json")
+    sqlite.import_users("server/users.json")
+    sqlite_store = ChannelStore(sqlite, flush_interval=3600, dirty_threshold=1 << 30)
+    sqlite_store.load() # Imports channels.json once
+    print(f"Import into SQLite: {time.perf_counter() - t0:.1f} s")
+    json_store = ChannelStore(JsonFileBackend("server/channels.json"), flush_interval=3600, dirty_threshold=1 << 30)
+    json_store.load()
+
+    rounds = args.rounds
+    print(f"{args.users} users, {args.messages} messages, median of {rounds}")
+    print(f"{'operation':<12} {'json ms':>10} {'sqlite ms':>10}")
+    for label, json_op, sqlite_op, n in (
+        ("register", lambda i: json_users.register(f"new{i}", "pw"),
+                     lambda i: sqlite.register(f"new{i}", "pw"), rounds),
+        ("credentials", lambda i: json_users.credentials(), lambda i: sqlite.credentials(), rounds),
+        ("append", lambda i: append_one(json_store, i),
+                   lambda i: append_one(sqlite_store, i), min(rounds, 5)),
+    ):
+        print(f"{label:<12} {median_ms(json_op, n):>10.2f} {median_ms(sqlite_op, n):>10.2f}")
+
+    rate, errors = concurrent(sqlite, args.threads, 200)
+    print(f"SQLite, {args.threads} threads registering users: {rate:.0f} writes/s, {len(errors)} error(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Bytes on the wire and encode/decode CPU: NDJSON ("json") vs binary ("bin1").
+
+For each common message the script reports the framed size and the time to
+encode it into a frame and to decode it back from a frame, per protocol.
+The bin1 numbers use the C msgpack package when installed, otherwise the
+pure-Python codec in common/codec.py (printed in the header).
+
+    python benchmarks/bench_wire.py --history 5000
+"""
+import argparse
+import sys
+import time
+
+from _harness import REPO_ROOT
+
+sys.path.insert(0, REPO_ROOT)
+from common import codec  # noqa: E402
+from common.protocol import WireDecoder, encode_message, PROTOCOL_JSON, PROTOCOL_BINARY  # noqa: E402
+
+
+def sample_messages(history, users):
+    message = {"username": "Nga", "message": "Hôm nay học mạng máy tính nhé", "timestamp": "2025-05-08T03:36:14.624234Z"}
+    return {
+        "save_message request": {"type": "channel", "action": "save_message", "channel_name": "MMT",
+                                 "message": message["message"], "username": "Nga"},
+        "save_message response": {"status": "success", "message": "Message saved successfully", "message_data": message},
+        f"sync_from_server ({history} msgs)": {"status": "success", "messages": [
+            {"username": f"user{i % 40}", "message": f"tin nhắn số {i} " + "lorem ipsum " * 3,
+             "timestamp": f"2025-05-08T03:{(i // 60) % 60:02d}:{i % 60:02d}.{i % 1000000:06d}Z"} for i in range(history)]},
+        f"get_user_status ({users} users)": {"status": "success",
+                                             "online": [f"user{i}" for i in range(0, users, 2)],
+                                             "offline": [f"user{i}" for i in range(1, users, 2)]},
+    }
+
+
+def timed(func, repeat):
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best
+
+
+def measure(obj, protocol):
+    frame = encode_message(obj, protocol)
+    probe = WireDecoder(protocol)
+    probe.feed(frame)
+    payload = probe.next_frame()
+    repeat = max(1, int(200000 / max(len(frame), 1)))
+    encode_s = timed(lambda: encode_message(obj, protocol), repeat)
+    decode_s = timed(lambda: WireDecoder(protocol).decode(payload), repeat)
+    return len(frame), encode_s, decode_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"bin1 codec: {'msgpack (C extension)' if codec.msgpack else 'pure Python fallback'}")
+    print(f"{'message':<32}{'proto':>6}{'bytes':>11}{'vs json':>9}{'encode us':>12}{'decode us':>12}")
+    for name, obj in sample_messages(args.history, args.users).items():
+        json_size = None
+        for protocol in (PROTOCOL_JSON, PROTOCOL_BINARY):
+            size, enc, dec = measure(obj, protocol)
+            json_size = json_size or size
+            print(f"{name:<32}{protocol:>6}{size:>11}{size / json_size:>8.0%}{enc * 1e6:>12.1f}{dec * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Server CPU per history byte of large catch-up syncs from the message log.
+
+A fresh server with CHAT_CHANNEL_STORAGE=log is seeded with one channel of H
+messages for every H in --sizes, and a participant fetches the whole history
+with sync_from_server (no cursor), --repeat times per path:
+
+* single  - one reply, messages decoded from the log at startup and encoded
+            with json.dumps per request (response cache off)
+* encode  - streamed history_chunk frames, each encoded with json.dumps
+            (CHAT_HISTORY_ZERO_COPY=0)
+* mapped  - streamed history_chunk frames joined from the stored records of the
+            mapped segment files, nothing decoded or encoded
+
+The client only splits frames and counts messages, so it does not hold the server
+back. Reported per path (median over the repeats): total ms, MB/s received,
+server CPU ms, and server CPU ns per byte sent.
+
+    python benchmarks/bench_zero_copy_history.py --sizes 100000,300000
+"""
+import argparse
+import shutil
+import statistics
+import tempfile
+import time
+
+from _harness import ServerProcess, channels_file, make_messages, send_request
+
+PATHS = {
+    "single": ({"CHAT_RESPONSE_CACHE_MAX_BYTES": "0"}, False),
+    "encode": ({"CHAT_HISTORY_ZERO_COPY": "0"}, True),
+    "mapped": ({"CHAT_HISTORY_ZERO_COPY": "1"}, True),
+}
+
+
+def receive(sock):
+    """Yields newline-delimited frames as bytes, reading 1 MB at a time."""
+    buffer = bytearray()
+    while True:
+        chunk = sock.recv(1 << 20)
+        if not chunk:
+            raise ConnectionError("Server closed the connection")
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            yield bytes(buffer[start:end + 1])
+            start = end + 1
+        del buffer[:start]
+
+
+def transfer(server, sock, frames, stream):
+    request = {"type": "channel", "action": "sync_from_server", "channel_name": "General", "username": "bench"}
+    if stream:
+        request["stream"] = True
+    cpu0 = server.cpu_seconds()
+    t0 = time.perf_counter()
+    received = size = 0
+    send_request(sock, request)
+    for frame in frames:
+        size += len(frame)
+        received += frame.count(b'"seq"')
+        if frame.startswith(b'{"status"'):
+            break
+    return time.perf_counter() - t0, server.cpu_seconds() - cpu0, size, received
+
+
+def run(size, path, repeat):
+    env, stream = PATHS[path]
+    env = dict(env, CHAT_CHANNEL_STORAGE="log")
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    files = {"server/channels.json": channels_file({"General": make_messages(size)})}
+    try:
+        with ServerProcess(workdir=workdir, env=env, files=files) as server:
+            sock = server.connect(timeout=300)
+            frames = receive(sock)
+            for request in (
+                {"type": "auth", "action": "register", "username": "bench", "password": "pw"},
+                {"type": "auth", "action": "login", "username": "bench", "password": "pw"},
+                {"type": "channel", "action": "join_channel", "channel_name": "General", "username": "bench"},
+            ):
+                send_request(sock, request)
+                next(frames)
+            time.sleep(1.5) # Let the write-behind store the join message, as in a settled channel
+            results = [transfer(server, sock, frames, stream) for _ in range(repeat)]
+            sock.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for *_, received in results:
+        assert received == size + 1, (path, received) # + the join message
+    total = statistics.median(r[0] for r in results)
+    cpu = statistics.median(r[1] for r in results)
+    return total, cpu, results[0][2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100000,300000")
+    parser.add_argument("--paths", default=",".join(PATHS))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'history':>8} {'path':>7} {'MB':>7} {'total ms':>9} {'MB/s':>7} {'cpu ms':>8} {'cpu ns/B':>9}")
+    for size in (int(n) for n in args.sizes.split(",")):
+        for path in args.paths.split(","):
+            total, cpu, nbytes = run(size, path, args.repeat)
+            print(f"{size:>8} {path:>7} {nbytes / 2 ** 20:>7.1f} {total * 1000:>9.1f} "
+                  f"{nbytes / 2 ** 20 / total:>7.1f} {cpu * 1000:>8.1f} {cpu * 1e9 / nbytes:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
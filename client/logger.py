@@ -1,56 +1,61 @@
+import atexit
 import os
-from datetime import datetime
-import traceback
+import sys
+# Imported before main.py sets up the path, so make common/ importable here too
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _REPO_ROOT not in sys.path:
+    sys.path.append(_REPO_ROOT)
+from common.log_writer import LogWriter, Logger, DEBUG, INFO, WARNING, ERROR
 
 # Đường dẫn file log
 LOG_DIR = "logs"
 LOG_FILE = os.path.join(LOG_DIR, "client.log")
 MAX_LOG_SIZE = 10 * 1024 * 1024  # 10 MB
+LOG_BACKUPS = 3 # client.log.1 ... client.log.3 are kept when the file is rotated
+# Level, format ("text" / "json") and sampling (see common/log_writer.py); the JSON
+# file LOG_CONFIG_FILE changes them while the client runs
+LOG_LEVEL = os.environ.get("CHAT_CLIENT_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("CHAT_CLIENT_LOG_FORMAT", "text")
+LOG_CONFIG_FILE = os.path.join(LOG_DIR, "client_log_config.json")
 
 # Đảm bảo thư mục logs tồn tại
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
+# Lines are written (and printed) in batches by a background thread
+# (common/log_writer.py), so logging never waits for the file or the console
+_writer = LogWriter(LOG_FILE, MAX_LOG_SIZE, LOG_BACKUPS, echo_tracebacks=True)
+atexit.register(_writer.close)
+# Records below LOG_LEVEL return before their "%s" arguments are formatted
+_logger = Logger(_writer, LOG_LEVEL, LOG_FORMAT, config_path=LOG_CONFIG_FILE)
+
 # Hàm ghi log thông tin
-def log_info(message):
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(f"[INFO] {datetime.now()} - {message}\n")
-    print(f"[INFO] {message}")
-    clear_logs()
+def log_info(message, *args, **fields):
+    if _logger.threshold <= INFO:
+        _logger.log(INFO, "INFO", message, args, False, fields)
 
 # Hàm ghi log lỗi
-def log_error(message, exc_info=False):
-    log_entry = f"[ERROR] {datetime.now()} - {message}\n"
-    if exc_info:
-        log_entry += traceback.format_exc() + "\n"
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(log_entry)
-    print(f"[ERROR] {message}")
-    if exc_info:
-        print(traceback.format_exc())
-    clear_logs()
+def log_error(message, *args, exc_info=False, **fields):
+    _logger.log(ERROR, "ERROR", message, args, exc_info, fields)
 
 # Hàm ghi log cảnh báo
-def log_warning(message):
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(f"[WARNING] {datetime.now()} - {message}\n")
-    print(f"[WARNING] {message}")
-    clear_logs()
-
-# Hàm ghi log debug (tùy chọn bật/tắt)
-def log_debug(message):
-    # print(f"[DEBUG] {datetime.now()} - {message}")
-    pass
-    # with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-    #     log_file.write(f"[DEBUG] {datetime.now()} - {message}\n")
-    # clear_logs()
-
-# Hàm xóa log khi vượt quá giới hạn
-def clear_logs():
-    try:
-        if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > MAX_LOG_SIZE:
-            with open(LOG_FILE, "w", encoding="utf-8") as log_file:
-                log_file.write(f"[INFO] {datetime.now()} - Log cleared due to size limit\n")
-            print("[INFO] Log file cleared due to size limit")
-    except Exception as e:
-        print(f"[ERROR] Failed to check/clear log file: {e}")
+def log_warning(message, *args, **fields):
+    if _logger.threshold <= WARNING:
+        _logger.log(WARNING, "WARNING", message, args, False, fields)
+
+# Hàm ghi log debug (bật bằng CHAT_CLIENT_LOG_LEVEL=DEBUG hoặc LOG_CONFIG_FILE)
+def log_debug(message, *args, **fields):
+    if _logger.threshold <= DEBUG:
+        _logger.log(DEBUG, "DEBUG", message, args, False, fields)
+
+def log_enabled(level=DEBUG):
+    """True if records of level are written. Guard arguments that are costly to compute."""
+    return _logger.threshold <= level
+
+def configure_logging(level=None, log_format=None, sample=None):
+    """Changes the log level, format or sampling without a restart."""
+    _logger.configure(level, log_format, sample)
+
+def flush_logs(timeout=5.0):
+    """Waits until everything logged so far is written."""
+    return _writer.flush(timeout)
@@ -1,16 +1,52 @@
 import socket
-import json
 import datetime
 import os
-import select
+import sys
 import threading
-import time # Needed for robust receive
+import time
+import weakref
+import itertools
+import collections
+import contextlib
+import concurrent.futures
 from logger import log_info, log_error, log_debug, log_warning
 from peer import start_livestream, connect_to_peer, receive_stream
-
-# Global variable for local message cache
-local_channels = {} # Format: { "channel_name": {"messages": [...]}, ... }
-LOCAL_CACHE_FILE = "client/client_cache.json" # Optional: for persistence
+# Make the shared protocol package (common/) importable when run as a script
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _REPO_ROOT not in sys.path:
+    sys.path.append(_REPO_ROOT)
+from common.framing import FrameTooLarge
+from common.protocol import WireDecoder, encode_message, PROTOCOL_JSON, PROTOCOL_BINARY
+from offline_cache import OfflineJournal
+
+# Local message cache: messages that could not be sent yet (offline_cache.py).
+# The old JSON cache is imported once when the journal is created.
+LOCAL_CACHE_FILE = "client/client_cache.journal"
+LEGACY_CACHE_FILE = "client/client_cache.json"
+LOCAL_SYNC_BATCH = 500 # Cached messages per sync_to_server request
+# CHAT_CLIENT_CACHE_FSYNC=0 skips the fsync after each cached message (faster, not crash-safe)
+local_cache = OfflineJournal(LOCAL_CACHE_FILE, LEGACY_CACHE_FILE,
+                             fsync=os.environ.get("CHAT_CLIENT_CACHE_FSYNC", "1") != "0")
+
+# Wire protocols offered to the server at login, in preference order.
+# Set CHAT_CLIENT_PROTOCOL=json to stay on newline-delimited JSON.
+OFFERED_PROTOCOLS = [PROTOCOL_JSON] if os.environ.get("CHAT_CLIENT_PROTOCOL") == "json" else [PROTOCOL_BINARY, PROTOCOL_JSON]
+
+# Largest number of requests one connection has in flight once the server echoes
+# request ids (see Connection)
+MAX_IN_FLIGHT = 32
+
+# Longest wait for one reply, in seconds, however long data keeps arriving (e.g.
+# pushes while the reply itself was lost)
+MAX_REPLY_WAIT = 60.0
+
+# Every socket returned by connect_to_server is driven by one Connection: a single
+# reader thread decodes everything the server sends, completes the request each
+# reply belongs to and hands pushes (new messages, presence, history chunks, ...)
+# to the registered handlers. Any thread may send requests at any time.
+_connections = weakref.WeakKeyDictionary() # { client_socket: Connection }
+_connections_lock = threading.Lock()
+_push_handlers = [] # callables taking one push message dict
 
 # --- Connection ---
 def connect_to_server(host="127.0.0.1", port=5000):
@@ -30,190 +66,248 @@ def connect_to_server(host="127.0.0.1", port=5000):
 
 # --- Local Cache ---
 def load_local_cache():
-    """Loads local message cache from a file."""
-    global local_channels
+    """Opens the local message cache (the journal is only scanned, messages stay on disk)."""
     try:
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(LOCAL_CACHE_FILE), exist_ok=True)
-        with open(LOCAL_CACHE_FILE, "r") as f:
-            local_channels = json.load(f)
-            log_info("Local message cache loaded.")
-    except FileNotFoundError:
-        local_channels = {}
-        log_info("No local cache file found. Starting empty.")
-    except json.JSONDecodeError:
-        local_channels = {}
-        log_error("Error decoding local cache file. Starting with empty cache.")
+        local_cache.open()
+        log_info(f"Local message cache loaded: {local_cache.stats()}")
     except Exception as e:
         log_error(f"Unexpected error loading local cache: {e}")
-        local_channels = {}
 
 def save_local_cache():
-    """Saves local message cache to a file."""
+    """Every cached message is already on disk; this only compacts the journal if worthwhile."""
     try:
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(LOCAL_CACHE_FILE), exist_ok=True)
-        with open(LOCAL_CACHE_FILE, "w", encoding='utf-8') as f:
-            json.dump(local_channels, f, ensure_ascii=False, indent=4)
-            # log_info("Local message cache saved.") # Can be noisy
+        local_cache.maybe_compact()
     except Exception as e:
-        log_error(f"Error saving local cache: {e}")
+        log_error(f"Error compacting local cache: {e}")
 
-# --- Robust Receive Helper ---
-# ... (other functions like connect_to_server, login, etc.) ...
+# --- Requests and Replies ---
+class _Pending:
+    __slots__ = ("future", "request_type", "holds_slot")
 
-def receive_json_response(client_socket, timeout=10.0):
-    buffer = b""
-    json_data = None
-    start_time = time.time()
-    
-    # Store original blocking state and set to non-blocking for select
-    original_blocking_state = client_socket.getblocking()
-    client_socket.setblocking(False)
+    def __init__(self, future, request_type):
+        self.future = future
+        self.request_type = request_type
+        self.holds_slot = True
 
-    try:
-        while True:
-            # Check for overall timeout
-            elapsed_time = time.time() - start_time
-            if elapsed_time >= timeout:
-                # print(f"[ERROR] Overall timeout ({timeout}s) receiving JSON response. Buffer: {buffer[:200]}")
-                return {"status": "error", "message": "Overall timeout receiving JSON response: Timeout waiting for complete JSON response"}
-
-            # Calculate remaining time for select
-            remaining_timeout = timeout - elapsed_time
-            if remaining_timeout <= 0: # Should be caught by above, but as a safeguard
-                return {"status": "error", "message": "Timeout before select call"}
-
-            # Wait for the socket to be readable
-            ready_to_read, _, exceptional_sockets = select.select([client_socket], [], [client_socket], remaining_timeout)
-
-            if exceptional_sockets:
-                # print("[ERROR] Socket exception during select.")
-                return {"status": "error", "message": "Socket exception"}
-
-            if ready_to_read:
-                for sock in ready_to_read:
-                    try:
-                        chunk = sock.recv(4096) # This was line 80
-                        if not chunk:
-                            # print("[ERROR] Connection closed by server while receiving JSON.")
-                            return {"status": "error", "message": "Connection closed by server"}
-                        buffer += chunk
-                        # print(f"[DEBUG] Received chunk, buffer size: {len(buffer)}")
-                    except BlockingIOError:
-                        # This shouldn't happen if select.select indicated readability,
-                        # but handle defensively. More likely, no data was ready yet if select timed out.
-                        pass # Continue to the next iteration to check timeout or select again
-                    except ConnectionResetError:
-                        # print("[ERROR] ConnectionResetError while receiving JSON.")
-                        return {"status": "error", "message": "Connection reset by server"}
-                    except Exception as e:
-                        # print(f"[ERROR] Unexpected error receiving chunk: {e}")
-                        return {"status": "error", "message": f"Unexpected error receiving response: {e}"}
-            # If select timed out (ready_to_read is empty) and we haven't hit overall timeout,
-            # the outer loop will continue and check overall_timeout or call select again.
-
-            # Attempt to parse JSON from the buffer
-            # This brace-counting logic is fragile.
-            # A more robust method is for the server to send the message length first.
-            try:
-                decoded_buffer = buffer.decode('utf-8', errors='replace') # Use replace for safety
-                
-                json_start_index = -1
-                # Find the first opening brace that is not part of an already processed object
-                # This logic assumes we are looking for the *next* JSON object if buffer contains multiple.
-                # For simplicity, let's assume we are looking for the first complete JSON.
-                
-                # Try to find the start of a JSON object
-                current_scan_start = 0
-                while current_scan_start < len(buffer):
-                    try:
-                        first_brace = buffer.find(b'{', current_scan_start)
-                        if first_brace == -1: # No more opening braces
-                            break 
-
-                        brace_count = 0
-                        in_string = False
-                        json_end_index = -1
-
-                        for i in range(first_brace, len(buffer)):
-                            char_byte = buffer[i:i+1]
-                            char = char_byte.decode('utf-8', errors='ignore') # Process one byte at a time
-
-                            if char == '"':
-                                # Basic handling for strings, not perfect for escaped quotes within JSON strings
-                                if i > first_brace and buffer[i-1:i] != b'\\':
-                                    in_string = not in_string
-                                elif i == first_brace: # Quote at the very start of scan (unlikely for valid JSON start)
-                                    in_string = not in_string
-                            elif not in_string:
-                                if char == '{':
-                                    brace_count += 1
-                                elif char == '}':
-                                    brace_count -= 1
-                                    if brace_count == 0: # Potential end of a JSON object
-                                        json_end_index = i
-                                        break
-                        
-                        if json_end_index != -1 and brace_count == 0:
-                            json_str_bytes = buffer[first_brace : json_end_index + 1]
-                            try:
-                                json_data = json.loads(json_str_bytes.decode('utf-8'))
-                                # print(f"[DEBUG] Successfully parsed JSON: {json_data}")
-                                buffer = buffer[json_end_index + 1:] # Remove parsed data
-                                return json_data
-                            except json.JSONDecodeError:
-                                # Found matching braces, but not valid JSON.
-                                # This could mean it's part of a larger structure or malformed.
-                                # If it's malformed and we assume one JSON per call, this is an error.
-                                # For now, we'll assume it might be incomplete and continue accumulating
-                                # if more data comes. If it's the only object, this will eventually timeout.
-                                # print(f"[DEBUG] JSONDecodeError, buffer might be incomplete or malformed. Trying to accumulate more. Slice: {json_str_bytes[:100]}")
-                                current_scan_start = json_end_index + 1 # Try to find next JSON
-                                continue # Continue scanning the rest of the buffer
-                            except UnicodeDecodeError as ue:
-                                # print(f"[ERROR] UnicodeDecodeError during JSON parsing: {ue}")
-                                return {"status": "error", "message": f"Unicode decode error during JSON parsing: {ue}"}
-                        elif brace_count > 0 : # Incomplete JSON object, need more data
-                            break # Break from inner scanning loop, wait for more data from socket
-                        else: # No valid JSON found starting at first_brace
-                            current_scan_start = first_brace + 1
-
-
-                    except UnicodeDecodeError:
-                        # This can happen if a multi-byte char is split. Wait for more data.
-                        break # Break from inner scanning loop, wait for more data
-
-                # If we've scanned the whole buffer and found no complete JSON, wait for more data
-                if json_data: # Should have been returned
+
+class Connection:
+    """A server connection with one reader thread and a future per request in flight.
+
+    Requests are tagged with a "request_id". Replies that echo it complete that
+    request, so up to MAX_IN_FLIGHT requests can wait at once. A server that does
+    not echo ids replies in request order, except that some replies are sent late
+    (e.g. after a group commit); until an echoed id is seen, only one request is
+    in flight, so a reply can never be handed to the wrong request.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = WireDecoder()
+        self.closed = threading.Event()
+        self.close_reason = None
+        self.ids_echoed = False
+        self.last_received = time.monotonic()
+        self._ids = itertools.count(1)
+        self._pending = collections.OrderedDict() # request_id -> _Pending, oldest first
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._slot_free = threading.Condition(self._lock)
+        self._send_lock = threading.RLock() # One frame written at a time; held through a protocol switch
+        self._reader = threading.Thread(target=self._read_loop, name="ServerReader", daemon=True)
+        self._reader.start()
+
+    # --- Sending ---
+    def send(self, request):
+        """Sends a request without waiting for (or expecting) a reply."""
+        with self._send_lock:
+            self.sock.sendall(encode_message(request, self.decoder.protocol))
+
+    def request_async(self, request, timeout=None):
+        """Sends request and returns a concurrent.futures.Future of its reply (a dict).
+
+        Waits up to timeout for a free in-flight slot (TimeoutError otherwise).
+        """
+        with self._lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._in_flight >= (MAX_IN_FLIGHT if self.ids_echoed else 1) and not self.closed.is_set():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No free request slot")
+                self._slot_free.wait(remaining)
+            future = concurrent.futures.Future()
+            if self.closed.is_set():
+                future.set_result({"status": "error", "message": self.close_reason})
+                return future
+            request_id = next(self._ids)
+            self._pending[request_id] = _Pending(future, request.get("type"))
+            self._in_flight += 1
+        future.request_id = request_id
+        try:
+            self.send(dict(request, request_id=request_id))
+        except Exception:
+            with self._lock:
+                self._pending.pop(request_id, None)
+                self._in_flight -= 1
+                self._slot_free.notify()
+            raise
+        return future
+
+    def request(self, request, timeout=10.0, exclusive=False, max_wait=MAX_REPLY_WAIT):
+        """Sends request and returns its reply, or an error dict if none arrives.
+
+        timeout counts from the last data received, so a long streamed reply does not
+        time out while it keeps arriving; max_wait bounds the whole wait all the same.
+        exclusive holds back every other send until the reply is in (for requests that
+        switch the wire protocol).
+        """
+        if threading.current_thread() is self._reader:
+            raise RuntimeError("Requests cannot wait for a reply on the reader thread (e.g. from a push handler)")
+        with (self._send_lock if exclusive else contextlib.nullcontext()):
+            give_up = time.monotonic() + max(timeout, max_wait)
+            future = self.request_async(request, timeout)
+            remaining = timeout
+            while True:
+                try:
+                    return future.result(remaining)
+                except concurrent.futures.TimeoutError:
+                    now = time.monotonic()
+                    idle = now - self.last_received
+                    if idle < timeout and now < give_up:
+                        remaining = min(timeout - idle, give_up - now)
+                        continue
+                    # The entry stays pending so that a late reply is still matched to it
+                    self._release_slot(future.request_id)
+                    return {"status": "error", "message": "Timeout waiting for the server's response"}
+
+    def _release_slot(self, request_id):
+        with self._lock:
+            pending = self._pending.get(request_id)
+            if pending is not None and pending.holds_slot:
+                pending.holds_slot = False
+                self._in_flight -= 1
+                self._slot_free.notify()
+
+    # --- Receiving ---
+    def _read_loop(self):
+        reason = "Connection closed by server"
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
                     break
+                self.last_received = time.monotonic()
+                self.decoder.feed(data)
+                while True:
+                    message = _next_message(self.decoder)
+                    if message is None:
+                        break
+                    if _is_push(message):
+                        _dispatch_push(message)
+                    else:
+                        self._complete(message)
+        except OSError as e:
+            reason = f"Connection error: {e}"
+        finally:
+            self._close(reason)
+
+    def _complete(self, reply):
+        request_id = reply.pop("request_id", None)
+        with self._lock:
+            if request_id is not None:
+                pending = self._pending.pop(request_id, None)
+                if not self.ids_echoed:
+                    self.ids_echoed = True
+                    self._slot_free.notify_all()
+            elif not self.ids_echoed and self._pending:
+                _, pending = self._pending.popitem(last=False)
+            else:
+                pending = None
+            if pending is not None and pending.holds_slot:
+                self._in_flight -= 1
+                self._slot_free.notify()
+        if pending is None:
+            log_warning("Discarding unexpected reply with no pending request: %s", reply)
+            return
+        if pending.request_type == "auth" and reply.get("protocol"):
+            # Switch framing before the next frame is decoded
+            self.decoder.set_protocol(reply["protocol"])
+        if not pending.future.done():
+            pending.future.set_result(reply)
+
+    def _close(self, reason):
+        with self._lock:
+            self.close_reason = reason
+            self.closed.set()
+            pending, self._pending = list(self._pending.values()), collections.OrderedDict()
+            self._in_flight = 0
+            self._slot_free.notify_all()
+        for entry in pending:
+            if not entry.future.done():
+                entry.future.set_result({"status": "error", "message": reason})
+
+
+def connection_for(client_socket):
+    """The Connection driving client_socket (created, with its reader thread, on first use)."""
+    connection = _connections.get(client_socket)
+    if connection is None:
+        with _connections_lock:
+            connection = _connections.get(client_socket)
+            if connection is None:
+                connection = _connections[client_socket] = Connection(client_socket)
+    return connection
+
+def send_request(client_socket, request):
+    """Sends one request framed in the protocol negotiated for client_socket, without waiting for a reply."""
+    connection_for(client_socket).send(request)
+
+def request_response(client_socket, request, timeout=10.0):
+    """Sends request and returns its reply; pushes received meanwhile go to the push handlers."""
+    return connection_for(client_socket).request(request, timeout)
+
+# --- Server Push ---
+def register_push_handler(callback):
+    """callback(message) is called for every push, on the connection's reader thread.
+
+    It must not block, nor wait for replies (use root.after or another thread).
+    """
+    if callback not in _push_handlers:
+        _push_handlers.append(callback)
 
-            except UnicodeDecodeError:
-                # Error decoding the whole buffer, might be incomplete.
-                pass # Continue accumulating
+def unregister_push_handler(callback):
+    if callback in _push_handlers:
+        _push_handlers.remove(callback)
 
-            # If not parsed and not timed out, the loop continues.
-            # No explicit sleep here as select() handles the waiting.
+def _is_push(message):
+    # Replies always carry "status"; pushes are typed notifications without one
+    return isinstance(message, dict) and "type" in message and "status" not in message
 
-    except socket.error as e: # Catch other socket errors
-        # print(f"[ERROR] Socket error in receive_json_response: {e}")
-        return {"status": "error", "message": f"Socket error: {e}"}
-    except Exception as e:
-        # print(f"[ERROR] General exception in receive_json_response: {e}")
-        # import traceback
-        # print(traceback.format_exc())
-        return {"status": "error", "message": f"General error receiving JSON: {e}"}
-    finally:
-        client_socket.setblocking(original_blocking_state) # Restore original blocking state
+def _dispatch_push(message):
+    for callback in list(_push_handlers):
+        try:
+            callback(message)
+        except Exception as e:
+            log_error(f"Push handler failed for {message.get('action')}: {e}", exc_info=True)
 
-    # This part is reached if the loop exits due to timeout without parsing successfully
-    if not json_data:
-        # print(f"[ERROR] Failed to parse complete JSON within timeout. Final Buffer: {buffer[:200]}")
-        return {"status": "error", "message": "Timeout waiting for complete JSON response (final check)"}
-    
-    # This line should ideally not be reached if logic is correct, as json_data is returned inside the loop.
-    return json_data
+def poll_push_messages(client_socket, timeout=1.0):
+    """Waits up to timeout while pushes are dispatched by the reader thread.
 
+    Returns False once the connection is gone so callers can fall back to polling.
+    """
+    return not connection_for(client_socket).closed.wait(timeout)
+
+def _next_message(decoder):
+    """Returns the next decodable message already buffered in decoder, or None."""
+    while True:
+        try:
+            frame = decoder.next_frame()
+        except FrameTooLarge as e:
+            return {"status": "error", "message": f"Response too large: {e}"}
+        if frame is None:
+            return None
+        try:
+            return decoder.decode(frame)
+        except ValueError as e:
+            log_error(f"Discarding invalid frame from server: {e}")
 
 
 # --- Authentication and Status ---
@@ -227,9 +321,11 @@ def login(client_socket, username=None, password=None, visitor_name=None, regist
             request = {"type": "auth", "action": "login", "username": username, "password": password}
         else:
             return {"status": "error", "message": "Invalid login parameters"}
+        request["protocols"] = OFFERED_PROTOCOLS # Negotiate the wire protocol
 
-        client_socket.sendall((json.dumps(request) + "\n").encode('utf-8')) # Use sendall + newline
-        response = receive_json_response(client_socket) # Use robust receiver
+        # The reader switches framing on the reply (if the server agreed to a protocol);
+        # other requests wait so they are not encoded in the old one
+        response = connection_for(client_socket).request(request, exclusive=True)
         log_info(f"Login/Register response: {response}")
         return response
     except (ConnectionError, BrokenPipeError, socket.error) as e:
@@ -247,8 +343,7 @@ def change_status(client_socket, username, status):
             "username": username,
             "status": status
         }
-        client_socket.sendall((json.dumps(request) + "\n").encode('utf-8')) # Use sendall + newline
-        response_data = receive_json_response(client_socket) # Use robust receiver
+        response_data = request_response(client_socket, request) # Use robust receiver
 
         if response_data.get("status") == "success":
             log_info(f"Status change to {status} for {username} confirmed by server.")
@@ -270,11 +365,10 @@ def list_online_users(client_socket, channel_name):
             "channel": channel_name
         }
         # log_debug(f"Sending get_user_status request for channel '{channel_name}': {request}") # Bỏ comment nếu logger của bạn hỗ trợ log_debug và bạn muốn xem request
-        client_socket.sendall((json.dumps(request) + "\n").encode("utf-8"))
-        response = receive_json_response(client_socket) # Sử dụng hàm nhận đã được cải thiện
+        response = request_response(client_socket, request) # Sử dụng hàm nhận đã được cải thiện
 
         # Ghi log toàn bộ phản hồi nhận được để gỡ lỗi (nếu log_debug được cấu hình)
-        log_debug(f"Full response for get_user_status on '{channel_name}': {response}")
+        log_debug("Full response for get_user_status on '%s': %s", channel_name, response, event="get_user_status")
 
         if response and response.get("status") == "success":
             online_list = response.get('online', [])
@@ -283,7 +377,7 @@ def list_online_users(client_socket, channel_name):
         elif response: # Nhận được phản hồi, nhưng status không phải là "success"
             error_msg = response.get('message', 'No message provided')
             log_error(f"Failed to get user status for '{channel_name}'. Server message: '{error_msg}'. Full response: {response}")
-        else: # Không nhận được phản hồi hoặc phản hồi không hợp lệ từ receive_json_response
+        else: # Không nhận được phản hồi hợp lệ từ server
             log_error(f"Failed to get user status for '{channel_name}': No valid response received from server.")
             # Trả về một dictionary lỗi chuẩn nếu response không hợp lệ
             return {"status": "error", "message": "No valid response received from server."}
@@ -308,8 +402,7 @@ def send_create_channel_request(client_socket, channel_name, username):
             "channel_name": channel_name,
             "username": username
         }
-        client_socket.sendall((json.dumps(request) + "\n").encode('utf-8')) # Use sendall + newline
-        response_data = receive_json_response(client_socket) # Use robust receiver
+        response_data = request_response(client_socket, request) # Use robust receiver
         return response_data
     except (ConnectionError, BrokenPipeError, socket.error) as e:
         log_error(f"Connection failed creating channel: {e}")
@@ -324,8 +417,7 @@ def list_channels(client_socket):
             "type": "channel",
             "action": "list_channels"
         }
-        client_socket.sendall((json.dumps(request) + "\n").encode('utf-8')) # Use sendall + newline
-        response_data = receive_json_response(client_socket) # Use robust receiver
+        response_data = request_response(client_socket, request) # Use robust receiver
 
         if response_data.get("status") == "success":
             channels = response_data.get("channels", [])
@@ -347,8 +439,7 @@ def send_join_channel_request(client_socket, username, channel_name):
             "username": username,
             "channel_name": channel_name
         }
-        client_socket.sendall((json.dumps(join_request) + "\n").encode('utf-8')) # Use sendall + newline
-        response_data = receive_json_response(client_socket) # Use robust receiver
+        response_data = request_response(client_socket, join_request) # Use robust receiver
 
         if response_data.get("status") == "success":
             log_info(f"Successfully joined channel '{channel_name}'. Server response: {response_data}")
@@ -371,8 +462,7 @@ def send_delete_channel_request(client_socket, channel_name, username):
             "channel_name": channel_name,
             "username": username
         }
-        client_socket.sendall((json.dumps(request) + "\n").encode('utf-8')) # Use sendall + newline
-        response_data = receive_json_response(client_socket) # Use robust receiver
+        response_data = request_response(client_socket, request) # Use robust receiver
         return response_data
     except (ConnectionError, BrokenPipeError, socket.error) as e:
         log_error(f"Connection failed deleting channel: {e}")
@@ -383,8 +473,14 @@ def send_delete_channel_request(client_socket, channel_name, username):
 
 # --- Sync Functions ---
 
-def request_sync_from_server(client_socket, channel_name, username): # Added username for server check
-    """Requests all messages for a channel from the server."""
+def request_sync_from_server(client_socket, channel_name, username, since=None, on_messages=None): # Added username for server check
+    """Requests the messages of a channel from the server.
+
+    With since (the "cursor" of a previous reply) only messages stored after it are
+    returned; the reply carries the new "cursor". Without it the whole history is sent.
+    With on_messages the server streams them instead: on_messages(list) is called for
+    every chunk as it arrives, and the reply itself carries no messages.
+    """
     if not client_socket or client_socket.fileno() == -1:
          log_error("Error: Invalid socket for sync from server.")
          return {"status": "error", "message": "Invalid client socket"}
@@ -395,15 +491,22 @@ def request_sync_from_server(client_socket, channel_name, username): # Added use
             "channel_name": channel_name,
             "username": username # Send username so server can verify participation
         }
-        client_socket.sendall((json.dumps(request) + "\n").encode('utf-8'))
-        response = receive_json_response(client_socket, timeout=15.0) # Longer timeout for potentially large sync
-
-        # Check if the response is a PUSH notification FIRST
-        if response and response.get("type") == "channel" and response.get("action") == "new_message":
-            log_debug(f"request_sync_from_server received a PUSH message: {response}")
-            return response # Return PUSH message for UI to handle without logging error here
+        if since is not None:
+            request["since"] = since
+        if on_messages is None:
+            response = request_response(client_socket, request, timeout=15.0) # Longer timeout for potentially large sync
+        else:
+            request["stream"] = True
+            def on_chunk(push): # Chunks are pushes, handed over by the reader thread
+                if push.get("action") == "history_chunk" and push.get("channel_name") == channel_name:
+                    on_messages(push.get("messages", []))
+            register_push_handler(on_chunk)
+            try:
+                response = request_response(client_socket, request, timeout=15.0)
+            finally:
+                unregister_push_handler(on_chunk)
 
-        # If not a PUSH, then it's a response to our sync request. Check its status.
+        # Pushes received meanwhile went to the push handlers; this is the sync reply
         if response and response.get("status") != "success":
              log_error(f"Server error during sync from server for '{channel_name}': {response.get('message')}")
         # else:
@@ -417,6 +520,37 @@ def request_sync_from_server(client_socket, channel_name, username): # Added use
         log_error(f"Error syncing from server for {channel_name}: {e}", exc_info=True) # Added exc_info for better debugging
         return {"status": "error", "message": str(e)}
 
+def request_history(client_socket, channel_name, username, before=None, after=None, limit=None):
+    """Requests one page of a channel's messages (get_history).
+
+    Without before/after the newest page is returned; before (a seq or timestamp)
+    pages backward, after pages forward. The reply carries "has_more" and, for the
+    newest page, the "cursor" to continue with request_sync_from_server.
+    """
+    if not client_socket or client_socket.fileno() == -1:
+         log_error("Error: Invalid socket for history request.")
+         return {"status": "error", "message": "Invalid client socket"}
+    try:
+        request = {
+            "type": "channel",
+            "action": "get_history",
+            "channel_name": channel_name,
+            "username": username
+        }
+        for key, value in (("before", before), ("after", after), ("limit", limit)):
+            if value is not None:
+                request[key] = value
+        response = request_response(client_socket, request)
+        if response and response.get("status") != "success":
+             log_error(f"Server error reading history of '{channel_name}': {response.get('message')}")
+        return response
+    except (ConnectionError, BrokenPipeError, socket.error) as e:
+        log_error(f"Connection error reading history of {channel_name}: {e}")
+        return {"status": "error", "message": f"Connection error: {e}"}
+    except Exception as e:
+        log_error(f"Error reading history of {channel_name}: {e}", exc_info=True)
+        return {"status": "error", "message": str(e)}
+
 def request_sync_to_server(client_socket, channel_name, messages, username): # Added username for server check
     """Sends locally cached messages to the server for merging."""
     if not client_socket or client_socket.fileno() == -1:
@@ -432,8 +566,7 @@ def request_sync_to_server(client_socket, channel_name, messages, username): # A
             "messages": messages,
             "username": username # Send username so server can verify participation and message ownership
         }
-        client_socket.sendall((json.dumps(request) + "\n").encode('utf-8')) # Use sendall + newline
-        response = receive_json_response(client_socket) # Use robust receiver
+        response = request_response(client_socket, request) # Use robust receiver
         if response.get("status") != "success":
              log_error(f"Server error during sync to server for '{channel_name}': {response.get('message')}")
         # else: log_info(f"Sync to server for '{channel_name}' confirmed by server.")
@@ -448,69 +581,55 @@ def request_sync_to_server(client_socket, channel_name, messages, username): # A
 # --- Local Saving ---
 def save_local_message(channel_name, username, message):
     """Lưu tin nhắn cục bộ khi server không khả dụng hoặc gửi thất bại."""
-    global local_channels
     timestamp = datetime.datetime.utcnow().isoformat() + "Z"
-    if channel_name not in local_channels:
-        local_channels[channel_name] = {"messages": []}
-    elif not isinstance(local_channels[channel_name].get("messages"), list):
-         log_warning(f"Correcting invalid local message list for channel '{channel_name}'.")
-         local_channels[channel_name]["messages"] = []
-
-
-    # Check for duplicates before adding
-    is_duplicate = any(
-        m.get('timestamp') == timestamp and m.get('username') == username and m.get('message') == message
-        for m in local_channels[channel_name].get("messages", [])
-        if isinstance(m, dict) # Ensure message format is correct before checking
-    )
-
-    if not is_duplicate:
-         new_message = {
-            "username": username,
-            "message": message,
-            "timestamp": timestamp
-         }
-         local_channels[channel_name]["messages"].append(new_message)
-         log_info(f"Message saved locally for channel '{channel_name}': {new_message}")
-         save_local_cache() # Save cache immediately after adding a message
-    else:
-        log_info(f"Attempted to save duplicate local message for channel '{channel_name}'.")
+    new_message = {
+        "username": username,
+        "message": message,
+        "timestamp": timestamp
+    }
+    try:
+        # One record appended (and fsync'd) to the journal; a repeat of the newest message is dropped
+        if local_cache.append(channel_name, new_message):
+            log_info("Message saved locally for channel '%s': %s", channel_name, new_message)
+        else:
+            log_info(f"Attempted to save duplicate local message for channel '{channel_name}'.")
+    except Exception as e:
+        log_error(f"Failed to save message locally for channel '{channel_name}': {e}")
 
 
 # --- Online/Offline Handling ---
-def handle_client_online(client_socket, username, current_channel):
+def handle_client_online(client_socket, username, current_channel, since=None, on_messages=None):
     """
     Synchronizes local cache TO server, then fetches updates FROM server
     for the current channel when client comes online.
+    since and on_messages are passed to request_sync_from_server: only messages
+    after the cursor, streamed to on_messages in chunks instead of being returned.
     """
-    global local_channels
     log_info(f"Client '{username}' is online. Starting synchronization for channel '{current_channel}'...")
 
     # --- Phase 1: Sync TO Server (Local Cache -> Server) ---
     log_info("Phase 1: Syncing local messages TO server...")
     synced_successfully = False
     try:
-        if current_channel in local_channels:
-            messages_to_sync = local_channels[current_channel].get("messages", [])
-            if messages_to_sync:
-                log_info(f"Attempting to sync {len(messages_to_sync)} local messages for '{current_channel}' to server...")
+        pending = local_cache.pending_count(current_channel)
+        if pending:
+            log_info(f"Attempting to sync {pending} local messages for '{current_channel}' to server...")
+            # Read back from the journal in batches, one sync_to_server request each
+            for messages_to_sync, sent_marker in local_cache.pending(current_channel, LOCAL_SYNC_BATCH):
                 # Pass username for server-side validation
                 sync_response = request_sync_to_server(client_socket, current_channel, messages_to_sync, username)
-
-                if sync_response and sync_response.get("status") == "success":
-                    log_info(f"Successfully synced local messages for '{current_channel}' to server.")
-                    # Clear local cache for this channel ONLY IF sync was successful
-                    local_channels[current_channel]["messages"] = []
-                    save_local_cache() # Save the cleared cache
-                    synced_successfully = True
-                else:
+                if not (sync_response and sync_response.get("status") == "success"):
                     error_msg = sync_response.get('message', 'Unknown error') if sync_response else 'No response'
                     log_error(f"Failed to sync local messages for '{current_channel}' to server: {error_msg}. Messages kept locally.")
+                    break
+                # Forget a batch ONLY once the server has it (it skips messages it already stored)
+                local_cache.mark_sent(current_channel, sent_marker)
             else:
-                log_info(f"No local messages to sync for channel '{current_channel}'.")
-                synced_successfully = True # No sync needed is also a success for this phase
+                log_info(f"Successfully synced local messages for '{current_channel}' to server.")
+                synced_successfully = True
         else:
-            synced_successfully = True # No sync needed
+            log_info(f"No local messages to sync for channel '{current_channel}'.")
+            synced_successfully = True # No sync needed is also a success for this phase
 
         log_info("Phase 1 (Sync TO Server) finished.")
 
@@ -524,7 +643,7 @@ def handle_client_online(client_socket, username, current_channel):
     server_messages = []
     try:
         # Pass username for server-side validation
-        sync_response = request_sync_from_server(client_socket, current_channel, username)
+        sync_response = request_sync_from_server(client_socket, current_channel, username, since=since, on_messages=on_messages)
         if sync_response and sync_response.get("status") == "success":
             server_messages = sync_response.get("messages", [])
             # The UI layer will be responsible for merging/displaying these messages
@@ -561,10 +680,8 @@ def send_message(client_socket, channel_name, message, username):
             "message": message,
             "username": username # Server uses this to verify sender and store
         }
-        client_socket.sendall((json.dumps(request) + "\n").encode('utf-8')) # Use sendall + newline
-
-        # Wait for server confirmation using the robust receiver
-        response = receive_json_response(client_socket, timeout=5.0) # 5 second timeout for send confirmation
+        # Wait for server confirmation (5 second timeout); pushes in between go to the push handlers
+        response = request_response(client_socket, request, timeout=5.0)
 
         # Log success/error based on server response status
         # if response.get("status") == "success":
@@ -590,9 +707,3 @@ def send_message(client_socket, channel_name, message, username):
         log_error(f"Unexpected error in send_message: {e}. Saving locally.")
         save_local_message(channel_name, username, message)
         return {"status": "error", "message": f"Unexpected error: {e}. Message saved locally."}
-
-# --- Utility/Debugging ---
-def log_debug(message):
-     # Simple print for debug, or integrate with logger if needed
-     # print(f"[DEBUG] {message}")
-     pass # Keep debug logs off by default
\ No newline at end of file
@@ -0,0 +1,65 @@
+import socket
+import threading
+import unittest
+
+import logger  # noqa: F401 (puts the repository root on sys.path, for common/)
+from common.protocol import WireDecoder, encode_message
+
+try:
+    import main
+except ImportError: # peer.py needs opencv-python and Pillow (requirements.txt)
+    main = None
+
+
+class FakeServer:
+    """The server end of a socketpair: records each request and answers it with reply."""
+
+    def __init__(self, sock, reply):
+        self.sock = sock
+        self.reply = reply
+        self.requests = []
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        decoder = WireDecoder()
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                return
+            decoder.feed(data)
+            frame = decoder.next_frame()
+            while frame is not None:
+                request = decoder.decode(frame)
+                self.requests.append(request)
+                self.sock.sendall(encode_message(dict(self.reply, request_id=request["request_id"])))
+                frame = decoder.next_frame()
+
+
+@unittest.skipIf(main is None, "the client's media dependencies are not installed")
+class TestCreateChannel(unittest.TestCase):
+    def setUp(self):
+        self.client_socket, server_socket = socket.socketpair()
+        self.addCleanup(self.client_socket.close)
+        self.addCleanup(server_socket.close)
+        self.server = FakeServer(server_socket, {"status": "success", "message": "Channel created"})
+
+    def test_create_channel_success(self):
+        response = main.send_create_channel_request(self.client_socket, "test_channel", "test_user")
+
+        self.assertEqual(response["status"], "success")
+        self.assertEqual(response["message"], "Channel created")
+        self.assertEqual(len(self.server.requests), 1)
+        request = self.server.requests[0]
+        self.assertEqual((request["type"], request["action"], request["channel_name"], request["username"]),
+                         ("channel", "create_channel", "test_channel", "test_user"))
+
+    def test_create_channel_on_a_closed_connection(self):
+        self.server.sock.shutdown(socket.SHUT_RDWR)
+        self.server.thread.join(5)
+        response = main.send_create_channel_request(self.client_socket, "test_channel", "test_user")
+        self.assertEqual(response["status"], "error")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,302 @@
+import json
+import os
+import threading
+from logger import log_info, log_error, log_warning
+from common.framing import LENGTH_PREFIX
+
+# Offline message cache of the client: an append-only journal.
+# A message that could not be sent is appended to the journal as one record (a
+# 4-byte big-endian length followed by compact UTF-8 JSON, like the server's
+# message log) and fsync'd, so saving it writes only that record:
+#     {"id": 7, "channel": "General", "message": {"username": ..., "message": ..., "timestamp": ...}}
+# Once messages have reached the server a marker is appended instead of
+# rewriting anything (count messages of the channel, up to id 7, were sent):
+#     {"sent": "General", "through": 7, "count": 3}
+# Only a few counters per channel are kept in memory. Pending messages are read
+# back from the file in batches (pending()), so catching up after a long time
+# offline never loads the whole journal.
+#
+# A record cut short by a crash is truncated when the journal is opened. Once
+# sent messages make up most of a journal larger than compact_min_bytes, the
+# pending records are copied to a new file that atomically replaces the journal.
+
+
+def encode_record(record):
+    payload = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return LENGTH_PREFIX.pack(len(payload)) + payload
+
+
+def read_records(f, end=None):
+    """Yields (offset, size, payload) of the complete records of f from its position up to end."""
+    header = LENGTH_PREFIX.size
+    offset = f.tell()
+    while end is None or offset + header <= end:
+        head = f.read(header)
+        if len(head) < header:
+            return
+        (length,) = LENGTH_PREFIX.unpack(head)
+        if end is not None and offset + header + length > end:
+            return
+        payload = f.read(length)
+        if len(payload) < length:
+            return
+        yield offset, header + length, payload
+        offset += header + length
+
+
+class _ChannelState:
+    __slots__ = ("sent_through", "pending", "start", "last")
+
+    def __init__(self):
+        self.sent_through = 0  # Id of the newest message the server has
+        self.pending = 0       # Messages not sent yet
+        self.start = 0         # File offset at or before the first pending record
+        self.last = None       # (username, message, timestamp) of the newest message, to drop repeats
+
+
+class OfflineJournal:
+    """Messages waiting to be sent, per channel, in an append-only file."""
+
+    def __init__(self, path, legacy_path=None, fsync=True, compact_min_bytes=256 * 1024):
+        self.path = path
+        self.legacy_path = legacy_path # Old JSON cache, imported once when the journal is created
+        self.fsync = fsync
+        self.compact_min_bytes = compact_min_bytes
+        self._channels = {}  # channel_name -> _ChannelState
+        self._next_id = 1
+        self._records = 0    # Message records in the file, sent or not
+        self._size = 0
+        self._file = None
+        self._readers = 0    # pending() generators running; no compaction meanwhile
+        self._lock = threading.RLock()
+        # Counters
+        self.appended = 0
+        self.compactions = 0
+
+    # --- Opening ---
+    def open(self):
+        """Reads the journal (truncating a torn last record). Called on first use if not before."""
+        with self._lock:
+            if self._file is not None:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if os.path.exists(self.path + ".tmp"):
+                os.remove(self.path + ".tmp") # Compaction interrupted before the swap
+            created = not os.path.exists(self.path)
+            self._scan()
+            self._file = open(self.path, "ab")
+            if created and self.legacy_path:
+                self._import_legacy()
+
+    def _scan(self):
+        self._channels.clear()
+        self._next_id, self._records, self._size = 1, 0, 0
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r+b") as f:
+            for offset, size, payload in read_records(f):
+                self._size = offset + size
+                try:
+                    self._apply(json.loads(payload), offset)
+                except (ValueError, KeyError, TypeError) as e:
+                    log_error(f"Skipping unreadable record at offset {offset} of {self.path}: {e}")
+            if f.seek(0, os.SEEK_END) > self._size:
+                log_warning(f"Truncating a partial record at the end of {self.path} ({f.tell() - self._size} bytes).")
+                f.truncate(self._size)
+
+    def _apply(self, record, offset):
+        if "sent" in record:
+            state = self._state(record["sent"])
+            state.sent_through = max(state.sent_through, record["through"])
+            state.pending = max(0, state.pending - record["count"])
+            return
+        state = self._state(record["channel"])
+        if state.pending == 0:
+            state.start = offset
+        state.pending += 1
+        message = record["message"]
+        state.last = (message.get("username"), message.get("message"), message.get("timestamp"))
+        self._next_id = max(self._next_id, record["id"] + 1)
+        self._records += 1
+
+    def _state(self, channel_name):
+        state = self._channels.get(channel_name)
+        if state is None:
+            state = self._channels[channel_name] = _ChannelState()
+        return state
+
+    def _import_legacy(self):
+        try:
+            with open(self.legacy_path, encoding="utf-8") as f:
+                legacy = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log_error(f"Cannot import the old local cache {self.legacy_path}: {e}")
+            return
+        imported = 0
+        for channel_name, channel in (legacy.items() if isinstance(legacy, dict) else ()):
+            messages = channel.get("messages") if isinstance(channel, dict) else None
+            for message in messages if isinstance(messages, list) else ():
+                if isinstance(message, dict) and self._append(channel_name, message, sync=False):
+                    imported += 1
+        self._sync()
+        log_info(f"Imported {imported} cached message(s) from {self.legacy_path} into {self.path}.")
+
+    # --- Writing ---
+    def append(self, channel_name, message):
+        """Stores message (a dict) durably. Returns False if it repeats the channel's newest message."""
+        with self._lock:
+            self.open()
+            return self._append(channel_name, message, sync=True)
+
+    def _append(self, channel_name, message, sync):
+        state = self._state(channel_name)
+        key = (message.get("username"), message.get("message"), message.get("timestamp"))
+        if key == state.last:
+            return False
+        data = encode_record({"id": self._next_id, "channel": channel_name, "message": message})
+        self._write(data, sync)
+        if state.pending == 0:
+            state.start = self._size
+        state.pending += 1
+        state.last = key
+        self._next_id += 1
+        self._records += 1
+        self._size += len(data)
+        self.appended += 1
+        return True
+
+    def _write(self, data, sync):
+        self._file.write(data)
+        if sync:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def mark_sent(self, channel_name, marker):
+        """Records that a batch from pending() reached the server; its messages are not returned again."""
+        through, count, resume = marker
+        with self._lock:
+            self._write(encode_record({"sent": channel_name, "through": through, "count": count}), sync=True)
+            state = self._state(channel_name)
+            state.sent_through = through
+            state.pending = max(0, state.pending - count)
+            state.start = resume
+            self._size = self._file.tell()
+
+    # --- Reading ---
+    def pending_count(self, channel_name):
+        with self._lock:
+            self.open()
+            state = self._channels.get(channel_name)
+            return state.pending if state is not None else 0
+
+    def pending(self, channel_name, batch_size=500):
+        """Yields (messages, marker) batches of the channel's unsent messages, oldest first.
+
+        Pass marker to mark_sent() once a batch is on the server. Messages appended
+        after the first batch was read are left for the next call.
+        """
+        with self._lock:
+            self.open()
+            state = self._channels.get(channel_name)
+            if state is None or state.pending == 0:
+                return
+            start, end, sent_through = state.start, self._size, state.sent_through
+            self._file.flush()
+            self._readers += 1
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                batch, through = [], 0
+                for offset, size, payload in read_records(f, end):
+                    try:
+                        record = json.loads(payload)
+                    except ValueError:
+                        continue # Logged when the journal was opened
+                    if record.get("channel") != channel_name or record.get("id", 0) <= sent_through:
+                        continue
+                    batch.append(record["message"])
+                    through = record["id"]
+                    if len(batch) >= batch_size:
+                        yield batch, (through, len(batch), offset + size)
+                        batch = []
+                if batch:
+                    yield batch, (through, len(batch), end)
+        finally:
+            with self._lock:
+                self._readers -= 1
+            self.maybe_compact()
+
+    # --- Compaction ---
+    def maybe_compact(self):
+        """Compacts the journal if it is large and mostly made of sent messages."""
+        with self._lock:
+            pending = sum(state.pending for state in self._channels.values())
+            if self._file is not None and self._readers == 0 and self._size >= self.compact_min_bytes \
+                    and pending * 2 <= self._records:
+                self.compact()
+
+    def compact(self):
+        """Rewrites the journal with only the pending messages, replacing it atomically."""
+        with self._lock:
+            self.open()
+            if self._readers:
+                return False
+            self._file.flush()
+            temporary = self.path + ".tmp"
+            starts, records, size = {}, 0, 0
+            with open(self.path, "rb") as source, open(temporary, "wb") as target:
+                for offset, length, payload in read_records(source, self._size):
+                    try:
+                        record = json.loads(payload)
+                        state = self._channels.get(record["channel"])
+                        if state is None or record["id"] <= state.sent_through:
+                            continue
+                    except (ValueError, KeyError, TypeError):
+                        continue # Sent markers and unreadable records
+                    starts.setdefault(record["channel"], size)
+                    target.write(LENGTH_PREFIX.pack(len(payload)) + payload)
+                    records += 1
+                    size += length
+                target.flush()
+                os.fsync(target.fileno())
+            self._file.close()
+            os.replace(temporary, self.path)
+            self._sync_directory()
+            self._file = open(self.path, "ab")
+            for channel_name, state in self._channels.items():
+                state.sent_through = 0 # The file holds no sent markers any more
+                state.start = starts.get(channel_name, size)
+            previous, self._size, self._records = self._size, size, records
+            self.compactions += 1
+            log_info(f"Compacted {self.path}: {previous} -> {size} bytes, {records} pending message(s).")
+            return True
+
+    def _sync_directory(self):
+        if not self.fsync or not hasattr(os, "O_DIRECTORY"):
+            return # E.g. Windows, where directories cannot be opened
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self.maybe_compact()
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        with self._lock:
+            return {"pending": sum(state.pending for state in self._channels.values()), "records": self._records,
+                    "bytes": self._size, "appended": self.appended, "compactions": self.compactions}
@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from offline_cache import OfflineJournal
+
+
+def make_messages(first, count, username="alice"):
+    return [{"username": username, "message": f"Message {n}", "timestamp": f"2024-01-01 00:00:{n % 60:02d}"}
+            for n in range(first, first + count)]
+
+
+class TestOfflineJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "offline.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def journal(self, **options):
+        journal = OfflineJournal(self.path, fsync=False, **options)
+        self.addCleanup(journal.close)
+        journal.open()
+        return journal
+
+    def pending(self, journal, channel_name):
+        return [message for batch, _ in journal.pending(channel_name) for message in batch]
+
+    def test_torn_record_is_truncated_on_open(self):
+        journal = self.journal()
+        for message in make_messages(1, 3):
+            journal.append("General", message)
+        journal.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, "ab") as f:
+            f.write(b"\x00\x00\x00\x64{\"id\": 4, \"chan") # Header announces 100 bytes, a crash cut it short
+
+        journal = self.journal()
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(journal.pending_count("General"), 3)
+        journal.append("General", make_messages(4, 1)[0]) # Lands right after the last complete record
+        journal.close()
+        self.assertEqual(self.pending(self.journal(), "General"), make_messages(1, 4))
+
+    def test_sent_markers_survive_a_reopen(self):
+        journal = self.journal()
+        for message in make_messages(1, 5):
+            journal.append("General", message)
+        journal.append("Other", make_messages(6, 1)[0])
+        batches = journal.pending("General", batch_size=2)
+        batch, marker = next(batches)
+        self.assertEqual(batch, make_messages(1, 2))
+        journal.mark_sent("General", marker)
+        batches.close()
+        journal.close()
+
+        journal = self.journal()
+        self.assertEqual(journal.pending_count("General"), 3)
+        self.assertEqual(self.pending(journal, "General"), make_messages(3, 3))
+        self.assertEqual(self.pending(journal, "Other"), make_messages(6, 1))
+        for _, marker in journal.pending("General"):
+            journal.mark_sent("General", marker)
+        journal.close()
+        self.assertEqual(self.journal().pending_count("General"), 0)
+
+    def test_no_compaction_while_a_reader_holds_pending(self):
+        journal = self.journal(compact_min_bytes=0)
+        for message in make_messages(1, 10):
+            journal.append("General", message)
+        read = []
+        batches = journal.pending("General", batch_size=3)
+        for batch, marker in batches:
+            read.extend(batch)
+            journal.mark_sent("General", marker)
+            self.assertFalse(journal.compact()) # Would move the records under the reader
+            journal.maybe_compact()
+            self.assertEqual(journal.compactions, 0)
+        self.assertEqual(read, make_messages(1, 10))
+        self.assertEqual(journal.compactions, 1) # Once the reader is done
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+        journal.append("General", make_messages(11, 1)[0])
+        journal.close()
+        self.assertEqual(self.pending(self.journal(), "General"), make_messages(11, 1))
+
+    def test_imports_the_legacy_json_cache_once(self):
+        legacy_path = os.path.join(self.directory, "client_cache.json")
+        general = make_messages(1, 2)
+        with open(legacy_path, "w", encoding="utf-8") as f:
+            json.dump({"General": {"messages": general + [general[-1]]}, # Repeated newest message is dropped
+                       "Other": {"messages": make_messages(3, 1)}, "Empty": {"messages": []}, "Broken": "x"}, f)
+
+        journal = self.journal(legacy_path=legacy_path)
+        self.assertEqual(self.pending(journal, "General"), general)
+        self.assertEqual(self.pending(journal, "Other"), make_messages(3, 1))
+        self.assertEqual(journal.pending_count("Empty"), 0)
+        journal.close()
+
+        with open(legacy_path, "w", encoding="utf-8") as f:
+            json.dump({"General": {"messages": make_messages(9, 1)}}, f)
+        journal = self.journal(legacy_path=legacy_path) # The journal exists: nothing is imported again
+        self.assertEqual(self.pending(journal, "General"), general)
+
+
+if __name__ == "__main__":
+    unittest.main()
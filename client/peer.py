@@ -3,7 +3,6 @@ import cv2
 import pickle
 import struct
 import threading
-import json
 import time # Added for potential delays/checks
 
 # Define a constant for the stream end signal
@@ -81,8 +80,10 @@ def start_livestream(host="0.0.0.0", port=5001, client_socket=None, channel_name
                 "port": port # The port viewers should connect to
             }
             try:
-                # Add newline for server protocol consistency
-                client_socket.sendall((json.dumps(request) + "\n").encode('utf-8'))
+                # Frame the request in the protocol negotiated with the server.
+                # Imported here because main imports this module.
+                from main import send_request
+                send_request(client_socket, request)
                 print(f"Livestream start notification sent to server for channel '{channel_name}' on P2P port {port}.")
                 # Optionally wait for a confirmation from the server? Depends on server design.
             except (ConnectionError, BrokenPipeError, socket.error) as e:
@@ -13,8 +13,9 @@ from main import (
     connect_to_server, login, list_channels, change_status,
     send_create_channel_request, send_delete_channel_request,
     send_join_channel_request, send_message, list_online_users,
-    request_sync_from_server, save_local_message, handle_client_online,
-    save_local_cache, load_local_cache
+    request_sync_from_server, request_history, save_local_message, handle_client_online,
+    save_local_cache, load_local_cache,
+    register_push_handler, unregister_push_handler, poll_push_messages
 )
 
 # Global variables
@@ -24,7 +25,14 @@ online_users = []
 offline_users = []
 shown_messages = set()
 current_channel = "General"
+sync_cursor = None # Last message seq received for current_channel (None = load the newest page first)
+HISTORY_PAGE_SIZE = 50 # Messages per get_history page
+oldest_loaded_seq = None # Seq of the oldest message shown; older pages are loaded on scroll-up
+history_has_more = False # Older messages exist on the server
+loading_older = False
 sync_thread_running = False
+sync_thread_generation = 0 # Bumped for every new sync thread so an older one exits
+resync_requested = False # Server dropped pushes for us (we fell behind); sync with the cursor
 user_status_update_job = None
 # Add message_entry and send_button as globals to be accessible in update_status
 message_entry = None
@@ -125,8 +133,10 @@ def main_screen(client_socket, username, user_role):
     global user_status_update_job, sync_thread_running
     # Make message_entry and send_button global within this scope
     global message_entry, send_button
-    global notified_livestreams
+    global notified_livestreams, sync_cursor, oldest_loaded_seq, history_has_more
     current_channel = "General"
+    sync_cursor = None
+    oldest_loaded_seq, history_has_more = None, False
     shown_messages = set()
     # Không reset user_status_update_job và sync_thread_running ở đây
 
@@ -334,7 +344,9 @@ def main_screen(client_socket, username, user_role):
                         print("Status changed from Offline to Online/Invisible. Syncing local messages...")
                         # Run sync in a separate thread to avoid blocking UI
                         # --- MODIFIED LINE ---
-                        threading.Thread(target=handle_client_online, args=(client_socket, username, current_channel), daemon=True).start()
+                        # Messages missed while offline are streamed into the chat as they arrive
+                        threading.Thread(target=handle_client_online, args=(client_socket, username, current_channel),
+                                         kwargs={"since": sync_cursor, "on_messages": show_streamed_messages}, daemon=True).start()
                     # --- End Sync Trigger ---
 
                 elif response:
@@ -415,7 +427,8 @@ def main_screen(client_socket, username, user_role):
 
             def confirm_join():
                 # Sửa: Khai báo global để sửa đổi
-                global current_channel, shown_messages, user_status_update_job, sync_thread_running
+                global current_channel, shown_messages, user_status_update_job, sync_thread_running, sync_cursor
+                global oldest_loaded_seq, history_has_more
                 selected = channel_listbox.curselection()
                 if selected:
                     selected_channel = channel_listbox.get(selected)
@@ -436,6 +449,8 @@ def main_screen(client_socket, username, user_role):
 
                         # Update channel state
                         current_channel = selected_channel
+                        sync_cursor = None # Newest page of the new channel first
+                        oldest_loaded_seq, history_has_more = None, False
                         channel_label.config(text=f"Channel: {current_channel}")
                         join_window.destroy()
 
@@ -552,12 +567,19 @@ def main_screen(client_socket, username, user_role):
     chat_frame.grid_columnconfigure(0, weight=1)
 
     # --- Message Handling ---
-    def update_chat_display(messages_list):
+    def update_chat_display(messages_list, prepend=False):
+        # prepend: an older history page, inserted above what is shown
         global shown_messages, livestream_links, notified_livestreams
         if not chat_display.winfo_exists(): return # Avoid error if widget destroyed
         chat_display.configure(state="normal")
         new_message_added = False
         messages_list.sort(key=lambda x: x.get('timestamp', ''))
+        where = tk.END
+        if prepend:
+            # The mark moves along with what is inserted at it, so the page keeps its order
+            chat_display.mark_set("older_page", "1.0")
+            chat_display.mark_gravity("older_page", tk.RIGHT)
+            where = "older_page"
 
         for msg in messages_list:
             ts = msg.get('timestamp', '')
@@ -603,16 +625,16 @@ def main_screen(client_socket, username, user_role):
                             livestream_links[msg_key] = {"host": host, "port": port}
                             link_tag = f"livestream_{msg_key}"
                             display_text = f"[{formatted_time}] System: User '{streamer}' started a livestream. "
-                            chat_display.insert(tk.END, display_text)
-                            chat_display.insert(tk.END, "[Click to Join]", (link_tag, "link"))
-                            chat_display.insert(tk.END, "\n")
+                            chat_display.insert(where, display_text)
+                            chat_display.insert(where, "[Click to Join]", (link_tag, "link"))
+                            chat_display.insert(where, "\n")
                             chat_display.tag_config(link_tag, foreground="blue", underline=True)
                             chat_display.tag_bind(link_tag, "<Button-1>", lambda event, key=msg_key: handle_join_livestream(event, key))
                             chat_display.tag_config("link", foreground="blue", underline=True)
                     elif is_user_join_notification:
                         join_notification_tag = "user_joined_event"
-                        chat_display.insert(tk.END, f"[{formatted_time}] ", "timestamp_style") 
-                        chat_display.insert(tk.END, f"{usr}: {content}\n", join_notification_tag)
+                        chat_display.insert(where, f"[{formatted_time}] ", "timestamp_style") 
+                        chat_display.insert(where, f"{usr}: {content}\n", join_notification_tag)
                         chat_display.tag_config(join_notification_tag, foreground="green", font=("Arial", 10, "italic"))
                         chat_display.tag_config("timestamp_style", foreground="gray") 
                     # elif is_user_disconnect_notification:
@@ -626,20 +648,69 @@ def main_screen(client_socket, username, user_role):
                     # --- END MODIFICATION ---
                     else:
                         # Regular message display (bao gồm các tin nhắn hệ thống khác nếu có)
-                        chat_display.insert(tk.END, f"[{formatted_time}] {usr}: {content}\n")
+                        chat_display.insert(where, f"[{formatted_time}] {usr}: {content}\n")
 
                     new_message_added = True
             else: print(f"Skipping invalid message format or missing key fields: {msg}")
 
-        if new_message_added: chat_display.see(tk.END)
+        if prepend: chat_display.yview("older_page") # Keep the messages that were on top in view
+        elif new_message_added: chat_display.see(tk.END)
         chat_display.configure(state="disabled")
+
+    def show_streamed_messages(messages):
+        # Called on the thread reading the socket for every history_chunk
+        try:
+            if messages and root.winfo_exists(): root.after(0, update_chat_display, messages)
+        except (tk.TclError, RuntimeError): pass # Window already closed
+
+    def load_older_messages():
+        # Fetches the page before the oldest message shown, off the Tk thread
+        global loading_older
+        if loading_older or not history_has_more or oldest_loaded_seq is None: return
+        loading_older = True
+        paged_channel, before = current_channel, oldest_loaded_seq
+
+        def fetch():
+            global loading_older, oldest_loaded_seq, history_has_more
+            try:
+                response = request_history(client_socket, paged_channel, username, before=before, limit=HISTORY_PAGE_SIZE)
+                if response.get("status") != "success" or paged_channel != current_channel: return
+                messages = response.get("messages", [])
+                history_has_more = bool(response.get("has_more"))
+                if messages:
+                    oldest_loaded_seq = messages[0].get("seq", oldest_loaded_seq)
+                    root.after(0, update_chat_display, messages, True)
+            except (tk.TclError, RuntimeError): pass # Window already closed
+            finally:
+                loading_older = False
+
+        threading.Thread(target=fetch, name='HistoryPageThread', daemon=True).start()
+
+    def on_chat_scroll(first, last):
+        if float(first) <= 0.0 and float(last) < 1.0: load_older_messages() # Scrolled to the top
+
+    def on_chat_wheel_up(event=None):
+        if chat_display.yview()[0] <= 0.0: load_older_messages() # Also when the page does not fill the view
+
+    chat_display.configure(yscrollcommand=on_chat_scroll)
+    chat_display.bind("<MouseWheel>", lambda event: on_chat_wheel_up() if event.delta > 0 else None)
+    chat_display.bind("<Button-4>", on_chat_wheel_up) # X11 wheel up
+
     def sync_messages():
+        global sync_cursor, oldest_loaded_seq, history_has_more
         # Ensure username is accessible here (it is, as it's passed to main_screen)
         if not current_channel or not client_socket or client_socket.fileno() == -1: return
         try:
-            # This function in client/main.py should also be aware of PUSH messages
-            # and not log an error if it receives one instead of a direct sync response.
-            response = request_sync_from_server(client_socket, current_channel, username)
+            # A channel starts with its newest page (older ones load on scroll-up);
+            # once we hold a cursor only messages stored after it come back
+            synced_channel = current_channel
+            first_page = sync_cursor is None
+            if first_page:
+                response = request_history(client_socket, synced_channel, username, limit=HISTORY_PAGE_SIZE)
+            else:
+                # Large catch-ups arrive in chunks, each shown as soon as it is received
+                response = request_sync_from_server(client_socket, synced_channel, username, since=sync_cursor,
+                                                    on_messages=show_streamed_messages)
 
             if not response:
                 safe_channel = current_channel.encode('utf-8', errors='replace').decode('utf-8', errors='replace')
@@ -649,23 +720,17 @@ def main_screen(client_socket, username, user_role):
             # Case 1: Successful sync response from request_sync_from_server
             if response.get("status") == "success":
                 messages = response.get("messages", [])
+                if synced_channel == current_channel and isinstance(response.get("cursor"), int):
+                    sync_cursor = response["cursor"]
+                    if first_page:
+                        history_has_more = bool(response.get("has_more"))
+                        oldest_loaded_seq = messages[0].get("seq") if messages else None
                 if root.winfo_exists():
                     root.after(0, update_chat_display, messages)
+                return bool(response.get("push")) # Server will push new messages from now on
             
-            # Case 2: Server PUSH notification (e.g., new_message broadcast)
-            # This might be received if request_sync_from_server picked up a broadcast.
-            elif response.get("type") == "channel" and response.get("action") == "new_message" and "message_data" in response:
-                print(f"[UI SYNC - PUSH DEBUG] Received a PUSH message during sync attempt: {response}")
-                message_data = response['message_data']
-                if isinstance(message_data, dict):
-                    print(f"[UI SYNC - PUSH] Processing PUSH system message: {message_data}")
-                    if root.winfo_exists():
-                        root.after(0, update_chat_display, [message_data]) # Display as a single message
-                else:
-                    print(f"[UI SYNC - PUSH ERROR] Unexpected format for 'message_data' in PUSH message: {message_data}")
-            
-            # Case 3: Actual error response from the sync request OR other unexpected format
-            # This block is reached if status is not "success" AND it's not the specific PUSH message handled above.
+            # Case 2: Actual error response from the sync request OR other unexpected format
+            # (pushes never come back as replies; the reader thread hands them to the push handlers)
             else:
                 print(f"[UI SYNC - ERROR DEBUG] Received non-success/non-push response from request_sync_from_server: {response}")
                 log_msg_detail = ""
@@ -718,18 +783,76 @@ def main_screen(client_socket, username, user_role):
                   safe_print_err = str(print_err).encode('utf-8', errors='replace').decode('utf-8', errors='replace')
                   print(f"[UI SYNC - Critical Error] Unexpected error during message sync AND error printing exception details: {safe_print_err}")
              print(f"--- End of unexpected error details ---")
+    def apply_presence_diff(user, state):
+        # Move one user between the Listboxes instead of refilling them
+        for users, listbox in ((online_users, online_users_list), (offline_users, offline_users_list)):
+            if user in users:
+                if listbox and listbox.winfo_exists():
+                    position = users.index(user)
+                    if listbox.get(position) == user: listbox.delete(position)
+                users.remove(user)
+        if state == "online":
+            online_users.append(user)
+            if online_users_list and online_users_list.winfo_exists(): online_users_list.insert(tk.END, user)
+        elif state == "offline":
+            offline_users.append(user)
+            if offline_users_list and offline_users_list.winfo_exists(): offline_users_list.insert(tk.END, user)
+        # "left": the user is in neither list any more
+
+    def handle_push_message(push):
+        global sync_cursor, resync_requested
+        if push.get("type") == "channel" and push.get("action") == "resync":
+            # Pushed messages were coalesced away; the sync thread fetches them by cursor
+            if push.get("channel_name") == current_channel: resync_requested = True
+            return
+        if push.get("type") == "presence":
+            # Join / leave / status change of one user in a channel we follow
+            if push.get("channel_name") == current_channel and push.get("username"):
+                try:
+                    if root.winfo_exists():
+                        root.after(0, apply_presence_diff, push["username"], push.get("state"))
+                except (tk.TclError, RuntimeError): pass # Window already closed
+            return
+        # New message pushed by the server for a channel this connection follows
+        if push.get("type") != "channel" or push.get("action") != "new_message": return
+        message_data = push.get("message_data")
+        if push.get("channel_name") != current_channel or not isinstance(message_data, dict): return
+        if sync_cursor is not None and message_data.get("seq") == sync_cursor + 1:
+            sync_cursor += 1 # The next sync only needs what came after this push
+        try:
+            if root.winfo_exists():
+                root.after(0, update_chat_display, [message_data])
+        except (tk.TclError, RuntimeError): pass # Window already closed
+
+    register_push_handler(handle_push_message)
+
     def start_auto_sync(interval=3):
-        global sync_thread_running
+        global sync_thread_running, sync_thread_generation
         if sync_thread_running: return
+        sync_thread_generation += 1
+        generation = sync_thread_generation
 
         def auto_sync_loop():
-            global sync_thread_running
+            global sync_thread_running, resync_requested
             sync_thread_running = True
             print(f"Auto-sync thread started (interval: {interval}s).")
+            push_active = False # True while the server pushes new messages to us
             # Sửa: Dùng while sync_thread_running
-            while sync_thread_running:
+            while sync_thread_running and generation == sync_thread_generation:
                 if client_socket and client_socket.fileno() != -1:
-                    try: sync_messages()
+                    if push_active:
+                        # No polling while the push stream is healthy, just read what arrives
+                        push_active = poll_push_messages(client_socket, timeout=1.0)
+                        if push_active and resync_requested:
+                            resync_requested = False
+                            try: sync_messages()
+                            except Exception as e: print(f"Error in auto-sync loop: {e}")
+                        if not push_active:
+                            print("Push stream lost, falling back to periodic sync.")
+                            try: root.after(0, resume_user_status_polling)
+                            except (tk.TclError, RuntimeError): pass
+                        continue
+                    try: push_active = sync_messages() is True
                     except Exception as e: print(f"Error in auto-sync loop: {e}")
                 else:
                     print("Auto-sync stopping: Invalid socket.")
@@ -737,7 +860,7 @@ def main_screen(client_socket, username, user_role):
                     # Không cần break vì vòng lặp sẽ tự thoát
 
                 # Check flag again before sleeping
-                if sync_thread_running:
+                if sync_thread_running and not push_active:
                     time.sleep(interval)
 
             print("Auto-sync thread has stopped.")
@@ -881,8 +1004,9 @@ def main_screen(client_socket, username, user_role):
             # print(f"Fetching user status for channel: {current_channel}") # Bỏ comment nếu cần debug
             response = list_online_users(client_socket, current_channel)
             if response and response.get("status") == "success":
-                new_online = response.get("online", [])
-                new_offline = response.get("offline", [])
+                # Copies: push diffs edit these lists in place
+                new_online = list(response.get("online", []))
+                new_offline = list(response.get("offline", []))
 
                 # Chỉ cập nhật nếu danh sách thực sự thay đổi
                 if new_online != online_users:
@@ -911,6 +1035,7 @@ def main_screen(client_socket, username, user_role):
             else:
                  # Trường hợp không nhận được phản hồi nào
                  print("Error fetching user status: No response from server.")
+            return bool(response and response.get("status") == "success" and response.get("push"))
 
         except ConnectionError as e:
             # Attempt to print connection error safely
@@ -961,7 +1086,10 @@ def main_screen(client_socket, username, user_role):
         global user_status_update_job
         # Check if polling should run
         if client_socket and client_socket.fileno() != -1 and current_channel and root.winfo_exists():
-            fetch_user_status()
+            if fetch_user_status() is True:
+                # The server pushes presence diffs from now on, no need to poll
+                user_status_update_job = None
+                return
             # Schedule the next call
             user_status_update_job = root.after(interval_ms, schedule_user_status_update, interval_ms)
         else:
@@ -969,6 +1097,10 @@ def main_screen(client_socket, username, user_role):
             user_status_update_job = None
             print("User status polling stopped.")
 
+    def resume_user_status_polling():
+        # Called when the push stream is lost
+        if user_status_update_job is None: schedule_user_status_update()
+
     # --- Avatar + Username ---
     avatar_frame = tk.Frame(left_frame, bg="lightgray")
     avatar_frame.pack(side=tk.BOTTOM, pady=20, fill=tk.X)
@@ -1000,6 +1132,7 @@ def main_screen(client_socket, username, user_role):
         global sync_thread_running, user_status_update_job
         print("Closing application...")
         sync_thread_running = False # Signal sync thread to stop
+        unregister_push_handler(handle_push_message)
         if user_status_update_job:
             try: root.after_cancel(user_status_update_job)
             except: pass
@@ -0,0 +1,258 @@
+"""Compact binary encoding for protocol messages (MessagePack format).
+
+Only the subset of MessagePack needed for JSON-like data is produced: nil,
+booleans, integers, float64, str, bin, arrays and maps. When the optional
+`msgpack` package is installed its C implementation is used; otherwise the
+pure-Python fallback below produces and reads the same bytes, so peers with
+and without the package interoperate.
+"""
+import struct
+
+try:
+    import msgpack
+except ImportError: # Optional dependency
+    msgpack = None
+
+_pack_B = struct.Struct(">B").pack
+_pack_BB = struct.Struct(">BB").pack
+_pack_b = struct.Struct(">Bb").pack
+_pack_h = struct.Struct(">Bh").pack
+_pack_i = struct.Struct(">Bi").pack
+_pack_H = struct.Struct(">BH").pack
+_pack_I = struct.Struct(">BI").pack
+_pack_Q = struct.Struct(">BQ").pack
+_pack_q = struct.Struct(">Bq").pack
+_pack_d = struct.Struct(">Bd").pack
+_unpack_H = struct.Struct(">H").unpack_from
+_unpack_I = struct.Struct(">I").unpack_from
+_unpack_Q = struct.Struct(">Q").unpack_from
+_unpack_b = struct.Struct(">b").unpack_from
+_unpack_h = struct.Struct(">h").unpack_from
+_unpack_i = struct.Struct(">i").unpack_from
+_unpack_q = struct.Struct(">q").unpack_from
+_unpack_d = struct.Struct(">d").unpack_from
+
+# Map keys repeat in every message ("username", "message", ...); cache their encoding
+_key_cache = {}
+_KEY_CACHE_LIMIT = 4096
+
+
+class CodecError(ValueError):
+    """Raised for data that cannot be encoded or bytes that are not valid MessagePack."""
+
+
+def _encode_str(value):
+    data = value.encode("utf-8")
+    n = len(data)
+    if n < 32:
+        return _pack_B(0xA0 | n) + data
+    if n < 0x100:
+        return b"\xd9" + _pack_B(n) + data
+    if n < 0x10000:
+        return _pack_H(0xDA, n) + data
+    return _pack_I(0xDB, n) + data
+
+
+def _encode_int(value):
+    # Smallest format that holds the value, as the msgpack package picks it
+    if value >= 0:
+        if value < 0x80:
+            return _pack_B(value)
+        if value < 0x100:
+            return _pack_BB(0xCC, value)
+        if value < 0x10000:
+            return _pack_H(0xCD, value)
+        if value < 0x100000000:
+            return _pack_I(0xCE, value)
+        if value < 0x10000000000000000:
+            return _pack_Q(0xCF, value)
+    else:
+        if value >= -32:
+            return _pack_B(value & 0xFF)
+        if value >= -0x80:
+            return _pack_b(0xD0, value)
+        if value >= -0x8000:
+            return _pack_h(0xD1, value)
+        if value >= -0x80000000:
+            return _pack_i(0xD2, value)
+        if value >= -0x8000000000000000:
+            return _pack_q(0xD3, value)
+    raise CodecError(f"Integer out of range: {value}")
+
+
+def _encode(value, out):
+    # Ordered by how often each type shows up in chat messages
+    if isinstance(value, str):
+        out.append(_encode_str(value))
+    elif isinstance(value, dict):
+        n = len(value)
+        if n < 16:
+            out.append(_pack_B(0x80 | n))
+        elif n < 0x10000:
+            out.append(_pack_H(0xDE, n))
+        else:
+            out.append(_pack_I(0xDF, n))
+        for key, item in value.items():
+            encoded_key = _key_cache.get(key)
+            if encoded_key is None:
+                if not isinstance(key, str):
+                    raise CodecError(f"Map keys must be strings, got {type(key).__name__}")
+                encoded_key = _encode_str(key)
+                if len(_key_cache) < _KEY_CACHE_LIMIT:
+                    _key_cache[key] = encoded_key
+            out.append(encoded_key)
+            _encode(item, out)
+    elif isinstance(value, (list, tuple)):
+        n = len(value)
+        if n < 16:
+            out.append(_pack_B(0x90 | n))
+        elif n < 0x10000:
+            out.append(_pack_H(0xDC, n))
+        else:
+            out.append(_pack_I(0xDD, n))
+        for item in value:
+            _encode(item, out)
+    elif value is None:
+        out.append(b"\xc0")
+    elif value is True:
+        out.append(b"\xc3")
+    elif value is False:
+        out.append(b"\xc2")
+    elif isinstance(value, int):
+        out.append(_encode_int(value))
+    elif isinstance(value, float):
+        out.append(_pack_d(0xCB, value))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        n = len(value)
+        if n < 0x100:
+            out.append(b"\xc4" + _pack_B(n))
+        elif n < 0x10000:
+            out.append(_pack_H(0xC5, n))
+        else:
+            out.append(_pack_I(0xC6, n))
+        out.append(bytes(value))
+    else:
+        raise CodecError(f"Cannot encode value of type {type(value).__name__}")
+
+
+def _decode(data, pos):
+    """Decodes one value starting at pos. Returns (value, new_pos)."""
+    tag = data[pos]
+    pos += 1
+    if tag < 0x80: # positive fixint
+        return tag, pos
+    if 0xA0 <= tag <= 0xBF: # fixstr
+        end = pos + (tag & 0x1F)
+        return data[pos:end].decode("utf-8"), end
+    if 0x80 <= tag <= 0x8F: # fixmap
+        return _decode_map(data, pos, tag & 0x0F)
+    if 0x90 <= tag <= 0x9F: # fixarray
+        return _decode_array(data, pos, tag & 0x0F)
+    if tag >= 0xE0: # negative fixint
+        return tag - 0x100, pos
+    if tag == 0xC0:
+        return None, pos
+    if tag == 0xC2:
+        return False, pos
+    if tag == 0xC3:
+        return True, pos
+    if tag == 0xD9:
+        n = data[pos]
+        return data[pos + 1:pos + 1 + n].decode("utf-8"), pos + 1 + n
+    if tag == 0xDA:
+        n = _unpack_H(data, pos)[0]
+        return data[pos + 2:pos + 2 + n].decode("utf-8"), pos + 2 + n
+    if tag == 0xDB:
+        n = _unpack_I(data, pos)[0]
+        return data[pos + 4:pos + 4 + n].decode("utf-8"), pos + 4 + n
+    if tag == 0xCB:
+        return _unpack_d(data, pos)[0], pos + 8
+    if tag == 0xCA:
+        return struct.unpack_from(">f", data, pos)[0], pos + 4
+    if tag == 0xCC:
+        return data[pos], pos + 1
+    if tag == 0xCD:
+        return _unpack_H(data, pos)[0], pos + 2
+    if tag == 0xCE:
+        return _unpack_I(data, pos)[0], pos + 4
+    if tag == 0xCF:
+        return _unpack_Q(data, pos)[0], pos + 8
+    if tag == 0xD0:
+        return _unpack_b(data, pos)[0], pos + 1
+    if tag == 0xD1:
+        return _unpack_h(data, pos)[0], pos + 2
+    if tag == 0xD2:
+        return _unpack_i(data, pos)[0], pos + 4
+    if tag == 0xD3:
+        return _unpack_q(data, pos)[0], pos + 8
+    if tag == 0xDC:
+        return _decode_array(data, pos + 2, _unpack_H(data, pos)[0])
+    if tag == 0xDD:
+        return _decode_array(data, pos + 4, _unpack_I(data, pos)[0])
+    if tag == 0xDE:
+        return _decode_map(data, pos + 2, _unpack_H(data, pos)[0])
+    if tag == 0xDF:
+        return _decode_map(data, pos + 4, _unpack_I(data, pos)[0])
+    if tag == 0xC4:
+        n = data[pos]
+        return bytes(data[pos + 1:pos + 1 + n]), pos + 1 + n
+    if tag == 0xC5:
+        n = _unpack_H(data, pos)[0]
+        return bytes(data[pos + 2:pos + 2 + n]), pos + 2 + n
+    if tag == 0xC6:
+        n = _unpack_I(data, pos)[0]
+        return bytes(data[pos + 4:pos + 4 + n]), pos + 4 + n
+    raise CodecError(f"Unsupported MessagePack type byte 0x{tag:02x}")
+
+
+def _decode_array(data, pos, count):
+    items = []
+    append = items.append
+    for _ in range(count):
+        item, pos = _decode(data, pos)
+        append(item)
+    return items, pos
+
+
+def _decode_map(data, pos, count):
+    result = {}
+    for _ in range(count):
+        key, pos = _decode(data, pos)
+        result[key], pos = _decode(data, pos)
+    return result, pos
+
+
+def pack(value):
+    """Encodes value as MessagePack bytes."""
+    if msgpack is not None:
+        try:
+            return msgpack.packb(value, use_bin_type=True)
+        except (TypeError, ValueError, OverflowError) as e:
+            raise CodecError(str(e)) from e
+    return _pure_pack(value)
+
+
+def unpack(data):
+    """Decodes MessagePack bytes produced by pack() (or any peer using the same subset)."""
+    if msgpack is not None:
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except Exception as e:
+            raise CodecError(f"Invalid MessagePack data: {e}") from e
+    return _pure_unpack(data)
+
+
+def _pure_pack(value):
+    out = []
+    _encode(value, out)
+    return b"".join(out)
+
+
+def _pure_unpack(data):
+    try:
+        value, end = _decode(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise CodecError(f"Truncated or invalid MessagePack data: {e}") from e
+    if end != len(data):
+        raise CodecError(f"{len(data) - end} trailing bytes after MessagePack value")
+    return value
@@ -0,0 +1,167 @@
+"""Incremental framing of the wire protocol.
+
+Two framings are supported on a connection:
+
+* NDJSON (default): every request and response is one JSON document followed
+  by "\n".
+* Binary (negotiated during auth, see common/protocol.py): every frame is a
+  4-byte big-endian length followed by that many payload bytes.
+
+TCP does not preserve message boundaries, so a frame may arrive split over
+several recv() calls or several frames may arrive in one. Each framer keeps one
+growable buffer per connection, remembers how far it has already scanned, and
+hands back each complete frame exactly once. Every received byte is scanned a
+single time, so the cost is linear in the bytes received regardless of how the
+stream is cut.
+"""
+import json
+import struct
+
+DELIMITER = b"\n"
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # 64 MB, generous enough for full channel histories
+
+LENGTH_PREFIX = struct.Struct(">I")
+
+
+class FrameTooLarge(ValueError):
+    """Raised when a frame grows beyond max_frame_size."""
+
+
+class NDJSONFramer:
+    """Splits a byte stream into newline-delimited frames."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._scan_pos = 0       # Bytes before this offset are known to contain no delimiter
+        self._discarding = False # True while skipping the rest of an oversized frame
+
+    def append(self, data):
+        """Adds received bytes without extracting frames."""
+        if self._discarding:
+            end = data.find(DELIMITER)
+            if end == -1:
+                return # Still inside the oversized frame, keep nothing
+            self._discarding = False
+            data = data[end + 1:]
+        self._buffer += data
+
+    def next_frame(self):
+        """Returns the next complete frame (bytes, without delimiter) or None.
+
+        Blank frames are skipped. Raises FrameTooLarge once if an incomplete frame
+        exceeds max_frame_size; its bytes are dropped up to the next delimiter and
+        framing resumes cleanly after it.
+        """
+        buffer = self._buffer
+        while True:
+            end = buffer.find(DELIMITER, self._scan_pos)
+            if end == -1:
+                self._scan_pos = len(buffer)
+                if len(buffer) > self.max_frame_size:
+                    size = len(buffer)
+                    self.reset()
+                    self._discarding = True
+                    raise FrameTooLarge(f"Frame exceeds {self.max_frame_size} bytes ({size} buffered without delimiter)")
+                return None
+            frame = bytes(buffer[:end]).strip()
+            del buffer[:end + 1] # bytearray drops a prefix without copying the tail
+            self._scan_pos = 0
+            if frame:
+                return frame
+
+    def feed(self, data):
+        """Adds received bytes and returns the list of complete frames."""
+        self.append(data)
+        frames = []
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def take_buffer(self):
+        """Removes and returns the unframed bytes (used when the connection switches framing)."""
+        data = bytes(self._buffer)
+        self.reset()
+        return data
+
+    def buffered(self):
+        """Number of bytes held for an incomplete frame."""
+        return len(self._buffer)
+
+    def reset(self):
+        self._buffer.clear()
+        self._scan_pos = 0
+        self._discarding = False
+
+
+class BinaryFramer:
+    """Splits a byte stream into length-prefixed frames."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._skip = 0 # Remaining bytes of an oversized frame to drop
+
+    def append(self, data):
+        if self._skip:
+            dropped = min(self._skip, len(data))
+            self._skip -= dropped
+            data = data[dropped:]
+        self._buffer += data
+
+    def next_frame(self):
+        """Returns the next complete frame payload or None. Raises FrameTooLarge for
+        frames announcing more than max_frame_size bytes; they are skipped."""
+        buffer = self._buffer
+        if len(buffer) < LENGTH_PREFIX.size:
+            return None
+        length = LENGTH_PREFIX.unpack_from(buffer)[0]
+        if length > self.max_frame_size:
+            available = len(buffer) - LENGTH_PREFIX.size
+            self._skip = max(0, length - available)
+            del buffer[:LENGTH_PREFIX.size + min(length, available)]
+            raise FrameTooLarge(f"Frame of {length} bytes exceeds {self.max_frame_size} bytes")
+        end = LENGTH_PREFIX.size + length
+        if len(buffer) < end:
+            return None
+        frame = bytes(buffer[LENGTH_PREFIX.size:end])
+        del buffer[:end]
+        return frame
+
+    def feed(self, data):
+        self.append(data)
+        frames = []
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def take_buffer(self):
+        data = bytes(self._buffer)
+        self.reset()
+        return data
+
+    def buffered(self):
+        return len(self._buffer)
+
+    def reset(self):
+        self._buffer.clear()
+        self._skip = 0
+
+
+def encode_json(obj):
+    """Serializes obj as one NDJSON frame."""
+    return (json.dumps(obj) + "\n").encode("utf-8")
+
+
+def decode_json(frame):
+    """Parses one frame. Raises ValueError (json.JSONDecodeError / UnicodeDecodeError) on bad input."""
+    return json.loads(frame)
+
+
+def encode_length_prefixed(payload):
+    """Wraps payload bytes in one binary frame."""
+    return LENGTH_PREFIX.pack(len(payload)) + payload
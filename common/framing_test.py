@@ -0,0 +1,44 @@
+import json
+import unittest
+
+from common.framing import NDJSONFramer, FrameTooLarge, encode_json, decode_json
+
+
+class TestNDJSONFramer(unittest.TestCase):
+    def test_frame_split_across_chunks(self):
+        payload = encode_json({"type": "channel", "action": "save_message", "message": "x" * 10000})
+        framer = NDJSONFramer()
+        frames = []
+        for i in range(0, len(payload), 4096):
+            frames.extend(framer.feed(payload[i:i + 4096]))
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(decode_json(frames[0])["message"], "x" * 10000)
+        self.assertEqual(framer.buffered(), 0)
+
+    def test_multiple_frames_in_one_chunk_and_partial_tail(self):
+        framer = NDJSONFramer()
+        data = encode_json({"n": 1}) + encode_json({"n": 2}) + b'{"n": 3'
+        self.assertEqual([decode_json(f)["n"] for f in framer.feed(data)], [1, 2])
+        self.assertEqual([decode_json(f)["n"] for f in framer.feed(b"}\n")], [3])
+
+    def test_multibyte_character_split(self):
+        payload = json.dumps({"message": "Xin chào"}, ensure_ascii=False).encode("utf-8") + b"\n"
+        cut = payload.index("à".encode("utf-8")) + 1 # Cut inside the two-byte character
+        framer = NDJSONFramer()
+        self.assertEqual(framer.feed(payload[:cut]), [])
+        self.assertEqual(decode_json(framer.feed(payload[cut:])[0])["message"], "Xin chào")
+
+    def test_blank_lines_are_skipped(self):
+        framer = NDJSONFramer()
+        self.assertEqual(framer.feed(b"\n\r\n" + encode_json({"a": 1}) + b"\n"), [b'{"a": 1}'])
+
+    def test_oversized_frame_is_dropped_and_framing_resumes(self):
+        framer = NDJSONFramer(max_frame_size=16)
+        with self.assertRaises(FrameTooLarge):
+            framer.feed(b"x" * 32)
+        self.assertEqual(framer.feed(b"still the big frame"), [])
+        self.assertEqual(framer.feed(b"...end\n" + encode_json({"ok": 1})), [b'{"ok": 1}'])
+
+
+if __name__ == "__main__":
+    unittest.main()
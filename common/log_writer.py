@@ -0,0 +1,292 @@
+"""Buffered, level-gated log writing shared by the server and client loggers.
+
+Logger is the front end. A record below the configured level is dropped before
+its message is formatted ("%s"-style arguments are only applied to records
+that are kept). Records may carry structured fields (user=..., channel=...,
+latency_ms=...; None values are left out). A record with an event field can be sampled: with
+sample {"get_user_status": 100}, one in 100 such records is kept and marked
+"sampled": 100. Level, format and sampling can be changed while running with
+configure(), or by editing the JSON file given as config_path, which is checked
+about once a second, e.g.
+    {"level": "DEBUG", "format": "json", "sample": {"sync_from_server": 10}}
+Removing the file restores the settings the logger was created with.
+
+LogWriter is the back end. Logging a line only appends a record to a deque
+(atomic under the GIL, no lock taken by the caller). A background thread wakes
+every flush_interval seconds, or as soon as batch_lines records are waiting,
+and writes everything pending with one write() to the file and one to the
+console, as text or (structured=True) as one JSON object per line. The file is
+rotated once it grows beyond max_bytes: log -> log.1 -> ... -> log.<backups>,
+dropping the oldest archive (backups=0 truncates the file instead).
+
+If the writer falls behind by more than max_pending records, new records are
+dropped and counted; the count is written to the log once it catches up.
+"""
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+
+class LogWriter:
+    """Appends formatted log records to path from a background thread."""
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5, flush_interval=0.2,
+                 batch_lines=1000, max_pending=100000, echo=True, echo_tracebacks=False, structured=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_lines = batch_lines
+        self.max_pending = max_pending
+        self.echo = echo                      # Also print "[LEVEL] message" to stdout
+        self.echo_tracebacks = echo_tracebacks
+        self.structured = structured          # JSON lines in the file instead of text
+        self.on_tick = None                   # Called on the writer thread about every tick_interval seconds
+        self.tick_interval = 1.0
+        self._pending = collections.deque()   # (time, level, message, traceback text, fields) or a flush Event
+        self._wake = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._file = None
+        self._size = 0
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+
+    def write(self, level, message, exc_text=None, fields=None):
+        """Queues one record (level name, formatted message, optional dict of fields). Never blocks on the file."""
+        pending = self._pending
+        if len(pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        pending.append((time.time(), level, message, exc_text, fields))
+        if self._thread is None:
+            self._start()
+        if len(pending) >= self.batch_lines:
+            self._wake.set()
+
+    def flush(self, timeout=5.0):
+        """Waits until every record queued before this call is written. Returns False on timeout."""
+        if self._thread is None or not self._thread.is_alive():
+            self._drain() # Never started (or stopped): write on this thread
+            return True
+        done = threading.Event()
+        self._pending.append(done)
+        self._wake.set()
+        return done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        """Writes what is pending, stops the thread and closes the file."""
+        self.flush(timeout)
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._drain() # Records logged while stopping
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        return {"written": self.written, "dropped": self.dropped, "batches": self.batches,
+                "rotations": self.rotations, "pending": len(self._pending)}
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="LogWriter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        last_tick = time.monotonic()
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._drain()
+            if self.on_tick is not None and time.monotonic() - last_tick >= self.tick_interval:
+                last_tick = time.monotonic()
+                try:
+                    self.on_tick()
+                except Exception as e:
+                    self.write("ERROR", f"Log writer tick failed: {e}")
+
+    def _drain(self):
+        pending = self._pending
+        while pending:
+            lines, console, waiters = [], [], []
+            while pending and len(lines) < self.batch_lines:
+                record = pending.popleft()
+                if isinstance(record, threading.Event):
+                    waiters.append(record)
+                    continue
+                created, level, message, exc_text, fields = record
+                if self.structured:
+                    lines.append(self._json_line(created, level, message, exc_text, fields))
+                else:
+                    if fields:
+                        message = f"{message} | " + " ".join(f"{key}={value}" for key, value in fields.items()
+                                                             if value is not None)
+                    lines.append(f"[{level}] {datetime.fromtimestamp(created)} - {message}\n")
+                    if exc_text:
+                        lines.append(exc_text + "\n")
+                if self.echo:
+                    console.append(f"[{level}] {message}\n")
+                    if exc_text and self.echo_tracebacks:
+                        console.append(exc_text + "\n")
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(f"[WARNING] {datetime.now()} - {dropped} log line(s) dropped, the writer fell behind\n")
+            if lines:
+                self._write_file("".join(lines))
+                self.written += len(lines)
+                self.batches += 1
+            if console:
+                self._write_console("".join(console))
+            for waiter in waiters:
+                waiter.set()
+
+    @staticmethod
+    def _json_line(created, level, message, exc_text, fields):
+        document = {"ts": datetime.fromtimestamp(created).isoformat(), "level": level, "msg": message}
+        if fields:
+            document.update((key, value) for key, value in fields.items() if value is not None)
+        if exc_text:
+            document["exc"] = exc_text
+        return json.dumps(document, ensure_ascii=False, default=str) + "\n"
+
+    def _write_file(self, text):
+        try:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, "ab")
+                self._size = self._file.tell()
+            data = text.encode("utf-8")
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._rotate()
+        except OSError as e:
+            print(f"[ERROR] Cannot write log file {self.path}: {e}", file=sys.stderr)
+            self._file = None
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backups > 0:
+            for number in range(self.backups - 1, 0, -1):
+                source = f"{self.path}.{number}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{number + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            open(self.path, "w").close()
+        self.rotations += 1
+
+    @staticmethod
+    def _write_console(text):
+        stream = sys.stdout
+        if stream is None:
+            return
+        try:
+            stream.write(text)
+            stream.flush()
+        except (OSError, ValueError, UnicodeEncodeError):
+            pass # Closed or unencodable console: the file still has the lines
+
+
+class Logger:
+    """Level gate, lazy formatting, sampling and runtime settings in front of a LogWriter."""
+
+    def __init__(self, writer, level="INFO", log_format="text", sample=None, config_path=None):
+        self.writer = writer
+        self.threshold = INFO
+        self.sample = {}
+        self._sample_counters = {}
+        self._defaults = {"level": level, "format": log_format, "sample": dict(sample or {})}
+        self.configure(level, log_format, sample or {})
+        self.config_path = config_path
+        self._config_mtime = None
+        if config_path:
+            self.reload_config()
+            writer.on_tick = self.reload_config
+
+    def enabled(self, level):
+        """True if records of level (e.g. DEBUG) are kept; guard costly arguments with it."""
+        return level >= self.threshold
+
+    def log(self, level, level_name, message, args=(), exc_info=False, fields=None):
+        if level < self.threshold:
+            return
+        if fields:
+            rate = self.sample.get(fields.get("event"))
+            if rate is not None and rate > 1:
+                counter = self._sample_counters.get(fields["event"])
+                if counter is None:
+                    counter = self._sample_counters.setdefault(fields["event"], itertools.count())
+                if next(counter) % rate:
+                    return
+                fields["sampled"] = rate
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = f"{message} {args!r}"
+        self.writer.write(level_name, message, traceback.format_exc() if exc_info else None, fields or None)
+
+    def configure(self, level=None, log_format=None, sample=None):
+        """Changes the settings given (the others stay). sample replaces the whole event -> rate mapping."""
+        if level is not None:
+            if str(level).upper() not in LEVELS:
+                raise ValueError(f"Unknown log level {level!r}")
+            self.threshold = LEVELS[str(level).upper()]
+        if log_format is not None:
+            if log_format not in ("text", "json"):
+                raise ValueError(f"Unknown log format {log_format!r}")
+            self.writer.structured = log_format == "json"
+        if sample is not None:
+            self.sample = {str(event): int(rate) for event, rate in sample.items()}
+
+    def settings(self):
+        names = {value: name for name, value in LEVELS.items()}
+        return {"level": names.get(self.threshold, self.threshold),
+                "format": "json" if self.writer.structured else "text", "sample": dict(self.sample)}
+
+    def reload_config(self):
+        """Applies config_path if it changed since the last call (the defaults if it was removed)."""
+        try:
+            mtime = os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._config_mtime:
+            return
+        self._config_mtime = mtime
+        settings = dict(self._defaults)
+        if mtime is not None:
+            try:
+                with open(self.config_path, encoding="utf-8") as f:
+                    overrides = json.load(f)
+                settings.update({key: overrides[key] for key in ("level", "format", "sample") if key in overrides})
+            except (OSError, ValueError) as e:
+                self.writer.write("ERROR", f"Ignoring log config {self.config_path}: {e}")
+                return
+        try:
+            self.configure(settings["level"], settings["format"], settings["sample"])
+        except (ValueError, TypeError, AttributeError) as e:
+            self.writer.write("ERROR", f"Ignoring log config {self.config_path}: {e}")
+            return
+        self.writer.write("INFO", f"Log settings: {self.settings()}")
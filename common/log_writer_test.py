@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from common.log_writer import LogWriter, Logger, DEBUG, INFO
+
+
+class TestLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "logs", "test.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def read(self, path=None):
+        with open(path or self.path, encoding="utf-8") as f:
+            return f.read().splitlines()
+
+    def test_flush_writes_records_in_order(self):
+        writer = LogWriter(self.path, echo=False, flush_interval=60)
+        for i in range(2500):
+            writer.write("INFO", f"line {i}")
+        writer.write("ERROR", "failed", "Traceback: boom")
+        self.assertTrue(writer.flush())
+        lines = self.read()
+        self.assertEqual(len(lines), 2502)
+        self.assertTrue(lines[0].startswith("[INFO] ") and lines[0].endswith(" - line 0"))
+        self.assertTrue(lines[2499].endswith(" - line 2499"))
+        self.assertTrue(lines[2500].startswith("[ERROR] ") and lines[2500].endswith(" - failed"))
+        self.assertEqual(lines[2501], "Traceback: boom")
+        writer.close()
+
+    def test_rotation_keeps_backups(self):
+        writer = LogWriter(self.path, max_bytes=2000, backups=2, echo=False, batch_lines=10)
+        for i in range(300):
+            writer.write("INFO", f"line {i:04d} " + "x" * 40)
+            if i % 10 == 9:
+                writer.flush()
+        writer.close()
+        self.assertGreater(writer.rotations, 2)
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+        # The newest line is in the current file, or in .1 if the last write rotated it
+        newest = self.read() if os.path.exists(self.path) else self.read(self.path + ".1")
+        self.assertTrue(newest[-1].endswith("line 0299 " + "x" * 40))
+        self.assertLessEqual(os.path.getsize(self.path + ".1"), 2000 + 10 * 100) # At most one batch over
+
+    def test_no_backups_truncates(self):
+        writer = LogWriter(self.path, max_bytes=500, backups=0, echo=False, batch_lines=5)
+        for i in range(100):
+            writer.write("INFO", "y" * 50)
+            writer.flush()
+        writer.close()
+        self.assertFalse(os.path.exists(self.path + ".1"))
+        self.assertLessEqual(os.path.getsize(self.path), 500 + 100)
+
+    def test_overflow_drops_and_reports(self):
+        writer = LogWriter(self.path, max_pending=10, echo=False, flush_interval=60)
+        writer._start = lambda: None # Keep the writer thread from draining meanwhile
+        for i in range(25):
+            writer.write("INFO", f"line {i}")
+        writer.close()
+        lines = self.read()
+        self.assertEqual(len(lines), 11)
+        self.assertIn("15 log line(s) dropped", lines[-1])
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.log")
+        self.writer = LogWriter(self.path, echo=False, flush_interval=60)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def read(self):
+        self.writer.flush()
+        with open(self.path, encoding="utf-8") as f:
+            return f.read().splitlines()
+
+    def test_disabled_level_is_not_formatted(self):
+        formatted = []
+
+        class Costly:
+            def __str__(self):
+                formatted.append(1)
+                return "costly"
+        logger = Logger(self.writer, "INFO")
+        logger.log(DEBUG, "DEBUG", "skipped %s", (Costly(),))
+        logger.log(INFO, "INFO", "kept %s", (Costly(),))
+        self.assertEqual(len(formatted), 1)
+        lines = self.read()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(" - kept costly"))
+
+    def test_sampling_and_json_fields(self):
+        logger = Logger(self.writer, "INFO", "json", sample={"get_user_status": 10})
+        for i in range(25):
+            logger.log(INFO, "INFO", "status %d", (i,), fields={"event": "get_user_status", "user": "Nga"})
+        logger.log(INFO, "INFO", "joined", fields={"event": "join_channel", "channel": "General"})
+        records = [json.loads(line) for line in self.read()]
+        self.assertEqual([r["msg"] for r in records], ["status 0", "status 10", "status 20", "joined"])
+        self.assertEqual(records[0]["sampled"], 10)
+        self.assertEqual(records[0]["user"], "Nga")
+        self.assertNotIn("sampled", records[3])
+        self.assertEqual(records[3]["channel"], "General")
+
+    def test_config_file_changes_settings_at_runtime(self):
+        config_path = os.path.join(self.directory, "log_config.json")
+        logger = Logger(self.writer, "INFO", config_path=config_path)
+        self.assertFalse(logger.enabled(DEBUG))
+        with open(config_path, "w") as f:
+            json.dump({"level": "DEBUG", "format": "json"}, f)
+        logger.reload_config()
+        self.assertTrue(logger.enabled(DEBUG))
+        self.assertTrue(self.writer.structured)
+        os.remove(config_path)
+        logger.reload_config()
+        self.assertEqual(logger.settings(), {"level": "INFO", "format": "text", "sample": {}})
+
+
+if __name__ == "__main__":
+    unittest.main()
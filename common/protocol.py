@@ -0,0 +1,165 @@
+"""Wire protocol selection and per-connection encoding/decoding.
+
+Every connection starts in the newline-delimited JSON protocol ("json"). A
+client that supports the binary protocol lists it in the "protocols" field of
+its auth request, e.g. {"type": "auth", ..., "protocols": ["bin1", "json"]}.
+The server answers that auth request in JSON with the chosen protocol in
+"protocol"; from the next frame on both directions use it. Servers that do not
+know the field ignore it and clients that never send it stay on JSON.
+
+"bin1" frames are a 4-byte big-endian length followed by one codec byte and the
+encoded payload:
+    0x01  MessagePack (common/codec.py)
+    0x02  UTF-8 JSON text
+"""
+import json
+
+from common import codec
+from common.framing import (
+    NDJSONFramer, BinaryFramer, MAX_FRAME_SIZE, LENGTH_PREFIX, encode_json, decode_json, encode_length_prefixed,
+)
+
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "bin1"
+SUPPORTED_PROTOCOLS = (PROTOCOL_BINARY, PROTOCOL_JSON) # Preference order
+
+CODEC_MSGPACK = 0x01
+CODEC_JSON = 0x02
+
+
+class ProtocolError(ValueError):
+    """Raised for frames that cannot be decoded in the connection's protocol."""
+
+
+def negotiate(offered, accepted=SUPPORTED_PROTOCOLS):
+    """Picks the first protocol in `accepted` that the peer offered. Falls back to JSON."""
+    if not isinstance(offered, (list, tuple)):
+        return PROTOCOL_JSON
+    for protocol in accepted:
+        if protocol in offered:
+            return protocol
+    return PROTOCOL_JSON
+
+
+def encode_message(obj, protocol=PROTOCOL_JSON):
+    """Serializes obj as one complete frame for the given protocol."""
+    if protocol == PROTOCOL_BINARY:
+        return encode_length_prefixed(bytes((CODEC_MSGPACK,)) + codec.pack(obj))
+    return encode_json(obj)
+
+
+def encode_json_frame(json_bytes, protocol=PROTOCOL_JSON):
+    """Frames already serialized JSON text (without trailing newline) for the given protocol."""
+    if protocol == PROTOCOL_BINARY:
+        return encode_length_prefixed(bytes((CODEC_JSON,)) + json_bytes)
+    return json_bytes + b"\n"
+
+
+def encode_json_frame_parts(parts, protocol=PROTOCOL_JSON):
+    """Like encode_json_frame for JSON text given as a list of bytes-like parts.
+
+    The parts (e.g. memoryviews of stored records) are copied once, into the frame.
+    """
+    if protocol == PROTOCOL_BINARY:
+        length = sum(len(part) for part in parts) + 1
+        return b"".join([LENGTH_PREFIX.pack(length), bytes((CODEC_JSON,))] + parts)
+    return b"".join(parts + [b"\n"])
+
+
+def add_fields(frame, fields, protocol=PROTOCOL_JSON):
+    """Returns an encoded frame of a map message with the entries of fields added.
+
+    Used to tag already encoded replies (e.g. cached ones) without decoding them.
+    The keys must not be in the message yet.
+    """
+    if protocol != PROTOCOL_BINARY:
+        return _add_json_fields(frame[:-1], fields) + b"\n"
+    payload = memoryview(frame)[LENGTH_PREFIX.size:]
+    if not payload:
+        raise ProtocolError("Empty binary frame")
+    if payload[0] == CODEC_JSON:
+        return encode_length_prefixed(bytes((CODEC_JSON,)) + _add_json_fields(bytes(payload[1:]), fields))
+    if payload[0] != CODEC_MSGPACK:
+        raise ProtocolError(f"Unknown codec id 0x{payload[0]:02x}")
+    body = payload[1:]
+    marker = body[0]
+    if 0x80 <= marker <= 0x8F:
+        count, header_size = marker & 0x0F, 1
+    elif marker == 0xDE:
+        count, header_size = int.from_bytes(body[1:3], "big"), 3
+    elif marker == 0xDF:
+        count, header_size = int.from_bytes(body[1:5], "big"), 5
+    else:
+        raise ProtocolError("Frame does not hold a map")
+    count += len(fields)
+    if count < 16:
+        header = bytes((0x80 | count,))
+    elif count < 0x10000:
+        header = b"\xde" + count.to_bytes(2, "big")
+    else:
+        header = b"\xdf" + count.to_bytes(4, "big")
+    entries = b"".join(codec.pack(key) + codec.pack(value) for key, value in fields.items())
+    return encode_length_prefixed(b"".join((bytes((CODEC_MSGPACK,)), header, body[header_size:], entries)))
+
+
+def _add_json_fields(json_bytes, fields):
+    """JSON text of an object with the entries of fields appended before its closing brace."""
+    extra = json.dumps(fields)[1:-1].encode("utf-8")
+    head = json_bytes.rstrip()[:-1].rstrip() # Without "}"
+    separator = b"" if head.endswith(b"{") else b", "
+    return head + separator + extra + b"}"
+
+
+def decode_message(frame, protocol=PROTOCOL_JSON):
+    """Parses one frame produced by the peer's framer. Raises ValueError on bad input."""
+    if protocol != PROTOCOL_BINARY:
+        return decode_json(frame)
+    if not frame:
+        raise ProtocolError("Empty binary frame")
+    codec_id = frame[0]
+    if codec_id == CODEC_MSGPACK:
+        return codec.unpack(frame[1:])
+    if codec_id == CODEC_JSON:
+        return json.loads(frame[1:])
+    raise ProtocolError(f"Unknown codec id 0x{codec_id:02x}")
+
+
+def _framer_for(protocol, max_frame_size):
+    if protocol == PROTOCOL_BINARY:
+        return BinaryFramer(max_frame_size)
+    return NDJSONFramer(max_frame_size)
+
+
+class WireDecoder:
+    """Turns one connection's byte stream into messages.
+
+    Frames are extracted lazily with next_frame(), so when a message switches the
+    connection to another protocol the bytes behind it are re-framed correctly.
+    """
+
+    def __init__(self, protocol=PROTOCOL_JSON, max_frame_size=MAX_FRAME_SIZE):
+        self.protocol = protocol
+        self.max_frame_size = max_frame_size
+        self.framer = _framer_for(protocol, max_frame_size)
+
+    def feed(self, data):
+        self.framer.append(data)
+
+    def next_frame(self):
+        """Next complete frame or None. May raise FrameTooLarge."""
+        return self.framer.next_frame()
+
+    def decode(self, frame):
+        return decode_message(frame, self.protocol)
+
+    def set_protocol(self, protocol):
+        """Switches framing; bytes already received but not framed are carried over."""
+        if protocol == self.protocol:
+            return
+        leftover = self.framer.take_buffer()
+        self.framer = _framer_for(protocol, self.max_frame_size)
+        self.framer.append(leftover)
+        self.protocol = protocol
+
+    def buffered(self):
+        return self.framer.buffered()
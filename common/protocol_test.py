@@ -0,0 +1,122 @@
+import unittest
+
+from common import codec
+from common.protocol import (
+    WireDecoder, add_fields, decode_message, encode_message, encode_json_frame, encode_json_frame_parts, negotiate, PROTOCOL_BINARY, PROTOCOL_JSON,
+)
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        values = [
+            None, True, False, 0, 127, 128, -1, -32, -33, 65535, 65536, 2 ** 40, -2 ** 40, 1.5,
+            "", "x" * 31, "y" * 32, "z" * 300, "w" * 70000, "Xin chào", b"\x00\x01", [], list(range(20)),
+            {"status": "success", "messages": [{"username": "Nga", "message": "Hiii", "port": 5001}]},
+            {str(i): i for i in range(20)},
+        ]
+        for value in values:
+            self.assertEqual(codec.unpack(codec.pack(value)), value)
+
+    def test_known_encoding(self):
+        # Byte-for-byte MessagePack so peers using the msgpack package interoperate
+        self.assertEqual(codec.pack({"a": 1}), b"\x81\xa1a\x01")
+        self.assertEqual(codec.pack([None, True, -1]), b"\x93\xc0\xc3\xff")
+
+    def test_truncated_data_raises(self):
+        with self.assertRaises(codec.CodecError):
+            codec.unpack(codec.pack({"message": "hello"})[:-2])
+
+
+# What the msgpack package (packb(value, use_bin_type=True)) produces for each value
+MSGPACK_ENCODINGS = [
+    (127, "7f"), (128, "cc80"), (255, "ccff"), (256, "cd0100"), (65535, "cdffff"), (65536, "ce00010000"),
+    (2 ** 32 - 1, "ceffffffff"), (2 ** 32, "cf0000000100000000"), (2 ** 64 - 1, "cfffffffffffffffff"),
+    (-1, "ff"), (-32, "e0"), (-33, "d0df"), (-128, "d080"), (-129, "d1ff7f"), (-32768, "d18000"),
+    (-32769, "d2ffff7fff"), (-2 ** 31, "d280000000"), (-2 ** 31 - 1, "d3ffffffff7fffffff"),
+    (-2 ** 63, "d38000000000000000"),
+    (1.5, "cb3ff8000000000000"), (-0.0, "cb8000000000000000"), (1e300, "cb7e37e43c8800759c"),
+    (b"", "c400"), (b"\x00\xff", "c40200ff"), (b"\x01" * 256, "c50100" + "01" * 256),
+    ("x" * 31, "bf" + "78" * 31), ("x" * 32, "d920" + "78" * 32), ("é", "a2c3a9"),
+    (list(range(16)), "dc0010" + "".join(f"{i:02x}" for i in range(16))),
+    ({"a": [1, {"b": b"\x00"}, None, [-33, 2.0]]}, "81a1619401" + "81a162c40100" + "c0" + "92d0dfcb4000000000000000"),
+    ({f"k{i:02d}": i for i in range(16)}, "de0010" + "".join(f"a36b{ord(str(i // 10)):02x}{ord(str(i % 10)):02x}{i:02x}"
+                                                            for i in range(16))),
+]
+
+
+class TestPurePythonCodec(unittest.TestCase):
+    """The fallback used when the msgpack package is missing must match it byte for byte."""
+
+    def test_encodes_like_msgpack(self):
+        for value, expected in MSGPACK_ENCODINGS:
+            self.assertEqual(codec._pure_pack(value).hex(), expected, value)
+
+    def test_decodes_msgpack_output(self):
+        for value, encoded in MSGPACK_ENCODINGS:
+            self.assertEqual(codec._pure_unpack(bytes.fromhex(encoded)), value)
+        # Formats msgpack emits for other peers' data: float32, int8..int32 of positive values
+        self.assertEqual(codec._pure_unpack(bytes.fromhex("ca3fc00000")), 1.5)
+        self.assertEqual(codec._pure_unpack(bytes.fromhex("93d001d10100d200010000")), [1, 256, 65536])
+
+    def test_integers_outside_int64_and_uint64_are_refused(self):
+        for value in (2 ** 64, -2 ** 63 - 1):
+            with self.assertRaises(codec.CodecError):
+                codec._pure_pack(value)
+
+    def test_trailing_bytes_raise(self):
+        with self.assertRaises(codec.CodecError):
+            codec._pure_unpack(b"\x01\x02")
+
+    @unittest.skipIf(codec.msgpack is None, "msgpack is not installed")
+    def test_matches_the_installed_msgpack_package(self):
+        for value, _ in MSGPACK_ENCODINGS:
+            packed = codec.msgpack.packb(value, use_bin_type=True)
+            self.assertEqual(codec._pure_pack(value), packed, value)
+            self.assertEqual(codec._pure_unpack(packed), value)
+
+
+class TestWireDecoder(unittest.TestCase):
+    def test_negotiate(self):
+        self.assertEqual(negotiate(["bin1", "json"]), PROTOCOL_BINARY)
+        self.assertEqual(negotiate(["json"]), PROTOCOL_JSON)
+        self.assertEqual(negotiate(["bin1"], accepted=["json"]), PROTOCOL_JSON)
+        self.assertEqual(negotiate("bin1"), PROTOCOL_JSON)
+
+    def test_switch_protocol_keeps_following_bytes(self):
+        auth_reply = encode_message({"status": "success", "protocol": PROTOCOL_BINARY})
+        pushed = encode_message({"type": "channel", "action": "new_message"}, PROTOCOL_BINARY)
+        decoder = WireDecoder()
+        decoder.feed(auth_reply + pushed[:3]) # Binary frame arrives right behind the JSON reply
+        self.assertEqual(decoder.decode(decoder.next_frame())["protocol"], PROTOCOL_BINARY)
+        decoder.set_protocol(PROTOCOL_BINARY)
+        self.assertIsNone(decoder.next_frame())
+        decoder.feed(pushed[3:])
+        self.assertEqual(decoder.decode(decoder.next_frame())["action"], "new_message")
+
+    def test_binary_frame_with_json_codec(self):
+        decoder = WireDecoder(PROTOCOL_BINARY)
+        decoder.feed(encode_json_frame(b'{"seq": 7}', PROTOCOL_BINARY))
+        self.assertEqual(decoder.decode(decoder.next_frame()), {"seq": 7})
+
+    def test_json_frame_parts(self):
+        stored = memoryview(b'xx{"seq":1}{"seq":2}')
+        parts = [b'{"messages":[', stored[2:11], b",", stored[11:], b"]}"]
+        for protocol in (PROTOCOL_JSON, PROTOCOL_BINARY):
+            frame = encode_json_frame_parts(parts, protocol)
+            self.assertEqual(frame, encode_json_frame(b'{"messages":[{"seq":1},{"seq":2}]}', protocol))
+
+    def test_add_fields(self):
+        messages = [{}, {"status": "success"}, {str(i): i for i in range(15)}, {str(i): i for i in range(70000)}]
+        for protocol in (PROTOCOL_JSON, PROTOCOL_BINARY):
+            for message in messages:
+                frame = add_fields(encode_message(message, protocol), {"request_id": 7}, protocol)
+                decoder = WireDecoder(protocol)
+                decoder.feed(frame)
+                self.assertEqual(decoder.decode(decoder.next_frame()), dict(message, request_id=7))
+        frame = add_fields(encode_json_frame(b'{"status": "success"}', PROTOCOL_BINARY), {"request_id": 8},
+                           PROTOCOL_BINARY)
+        self.assertEqual(decode_message(frame[4:], PROTOCOL_BINARY), {"status": "success", "request_id": 8})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import threading
+from logger import log_error
+from shared import channel_subscribers, subscriptions_lock
+from sessions import sessions
+from outbound import send_frame
+from common.protocol import encode_message
+
+# Server-originated fanout (new messages, presence diffs, livestream events).
+# A broadcast serializes its payload once per wire protocol in use and queues the
+# very same immutable bytes object on every recipient's outbound queue, instead of
+# running json.dumps + encode for each recipient. Recipients come from the
+# channel -> sessions subscription index in shared.py, so the cost depends on the
+# channel's audience, not on the number of connected clients.
+
+
+class EncodedPayload:
+    """A push serialized at most once per protocol; the bytes are shared by all recipients."""
+    __slots__ = ("payload", "_frames", "_lock")
+
+    def __init__(self, payload):
+        self.payload = payload
+        self._frames = {} # Key: protocol, Value: bytes
+        self._lock = threading.Lock()
+
+    def frame(self, protocol):
+        data = self._frames.get(protocol)
+        if data is None:
+            with self._lock:
+                data = self._frames.get(protocol)
+                if data is None:
+                    data = encode_message(self.payload, protocol)
+                    self._frames[protocol] = data
+        return data
+
+
+# --- Subscription index ---
+def subscribe_client(client_socket, channel_name):
+    """Makes client_socket receive pushes for channel_name (replacing its previous channel)."""
+    session = sessions.get(client_socket)
+    if session is None:
+        return # Connection already closed
+    with subscriptions_lock:
+        previous = session.channel
+        if previous == channel_name:
+            return
+        if previous is not None:
+            _discard(previous, session)
+        session.channel = channel_name
+        channel_subscribers.setdefault(channel_name, set()).add(session)
+
+def unsubscribe_client(client_socket):
+    """Removes the push subscription of client_socket (called when it disconnects)."""
+    session = sessions.get(client_socket)
+    if session is None:
+        return
+    with subscriptions_lock:
+        channel_name, session.channel = session.channel, None
+        if channel_name is not None:
+            _discard(channel_name, session)
+
+def _discard(channel_name, session):
+    subscribers = channel_subscribers.get(channel_name)
+    if subscribers is not None:
+        subscribers.discard(session)
+        if not subscribers:
+            del channel_subscribers[channel_name]
+
+def subscribers_of(channel_name):
+    """Snapshot of the sessions following channel_name."""
+    with subscriptions_lock:
+        return list(channel_subscribers.get(channel_name, ()))
+
+
+# --- Fanout ---
+def broadcast_to_channel(channel_name, payload, exclude_socket=None, key=None, coalesce_with=None):
+    """Queues payload as a push for every connection subscribed to the channel.
+
+    key / coalesce_with tell the outbound queues how to merge pushes for clients
+    that fall behind (see outbound.py). Returns the recipient count.
+    """
+    with subscriptions_lock:
+        recipients = channel_subscribers.get(channel_name)
+        if not recipients:
+            return 0
+        recipients = [session for session in recipients if session.sock is not exclude_socket]
+    encoded = EncodedPayload(payload)
+    coalesced = EncodedPayload(coalesce_with) if coalesce_with is not None else None
+    for session in recipients:
+        protocol = session.protocol
+        try:
+            send_frame(session.sock, encoded.frame(protocol), True, key,
+                       coalesced.frame(protocol) if coalesced is not None else None)
+        except Exception as e:
+            log_error(f"Failed to push to subscriber of '{channel_name}': {e}")
+    return len(recipients)
+
+def broadcast_new_message(channel_name, message_data, exclude_socket=None):
+    """Pushes a newly stored message to the channel's subscribers.
+
+    A subscriber too far behind gets one "resync" notice instead of the backlog and
+    fetches the missing messages with its sync cursor.
+    """
+    push = {"type": "channel", "action": "new_message", "channel_name": channel_name, "message_data": message_data}
+    resync = {"type": "channel", "action": "resync", "channel_name": channel_name}
+    return broadcast_to_channel(channel_name, push, exclude_socket, key=("messages", channel_name), coalesce_with=resync)
+
+def broadcast_presence(channel_name, username, state, exclude_socket=None):
+    """Pushes one presence diff for the channel's user list.
+
+    state is "online" or "offline" (the list the user is now in) or "left" (in
+    neither). Guests are never listed, so their changes are not pushed.
+    """
+    if sessions.role_of(username) == "guest":
+        return 0
+    push = {"type": "presence", "channel_name": channel_name, "username": username, "state": state}
+    # Diffs carry the user's whole state, so only the latest one per user matters
+    return broadcast_to_channel(channel_name, push, exclude_socket, key=("presence", channel_name, username))
@@ -1,66 +1,134 @@
 import json
-import os
-import threading
 import datetime
-from logger import log_info, log_error
-from shared import channel_users, user_status, user_roles  # Import danh sách người dùng và trạng thái người dùng
+from contextlib import contextmanager
+from logger import log_info, log_error, log_debug
+from config import CHANNELS_FLUSH_INTERVAL, CHANNELS_FLUSH_DIRTY_THRESHOLD, CHANNEL_STORAGE
+from config import MESSAGE_LOG_DIR, MESSAGE_LOG_SEGMENT_BYTES, MESSAGE_LOG_INDEX_INTERVAL, SQLITE_DB_FILE
+from config import GROUP_COMMIT, GROUP_COMMIT_INTERVAL_MS, GROUP_COMMIT_BATCH_SIZE
+from config import HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, HISTORY_CHUNK_MESSAGES, HISTORY_ZERO_COPY
+from channel_store import ChannelStore, JsonFileBackend
+from message_log import MessageLogBackend
+from repository import sqlite_repository
+from sessions import sessions  # Trạng thái và vai trò của người dùng đang kết nối
+from presence import set_channel_presence, channel_presence
+from history import history_page, seq_position, forget_channel
+from broadcast import subscribe_client, broadcast_new_message, broadcast_presence
+from outbound import send_message, send_stream, reply_later
+from response_cache import send_cached_response, bump_channel_version
+from common.protocol import encode_json_frame_parts
 # --- Constants and Lock ---
 CHANNELS_FILE = "server/channels.json"
-channels_lock = threading.Lock() # <--- Define the lock globally
 
-# --- File Operations (Thread-Safe) ---
-# Replace your existing load_channels with this one
+def create_storage_backend(storage=CHANNEL_STORAGE):
+    """Persistence for channel state, chosen by CHANNEL_STORAGE ("json", "log" or "sqlite")."""
+    # The log and sqlite backends import CHANNELS_FILE once, on their first start
+    if storage == "log":
+        return MessageLogBackend(MESSAGE_LOG_DIR, CHANNELS_FILE, MESSAGE_LOG_SEGMENT_BYTES, MESSAGE_LOG_INDEX_INTERVAL)
+    if storage == "sqlite":
+        return sqlite_repository(SQLITE_DB_FILE, legacy_channels_path=CHANNELS_FILE)
+    if storage != "json":
+        log_error(f"Unknown channel storage '{storage}', using 'json'.")
+    return JsonFileBackend(CHANNELS_FILE)
+
+# Channel state lives in memory (channel_store.py) and is written behind to the backend
+channel_store = ChannelStore(create_storage_backend(), CHANNELS_FLUSH_INTERVAL, CHANNELS_FLUSH_DIRTY_THRESHOLD,
+                             GROUP_COMMIT, GROUP_COMMIT_INTERVAL_MS / 1000, GROUP_COMMIT_BATCH_SIZE)
+channels_lock = channel_store.lock # Held while adding or removing channels
+
+# --- Channel State (Thread-Safe) ---
 def load_channels():
-    """Loads channel data from the JSON file (thread-safe)."""
-    with channels_lock: # Acquire lock before file access
-        try:
-            # Ensure the directory exists
-            os.makedirs(os.path.dirname(CHANNELS_FILE), exist_ok=True)
-            with open(CHANNELS_FILE, "r") as file:
-                data = json.load(file)
-                # Basic validation
-                if "channels" not in data or not isinstance(data.get("channels"), dict):
-                    log_error(f"Invalid structure in {CHANNELS_FILE}. Resetting.")
-                    return {"channels": {}}
-                return data
-        except FileNotFoundError:
-            log_info(f"{CHANNELS_FILE} not found. Creating default structure.")
-            return {"channels": {}} # Return default structure if file doesn't exist
-        except json.JSONDecodeError as e:
-            log_error(f"Error decoding JSON from {CHANNELS_FILE}: {e}. Returning default.")
-            return {"channels": {}}
-        except Exception as e:
-            log_error(f"Unexpected error loading channels: {e}", exc_info=True)
-            return {"channels": {}}
-
-# Replace your existing save_channels with this one
-def save_channels(channels):
-    """Saves channel data to the JSON file (thread-safe)."""
-    with channels_lock: # Acquire lock before file access
-        try:
-            # Ensure the directory exists
-            os.makedirs(os.path.dirname(CHANNELS_FILE), exist_ok=True)
-            with open(CHANNELS_FILE, "w") as file:
-                json.dump(channels, file, indent=4)
-                file.flush() # Ensure data is written immediately
-        except Exception as e:
-            log_error(f"Error saving channels to {CHANNELS_FILE}: {e}", exc_info=True)
+    """Returns the in-memory channel state, read from the storage backend on first use.
+
+    The returned dict is live. Add or remove channels under channels_lock, change a
+    channel inside locked_channel(), and call save_channels() after a change.
+    Readers take no lock (see channel_store.py).
+    """
+    return channel_store.load()
+
+@contextmanager
+def locked_channel(channel_name, create=None):
+    """Holds the lock of one channel and yields its live data (None if it does not exist).
+
+    If create is given, a missing channel is added with that data first. Writers of
+    other channels are not blocked.
+    """
+    channels = load_channels()["channels"]
+    while True:
+        channel_data = channels.get(channel_name)
+        if channel_data is None and create is not None:
+            with channels_lock:
+                channel_data = channels.get(channel_name)
+                if channel_data is None:
+                    channel_data = channels[channel_name] = create
+                    log_info(f"Implicitly created '{channel_name}' channel.")
+        with channel_store.channel_lock(channel_name):
+            if channels.get(channel_name) is channel_data: # Not deleted or recreated meanwhile
+                channel_store.touch(channel_name) # The next flush copies this channel again
+                try:
+                    yield channel_data
+                finally:
+                    bump_channel_version(channel_name) # Cached replies of the channel are stale now
+                return
 
-def send_response(client_socket, response_data, addr=None):
-    """Sends a JSON response to the client."""
-    try:
-        # Ensure addr is a string for logging if provided
-        addr_str = f"{addr}" if addr else "Unknown Address"
-        # Use sendall and add a newline character as a delimiter
-        client_socket.sendall((json.dumps(response_data) + "\n").encode('utf-8'))
-        # log_info(f"Sent response to {addr_str}: {response_data}") # Optional
-    except Exception as e:
-        log_error(f"Failed to send response to {addr_str if addr else 'Unknown Address'}: {e}")
+def save_channels(channels):
+    """Marks the channel state changed; the store's writer persists it in the background.
+
+    Returns a ticket for when_saved().
+    """
+    if channels is not channel_store.data:
+        return channel_store.replace(channels)
+    return channel_store.mark_dirty()
+
+def when_saved(ticket, callback):
+    """Group commit: runs callback() once the change behind ticket is durable, without blocking the caller."""
+    channel_store.when_durable(ticket, callback)
+
+def flush_channels():
+    """Writes pending channel changes to the storage backend now (used at shutdown)."""
+    channel_store.close()
+    if channel_store.group_commit:
+        log_info(f"Group commit stats: {channel_store.commit_stats()}")
+
+# --- Message Sequence Numbers ---
+# Every stored channel message carries "seq", a per-channel counter starting at 1
+# in the order messages were stored. Message lists are kept in that order (never
+# re-sorted), so message i of a list has seq i + 1 and "everything after cursor
+# N" is simply messages[N:]. The last assigned number is kept in "last_seq".
+def ensure_message_seqs(channel_data):
+    """Numbers the messages of a channel stored before sequence numbers existed."""
+    messages_list = channel_data.get("messages")
+    if not isinstance(messages_list, list):
+        messages_list = []
+        channel_data["messages"] = messages_list
+    if "last_seq" not in channel_data:
+        for index, msg in enumerate(messages_list):
+            if isinstance(msg, dict):
+                msg["seq"] = index + 1
+        channel_data["last_seq"] = len(messages_list)
+    return messages_list
+
+def append_channel_message(channel_data, message_data):
+    """Stores message_data at the end of the channel with the next sequence number."""
+    messages_list = ensure_message_seqs(channel_data)
+    seq = channel_data["last_seq"] + 1
+    message_data["seq"] = seq
+    messages_list.append(message_data)
+    channel_data["last_seq"] = seq # Last: lock-free readers never see a seq that is not stored yet
+    return seq
+
+def messages_since(channel_data, since):
+    """Messages stored after cursor `since`, in storage order."""
+    messages_list = ensure_message_seqs(channel_data)
+    if since <= 0:
+        return list(messages_list) # Copy: the stored list keeps growing once the lock is released
+    if since <= len(messages_list) and messages_list[since - 1].get("seq") == since:
+        return messages_list[since:] # Contiguous numbering, direct slice
+    return [msg for msg in messages_list if isinstance(msg, dict) and msg.get("seq", 0) > since]
 
 # Hàm điều hướng yêu cầu liên quan đến channel (SỬA ĐỔI)
 def handle_channel_request(client_socket, data):
     response = None # Initialize response
-    addr_info = client_socket.getpeername() if client_socket and client_socket.fileno() != -1 else "Unknown Address"
+    addr_info = sessions.address_of(client_socket)
     try:
         # ... (parsing logic remains the same) ...
         if isinstance(data, bytes):
@@ -77,17 +145,21 @@ def handle_channel_request(client_socket, data):
         if action == "create_channel":
             response = create_channel(client_socket, request) # Should return dict
         elif action == "list_channels":
-            response = list_channels(client_socket) # Modify to return dict
+            response = list_channels(client_socket) # Returns dict
         elif action == "delete_channel":
-            response = delete_channel(client_socket, request) # Modify to return dict
+            response = delete_channel(client_socket, request) # Returns dict
         elif action == "join_channel":
             response = join_channel(client_socket, request) # Modify to return dict
         elif action == "save_message":
             response = save_message(client_socket, request, authenticated_user) # Already returns dict
         elif action == "sync_to_server":
-            response = handle_sync_to_server(client_socket, request) # Modify to return dict
+            response = handle_sync_to_server(client_socket, request) # Returns dict
         elif action == "sync_from_server":
-            response = handle_sync_from_server(client_socket, request) # Modify to return dict
+            response = handle_sync_from_server(client_socket, request) # Returns dict
+        elif action == "get_history":
+            response = handle_get_history(client_socket, request) # Returns dict
+        elif action == "subscribe":
+            response = handle_subscribe(client_socket, request) # Returns dict
         else:
             response = {"status": "error", "message": "Invalid channel action"}
 
@@ -116,17 +188,19 @@ def create_channel(client_socket, request):
         if not channel_name or not username:
             return {"status": "error", "message": "Channel name and username are required"}
 
-        channels = load_channels()
-        if channel_name in channels["channels"]:
-            return {"status": "error", "message": f"Channel '{channel_name}' already exists"}
-        else:
-            channels["channels"][channel_name] = {
-                "host": username,
-                "participants": [username],
-                "messages": []
-            }
-            save_channels(channels)
-            return {"status": "success", "message": f"Channel '{channel_name}' created successfully"}
+        with channels_lock:
+            channels = load_channels()
+            if channel_name in channels["channels"]:
+                return {"status": "error", "message": f"Channel '{channel_name}' already exists"}
+            else:
+                channels["channels"][channel_name] = {
+                    "host": username,
+                    "participants": [username],
+                    "messages": []
+                }
+                save_channels(channels)
+                bump_channel_version(channel_name)
+                return {"status": "success", "message": f"Channel '{channel_name}' created successfully"}
 
     except Exception as e:
         log_error(f"Error in create_channel: {e}")
@@ -140,51 +214,51 @@ def delete_channel(client_socket, request):
         username = request.get("username")  # Lấy thông tin người yêu cầu
         if not channel_name or not username:
             response = {"status": "error", "message": "Channel name and username are required"}
-            client_socket.send(json.dumps(response).encode('utf-8'))
-            return
-
-        channels = load_channels()
-
-        # Kiểm tra nếu "channels" không phải là từ điển
-        if not isinstance(channels["channels"], dict):
-            response = {"status": "error", "message": "Invalid channels data format"}
-            client_socket.send(json.dumps(response).encode('utf-8'))
-            return
-
-        # Kiểm tra nếu kênh tồn tại
-        if channel_name != "General" and channel_name not in channels["channels"]:
-            response = {"status": "error", "message": f"Channel '{channel_name}' does not exist"}
-            client_socket.send(json.dumps(response).encode('utf-8'))
-            return
-
-        # Kiểm tra nếu người yêu cầu là người tạo kênh
-        if channels["channels"][channel_name]["host"] != username:
-            response = {"status": "error", "message": "You do not have permission to delete the channel"}
-            client_socket.send(json.dumps(response).encode('utf-8'))
-            return
-
-        # Xóa kênh
-        del channels["channels"][channel_name]
-        save_channels(channels)
+            return response
+
+        with channels_lock:
+            channels = load_channels()
+
+            # Kiểm tra nếu "channels" không phải là từ điển
+            if not isinstance(channels["channels"], dict):
+                response = {"status": "error", "message": "Invalid channels data format"}
+                return response
+
+            # Kiểm tra nếu kênh tồn tại
+            if channel_name != "General" and channel_name not in channels["channels"]:
+                response = {"status": "error", "message": f"Channel '{channel_name}' does not exist"}
+                return response
+
+            # Kiểm tra nếu người yêu cầu là người tạo kênh
+            if channels["channels"][channel_name]["host"] != username:
+                response = {"status": "error", "message": "You do not have permission to delete the channel"}
+                return response
+
+            # Xóa kênh (sau khi người đang ghi vào kênh xong)
+            with channel_store.channel_lock(channel_name):
+                del channels["channels"][channel_name]
+                save_channels(channels)
+            forget_channel(channel_name)
+            bump_channel_version(channel_name)
         response = {"status": "success", "message": f"Channel '{channel_name}' deleted successfully"}
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        return response
     except Exception as e:
         response = {"status": "error", "message": str(e)}
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        return response
 # Hàm liệt kê danh sach các kênh
 def list_channels(client_socket):
     try:
         channels = load_channels()
         response = {
             "status": "success",
-            "channels": list(channels["channels"].keys())
+            "channels": list(channels["channels"]) # Atomic copy, no lock needed
         }
-        client_socket.send(json.dumps(response).encode('utf-8'))  # Gửi một phản hồi JSON duy nhất
-        log_info(f"Channels listed: {response}")
+        log_debug("Channels listed: %s", response)
+        return response # Một phản hồi JSON duy nhất
     except Exception as e:
         response = {"status": "error", "message": str(e)}
-        client_socket.send(json.dumps(response).encode('utf-8'))
         log_error(f"Error in list_channels: {e}")
+        return response
 
 def join_channel(client_socket, request): # Modified to return response dict
     try:
@@ -194,93 +268,64 @@ def join_channel(client_socket, request): # Modified to return response dict
         if not channel_name or not username:
             return {"status": "error", "message": "Channel name and username are required"}
 
-        channels = load_channels() # Thread-safe load
-
-        # Ensure "channels" key exists and is a dictionary
-        if "channels" not in channels or not isinstance(channels.get("channels"), dict):
-            log_error("Invalid or missing 'channels' structure in channels.json during join_channel")
-            channels["channels"] = {} # Attempt to initialize if missing
-
-        # Check if channel exists (allow "General" implicitly)
-        if channel_name != "General" and channel_name not in channels["channels"]:
-            return {"status": "error", "message": f"Channel '{channel_name}' does not exist"}
-
-        # Handle "General" channel creation if it doesn't exist
-        if channel_name == "General" and "General" not in channels["channels"]:
-            channels["channels"]["General"] = {
-                "host": "system", 
-                "participants": [],
-                "messages": []
-            }
-            log_info("Implicitly created 'General' channel during join_channel.")
-
-        channel_data = channels["channels"][channel_name]
-
-        user_joined_for_first_time = False
-        # Ensure participants list exists
-        if "participants" not in channel_data or not isinstance(channel_data["participants"], list):
-            channel_data["participants"] = []
+        channels = load_channels()
+        # "General" is created implicitly if it doesn't exist
+        general = {"host": "system", "participants": [], "messages": []} if channel_name == "General" else None
+        with locked_channel(channel_name, create=general) as channel_data:
+            # Check if channel exists
+            if channel_data is None:
+                return {"status": "error", "message": f"Channel '{channel_name}' does not exist"}
+
+            user_joined_for_first_time = False
+            # Ensure participants list exists
+            if "participants" not in channel_data or not isinstance(channel_data["participants"], list):
+                channel_data["participants"] = []
             
-        if username not in channel_data["participants"]:
-            channel_data["participants"].append(username)
-            user_joined_for_first_time = True # User is newly added to participants
-
-        # Add system message for user join if they are new to the channel's participant list
-        system_message_content = f"User '{username}' has joined the channel."
-        timestamp = datetime.datetime.utcnow().isoformat() + "Z"
-        if user_roles.get(username) != "guest":  # Check if the role is not 'guest'
-            system_message_data = {
-            "username": "System",
-            "message": system_message_content,
-            "timestamp": timestamp,
-            "event_type": "USER_JOINED_CHANNEL"
-            }
-            # Ensure messages list exists and is a list
-            messages_list = channel_data.setdefault("messages", [])
-            if not isinstance(messages_list, list): 
-                messages_list = []
-                channel_data["messages"] = messages_list
-                
-            messages_list.append(system_message_data)
-            messages_list.sort(key=lambda x: x.get('timestamp', '')) # Keep sorted
-            log_info(f"System message for '{username}' joining '{channel_name}' prepared.")
+            if username not in channel_data["participants"]:
+                channel_data["participants"].append(username)
+                user_joined_for_first_time = True # User is newly added to participants
+
+            # Add system message for user join if they are new to the channel's participant list
+            system_message_content = f"User '{username}' has joined the channel."
+            timestamp = datetime.datetime.utcnow().isoformat() + "Z"
+            if sessions.role_of(username) != "guest":  # Check if the role is not 'guest'
+                system_message_data = {
+                "username": "System",
+                "message": system_message_content,
+                "timestamp": timestamp,
+                "event_type": "USER_JOINED_CHANNEL"
+                }
+                append_channel_message(channel_data, system_message_data) # Kept in storage (seq) order
+                log_info(f"System message for '{username}' joining '{channel_name}' prepared.")
         
-        save_channels(channels) # Save updated participants and potentially the new system message
-
-        # Update channel_users (in-memory state for online/offline list)
-        if channel_name not in channel_users:
-            channel_users[channel_name] = {"online": [], "offline": []}
+            ticket = save_channels(channels) # Save updated participants and potentially the new system message
 
-        status = user_status.get(username, "offline") 
-
-        # Remove from the other list and add to the correct one
+        # Update channel presence (in-memory online/offline sets, presence.py)
+        status = sessions.status_of(username)
         # Treat invisible as online for channel presence regarding lists
-        if status == "online" or status == "invisible": 
-            if username in channel_users[channel_name].get("offline", []):
-                channel_users[channel_name]["offline"].remove(username)
-            if username not in channel_users[channel_name].get("online", []):
-                channel_users[channel_name].setdefault("online", []).append(username)
-        else: # offline
-            if username in channel_users[channel_name].get("online", []):
-                channel_users[channel_name]["online"].remove(username)
-            if username not in channel_users[channel_name].get("offline", []):
-                channel_users[channel_name].setdefault("offline", []).append(username)
-        
-        # Ensure no duplicates
-        if "online" in channel_users[channel_name]:
-            channel_users[channel_name]["online"] = list(set(channel_users[channel_name]["online"]))
-        if "offline" in channel_users[channel_name]:
-            channel_users[channel_name]["offline"] = list(set(channel_users[channel_name]["offline"]))
+        is_online = status == "online" or status == "invisible"
+        set_channel_presence(channel_name, username, is_online)
+        broadcast_presence(channel_name, username, "online" if is_online else "offline",
+                           exclude_socket=client_socket)
+        online_users, offline_users = channel_presence(channel_name)
 
         log_info(f"User '{username}' joined channel '{channel_name}'. In-memory status updated.")
+
+        # Follow the channel from now on and tell the members already in it about the join,
+        # once the system message is on disk (group commit), like save_message
+        subscribe_client(client_socket, channel_name)
+        if sessions.role_of(username) != "guest":
+            when_saved(ticket, lambda: broadcast_new_message(channel_name, system_message_data,
+                                                             exclude_socket=client_socket))
         
         return { 
             "status": "success",
             "message": f"User '{username}' joined channel '{channel_name}' successfully",
+            "push": True, # New messages of this channel are pushed to this connection
             "owner": channel_data.get("host", "system"), 
             "user_list": { 
-                "online": channel_users[channel_name].get("online", []),
-                "offline": channel_users[channel_name].get("offline", [])
+                "online": online_users,
+                "offline": offline_users
             }
         }
 
@@ -291,9 +336,18 @@ def join_channel(client_socket, request): # Modified to return response dict
 def send_response(client_socket, response_data, addr=None):
     """Sends a JSON response to the client."""
     try:
-        client_socket.sendall((json.dumps(response_data) + "\n").encode('utf-8')) # Use sendall and newline
+        send_message(client_socket, response_data) # Framed in the protocol negotiated for this connection
     except Exception as e:
         log_error(f"Failed to send response to {addr}: {e}")
+
+def handle_subscribe(client_socket, request):
+    """Explicit subscription, e.g. when the client switches back to a channel it already joined."""
+    channel_name = request.get("channel_name")
+    if not channel_name:
+        return {"status": "error", "message": "Channel name is required"}
+    subscribe_client(client_socket, channel_name)
+    return {"status": "success", "message": f"Subscribed to '{channel_name}'", "push": True}
+
 # Hàm lưu tin nhắn vào kênh
 def save_message(client_socket, request, authenticated_user):
     try:
@@ -308,7 +362,7 @@ def save_message(client_socket, request, authenticated_user):
              # send_response(client_socket, response) // DO NOT SEND HERE
              return response 
 
-        current_user_status = user_status.get(username, "offline") 
+        current_user_status = sessions.status_of(username)
         if current_user_status not in ["online", "invisible"]:
             log_error(f"User '{username}' attempted to send message while server status is '{current_user_status}'")
             response = {"status": "error", "message": f"Cannot send messages while status is '{current_user_status}'"}
@@ -321,48 +375,38 @@ def save_message(client_socket, request, authenticated_user):
             return response 
 
         channels = load_channels()
-        if "channels" not in channels or not isinstance(channels.get("channels"), dict):
-             log_error("Invalid or missing 'channels' structure in channels.json")
-             channels = {"channels": {}} 
-
-        channel_data = channels.get("channels", {}).get(channel_name)
-
-        if not channel_data:
-            if channel_name == "General":
-                 if "General" not in channels.get("channels", {}):
-                      channels.setdefault("channels", {})["General"] = {"owner": "system", "participants": [], "messages": []}
-                      log_info("Implicitly created 'General' channel during save_message.")
-                 channel_data = channels["channels"]["General"]
-            else:
-                 log_error(f"User '{username}' tried saving message to non-existent channel '{channel_name}'.")
-                 response = {"status": "error", "message": f"Channel '{channel_name}' does not exist"}
-                 # send_response(client_socket, response) // DO NOT SEND HERE
-                 return response 
-
-        messages_list = channel_data.setdefault("messages", [])
-        if not isinstance(messages_list, list):
-            log_error(f"Correcting invalid 'messages' type for channel '{channel_name}'.")
-            messages_list = []
-            channel_data["messages"] = messages_list
-
-        timestamp = datetime.datetime.utcnow().isoformat() + "Z" 
-        message_data = {
-            "username": username,
-            "message": message_text,
-            "timestamp": timestamp
-        }
+        general = {"owner": "system", "participants": [], "messages": []} if channel_name == "General" else None
+        with locked_channel(channel_name, create=general) as channel_data:
+            if channel_data is None:
+                log_error(f"User '{username}' tried saving message to non-existent channel '{channel_name}'.")
+                response = {"status": "error", "message": f"Channel '{channel_name}' does not exist"}
+                # send_response(client_socket, response) // DO NOT SEND HERE
+                return response 
+
+            if not isinstance(channel_data.get("messages", []), list):
+                log_error(f"Correcting invalid 'messages' type for channel '{channel_name}'.")
+
+            timestamp = datetime.datetime.utcnow().isoformat() + "Z" 
+            message_data = {
+                "username": username,
+                "message": message_text,
+                "timestamp": timestamp
+            }
 
-        messages_list.append(message_data)
-        save_channels(channels)
+            append_channel_message(channel_data, message_data)
+            ticket = save_channels(channels)
 
         response = {"status": "success", "message": "Message saved successfully", "message_data": message_data}
-        # send_response(client_socket, response) // REMOVE THIS LINE
-        log_info(f"Message saved for '{username}' in '{channel_name}'.") 
 
-        # --- TODO: Broadcast message_data to other online/invisible users in the channel ---
-        # broadcast_message(channel_name, message_data, sender_socket=client_socket)
+        def acknowledge():
+            # Reply (and push) only once the message's batch is on disk
+            send_response(client_socket, response)
+            log_info("Message saved for '%s' in '%s'.", username, channel_name)
+            # Push the stored message to the other connections following this channel
+            broadcast_new_message(channel_name, message_data, exclude_socket=client_socket)
 
-        return response 
+        when_saved(ticket, reply_later(acknowledge)) # Echoes this request's request_id, if any
+        return None # Sent by acknowledge()
 
     except Exception as e:
         log_error(f"Error in save_message: {e}", exc_info=True)
@@ -372,49 +416,41 @@ def save_message(client_socket, request, authenticated_user):
         # except Exception as send_e:
             # log_error(f"Failed to send error response during save_message: {send_e}")
         return response 
-def save_system_message(channel_name, message_data):
-    """Saves a system-generated message/notification to a channel (thread-safe)."""
+def save_system_message(channel_name, message_data, on_saved=None):
+    """Saves a system-generated message/notification to a channel (thread-safe).
+
+    Does not wait for the write: on_saved(), if given, runs once the message is
+    durable, like the reply of save_message. Returns False if it was not stored.
+    """
     if not channel_name or not isinstance(message_data, dict):
         log_error(f"Invalid input for save_system_message: channel='{channel_name}', data='{message_data}'")
         return False # Indicate failure
 
     try:
-        # Use the thread-safe load_channels function
         channels = load_channels()
-        # Ensure "channels" key exists and is a dictionary
-        if "channels" not in channels or not isinstance(channels.get("channels"), dict):
-             log_error("Invalid or missing 'channels' structure in channels.json during system save")
-             channels = {"channels": {}} # Reset to avoid further errors
-
-        channel_data = channels.get("channels", {}).get(channel_name)
-
         # Check if channel exists or handle 'General' implicitly
-        if not channel_data:
-            if channel_name == "General":
-                 if "General" not in channels.get("channels", {}):
-                      channels.setdefault("channels", {})["General"] = {"owner": "system", "participants": [], "messages": []}
-                      log_info("Implicitly created 'General' channel during save_system_message.")
-                 channel_data = channels["channels"]["General"]
-            else:
-                 log_error(f"Attempted to save system message to non-existent channel '{channel_name}'.")
-                 return False # Indicate failure
+        general = {"owner": "system", "participants": [], "messages": []} if channel_name == "General" else None
+        with locked_channel(channel_name, create=general) as channel_data:
+            if channel_data is None:
+                log_error(f"Attempted to save system message to non-existent channel '{channel_name}'.")
+                return False # Indicate failure
+
+            if not isinstance(channel_data.get("messages", []), list):
+                log_error(f"Correcting invalid 'messages' type for channel '{channel_name}' during system save.")
 
-        # Ensure messages list exists and is a list
-        messages_list = channel_data.setdefault("messages", [])
-        if not isinstance(messages_list, list):
-            log_error(f"Correcting invalid 'messages' type for channel '{channel_name}' during system save.")
-            messages_list = []
-            channel_data["messages"] = messages_list
+            # Add the system message (timestamp should already be in message_data).
+            # Lists stay in storage order; clients order by timestamp when displaying.
+            append_channel_message(channel_data, message_data)
 
-        # Add the system message (timestamp should already be in message_data)
-        messages_list.append(message_data)
+            # Use the thread-safe save_channels function
+            ticket = save_channels(channels)
 
-        # Sort messages by timestamp after adding (optional but good practice)
-        messages_list.sort(key=lambda x: x.get('timestamp', ''))
+        def saved():
+            log_info(f"System message saved to channel '{channel_name}'.")
+            if on_saved is not None:
+                on_saved()
 
-        # Use the thread-safe save_channels function
-        save_channels(channels)
-        log_info(f"System message saved to channel '{channel_name}'.")
+        when_saved(ticket, reply_later(saved)) # Echoes the current request_id in replies on_saved() sends
         return True # Indicate success
 
     except Exception as e:
@@ -427,44 +463,47 @@ def handle_sync_to_server(client_socket, request):
 
     if not channel_name or not isinstance(messages_to_sync, list): # Check if messages is a list
         response = {"status": "error", "message": "Channel name and a list of messages are required"}
-        client_socket.send(json.dumps(response).encode('utf-8'))
-        return
+        return response
     try:
         channels = load_channels()
-
-        if channel_name not in channels.get("channels", {}):
-             # If channel doesn't exist on server, reject sync or auto-create (rejecting for now)
-             response = {"status": "error", "message": f"Channel '{channel_name}' does not exist on server"}
-             client_socket.send(json.dumps(response).encode('utf-8'))
-             log_error(f"Sync failed: Channel '{channel_name}' does not exist.")
-             return
-
-        # Use timestamps for merging to avoid duplicates
-        # Create a set of existing timestamps for quick lookup
-        server_channel_messages = channels["channels"][channel_name].get("messages", [])
-        existing_timestamps = {msg['timestamp'] for msg in server_channel_messages if isinstance(msg, dict) and 'timestamp' in msg}
-
-        new_messages_added_count = 0
-        malformed_messages_count = 0
-
-        for msg in messages_to_sync:
-            # Validate message format and timestamp presence
-            if isinstance(msg, dict) and 'timestamp' in msg and 'username' in msg and 'message' in msg:
-                 msg_timestamp = msg['timestamp']
-                 if msg_timestamp not in existing_timestamps:
-                    server_channel_messages.append(msg)
-                    existing_timestamps.add(msg_timestamp) # Add new timestamp to the set
-                    new_messages_added_count += 1
-            else:
-                log_error(f"Invalid message format during sync for channel '{channel_name}': {msg}")
-                malformed_messages_count += 1
+        with locked_channel(channel_name) as channel_data:
+            if channel_data is None:
+                 # If channel doesn't exist on server, reject sync or auto-create (rejecting for now)
+                 response = {"status": "error", "message": f"Channel '{channel_name}' does not exist on server"}
+                 log_error(f"Sync failed: Channel '{channel_name}' does not exist.")
+                 return response
+
+            # Use timestamps for merging to avoid duplicates
+            # Create a set of existing timestamps for quick lookup
+            server_channel_messages = ensure_message_seqs(channel_data)
+            existing_timestamps = {msg['timestamp'] for msg in server_channel_messages if isinstance(msg, dict) and 'timestamp' in msg}
+
+            new_messages_added_count = 0
+            malformed_messages_count = 0
+            added_messages = []
+
+            for msg in messages_to_sync:
+                # Validate message format and timestamp presence
+                if isinstance(msg, dict) and 'timestamp' in msg and 'username' in msg and 'message' in msg:
+                     msg_timestamp = msg['timestamp']
+                     if msg_timestamp not in existing_timestamps:
+                        msg = dict(msg) # The client's cached seq (if any) is not ours
+                        append_channel_message(channel_data, msg)
+                        existing_timestamps.add(msg_timestamp) # Add new timestamp to the set
+                        new_messages_added_count += 1
+                        added_messages.append(msg)
+                else:
+                    log_error(f"Invalid message format during sync for channel '{channel_name}': {msg}")
+                    malformed_messages_count += 1
+
+            if new_messages_added_count > 0:
+                # Merged messages are appended with new seqs (not re-sorted) so cursors stay valid
+                save_channels(channels) # Save the updated channels data
 
         if new_messages_added_count > 0:
-            # Sort messages by timestamp after merging (important for consistency)
-            server_channel_messages.sort(key=lambda x: x.get('timestamp', ''))
-            channels["channels"][channel_name]["messages"] = server_channel_messages # Update the list in channels dict
-            save_channels(channels) # Save the updated channels data
             log_info(f"Synchronized {new_messages_added_count} new messages to channel '{channel_name}' from client.")
+            for msg in added_messages:
+                broadcast_new_message(channel_name, msg, exclude_socket=client_socket)
         else:
              log_info(f"No new messages to synchronize for channel '{channel_name}' from client.")
 
@@ -475,13 +514,64 @@ def handle_sync_to_server(client_socket, request):
             "status": "success",
             "message": f"Synchronization to server for '{channel_name}' complete. {new_messages_added_count} new messages added."
         }
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        return response
 
     except Exception as e:
         response = {"status": "error", "message": f"Internal server error during sync: {str(e)}"}
-        client_socket.send(json.dumps(response).encode('utf-8'))
         log_error(f"Error in handle_sync_to_server for channel '{channel_name}': {e}")
+        return response
+
 
+def _stored_history(channel_name, messages_list, start, end):
+    """(payload chunks, stop): messages [start, stop) as records mapped from the message log.
+
+    (None, start) unless the channel is stored in the log and those records are on disk.
+    """
+    backend = channel_store.backend
+    if not HISTORY_ZERO_COPY or not isinstance(backend, MessageLogBackend):
+        return None, start
+    log, written = backend.logged_records(channel_name, messages_list)
+    stop = min(end, written)
+    if log is None or stop <= start:
+        return None, start
+    try:
+        return log.payload_chunks(start, stop, HISTORY_CHUNK_MESSAGES), stop
+    except (OSError, ValueError) as e: # E.g. the channel's log was just deleted
+        log_error(f"Cannot map the message log of '{channel_name}', encoding its history instead: {e}")
+        return None, start
+
+def _history_chunks(channel_name, messages_list, start, end, final_response, protocol, stored=(None, 0)):
+    """Messages [start, end) of a channel as history_chunk pushes, then the reply that ends the stream.
+
+    stored is _stored_history(): those messages are framed from their records as
+    they are on disk, without being decoded and encoded again.
+    """
+    payload_chunks, stop = stored
+    if payload_chunks is not None:
+        head = json.dumps({"type": "channel", "action": "history_chunk", "channel_name": channel_name,
+                           "messages": []})[:-2].encode("utf-8") # Up to and including "["
+        for payloads in payload_chunks:
+            parts = [head]
+            for payload in payloads:
+                if payload[0] == 0x7B: # "{": only dict messages, as below
+                    parts += (payload, b",")
+            if len(parts) > 1:
+                parts[-1] = b"]}"
+                yield encode_json_frame_parts(parts, protocol)
+        start = stop
+    for first in range(start, end, HISTORY_CHUNK_MESSAGES):
+        chunk = messages_list[first:min(end, first + HISTORY_CHUNK_MESSAGES)]
+        yield {"type": "channel", "action": "history_chunk", "channel_name": channel_name,
+               "messages": [msg for msg in chunk if isinstance(msg, dict)]}
+    yield final_response
+
+def _sync_start(channel_data, since):
+    """(cursor, since, reset) for a sync of channel_data from cursor since."""
+    cursor = channel_data.get("last_seq", 0)
+    if since is not None and since > cursor:
+        # Cursor from another history (e.g. the channel was recreated): start over
+        return cursor, None, True
+    return cursor, since, False
 
 # Hàm đồng bộ tin nhắn từ server về client (channel-hosting hoặc joined user)
 def handle_sync_from_server(client_socket, request):
@@ -489,32 +579,138 @@ def handle_sync_from_server(client_socket, request):
         channel_name = request.get("channel_name")
         username = request.get("username")
 
+        # Optional cursor: the last seq the client already has. Without it the whole history is sent.
+        since = request.get("since")
+        # Optional streaming: the messages come as history_chunk pushes of HISTORY_CHUNK_MESSAGES,
+        # encoded while the connection drains, and the reply that follows them has none
+        stream = request.get("stream") is True
+
         if not channel_name or not username:
             response = {"status": "error", "message": "Channel name and username are required"}
-            client_socket.send(json.dumps(response).encode('utf-8'))
-            return
+            return response
+        if since is not None and (not isinstance(since, int) or isinstance(since, bool) or since < 0):
+            return {"status": "error", "message": "'since' must be a non-negative integer"}
 
+        # Read without locks: writers may append while we copy, so the cursor is taken
+        # from what was actually copied
         channels = load_channels()
+        channel_data = channels["channels"].get(channel_name)
 
         # Check if channel exists
-        if channel_name not in channels.get("channels", {}):
+        if channel_data is None:
             # If channel doesn't exist, return empty list or error (returning empty for now)
             log_error(f"Sync from server requested for non-existent channel '{channel_name}'. Returning empty list.")
-            messages = []
-        else:
-            # Check if the user is a participant of the channel
-            participants = channels["channels"][channel_name].get("participants", [])
-            if username not in participants:
-                response = {"status": "error", "message": "You are not a participant of this channel"}
-                client_socket.send(json.dumps(response).encode('utf-8'))
-                log_error(f"User '{username}' attempted to sync messages for channel '{channel_name}' without being a participant.")
-                return
+            return {"status": "success", "messages": [], "cursor": 0, "push": True}
+
+        # Check if the user is a participant of the channel
+        participants = channel_data.get("participants", [])
+        if username not in participants:
+            response = {"status": "error", "message": "You are not a participant of this channel"}
+            log_error(f"User '{username}' attempted to sync messages for channel '{channel_name}' without being a participant.")
+            return response
+
+        if "last_seq" not in channel_data:
+            with locked_channel(channel_name) as locked: # Numbering old messages is a write
+                if locked is not None:
+                    ensure_message_seqs(locked)
+        subscribe_client(client_socket, channel_name)
+
+        if stream:
+            channel_data = channels["channels"].get(channel_name, channel_data)
+            cursor, start_since, reset = _sync_start(channel_data, since)
+            messages_list = channel_data.get("messages", [])
+            end = len(messages_list) # Later appends reach the client as pushes
+            start = seq_position(messages_list, end, (start_since or 0) + 1)
+            if end > start and isinstance(messages_list[end - 1], dict):
+                cursor = max(cursor, messages_list[end - 1].get("seq", 0))
+            response = {"status": "success", "messages": [], "cursor": cursor, "push": True,
+                        "streamed": end - start}
+            if reset:
+                response["reset"] = True
+            stored = _stored_history(channel_name, messages_list, start, end)
+            send_stream(client_socket, _history_chunks(channel_name, messages_list, start, end, response,
+                                                       sessions.protocol_of(client_socket), stored))
+            return None # The reply goes out behind the chunks
+
+        def build():
+            # Called on a cache miss, after the channel version was read, so the
+            # channel is looked up again (it may have been deleted or recreated)
+            current = channels["channels"].get(channel_name)
+            if current is None:
+                return {"status": "success", "messages": [], "cursor": 0, "push": True}
+            cursor, start_since, reset = _sync_start(current, since)
+            messages = messages_since(current, start_since or 0)
+            if messages:
+                cursor = max(cursor, messages[-1].get("seq", 0))
+            response = {"status": "success", "messages": messages, "cursor": cursor, "push": True}
+            if reset:
+                response["reset"] = True # Client should drop what it has and use this full history
+            return response
+
+        # Clients at the same cursor get the same bytes until the channel changes
+        send_cached_response(client_socket, channel_name, ("sync", since or 0), build)
+        return None
 
-            messages = channels["channels"][channel_name].get("messages", [])
+    except Exception as e:
+        log_error(f"Error in handle_sync_from_server: {str(e)}")
+        return {"status": "error", "message": f"Internal server error during sync: {str(e)}"}
+
+
+# Hàm đọc lịch sử tin nhắn theo trang (history.py)
+def _history_bound(value):
+    """A valid before / after bound: a seq (int >= 0), an ISO timestamp (str) or None."""
+    if value is None or isinstance(value, str):
+        return True
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def handle_get_history(client_socket, request):
+    """One page of a channel's messages.
+
+    Request: channel_name, username, optional before / after (both seqs or both
+    timestamps) and limit (default HISTORY_PAGE_SIZE, at most HISTORY_MAX_PAGE_SIZE).
+    Without bounds the newest page is returned. The reply carries "has_more" (more
+    messages beyond the page, in its direction) and, when the page ends at the
+    newest message, "cursor" for later sync_from_server calls; from then on new
+    messages are pushed, as after sync_from_server.
+    """
+    try:
+        channel_name = request.get("channel_name")
+        username = request.get("username")
+        before, after = request.get("before"), request.get("after")
+        limit = request.get("limit", HISTORY_PAGE_SIZE)
 
-        response = {"status": "success", "messages": messages}
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        if not channel_name or not username:
+            return {"status": "error", "message": "Channel name and username are required"}
+        if not _history_bound(before) or not _history_bound(after):
+            return {"status": "error", "message": "'before' and 'after' must be sequence numbers or timestamps"}
+        if before is not None and after is not None and isinstance(before, str) != isinstance(after, str):
+            return {"status": "error", "message": "'before' and 'after' must both be sequence numbers or both timestamps"}
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+            return {"status": "error", "message": "'limit' must be a positive integer"}
+        limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+
+        # Read without locks, like sync_from_server
+        channel_data = load_channels()["channels"].get(channel_name)
+        if channel_data is None:
+            return {"status": "error", "message": f"Channel '{channel_name}' does not exist"}
+        if username not in channel_data.get("participants", []):
+            log_error(f"User '{username}' attempted to read the history of channel '{channel_name}' without being a participant.")
+            return {"status": "error", "message": "You are not a participant of this channel"}
+        if "last_seq" not in channel_data:
+            with locked_channel(channel_name) as locked: # Numbering old messages is a write
+                if locked is not None:
+                    ensure_message_seqs(locked)
+                    channel_data = locked
+
+        messages, has_more, reaches_end = history_page(channel_name, channel_data.get("messages", []),
+                                                       before, after, limit)
+        response = {"status": "success", "messages": messages, "has_more": has_more}
+        if reaches_end:
+            response["cursor"] = messages[-1]["seq"] if messages else min(after or 0, channel_data.get("last_seq", 0))
+            response["push"] = True
+            subscribe_client(client_socket, channel_name)
+        return response
 
     except Exception as e:
-        client_socket.send(json.dumps(response).encode('utf-8'))
-        log_error(f"Error in handle_sync_from_server: {str(e)}")
+        log_error(f"Error in handle_get_history: {str(e)}", exc_info=True)
+        return {"status": "error", "message": f"Internal server error reading history: {str(e)}"}
@@ -0,0 +1,293 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, nullcontext
+from logger import log_info, log_error
+
+# In-memory channel store with write-behind persistence.
+# The backend's state is loaded once, on first use. From then on the dict held
+# here is the authoritative channel state and handlers call mark_dirty() after
+# changing it. A background writer persists the changes whenever
+# the store is dirty and either `flush_interval` seconds have passed or
+# `dirty_threshold` mutations have piled up, so a request never pays for disk I/O.
+# Changes made since the last flush are lost if the process is killed hard;
+# flush() is called on orderly shutdown.
+#
+# Locking: `lock` guards the set of channels (adding, removing or replacing a
+# channel). Each channel has its own lock, channel_lock(name), held while that
+# channel's data is changed, so writers of different channels run in parallel.
+# Always take `lock` before a channel lock, never the other way round. Readers
+# take no lock: they copy what they need (list(...) / slices are atomic) and must
+# cope with a channel that keeps growing. Writers call touch(name) before changing
+# a channel in place. capture() runs with `lock` held and takes the channel locks
+# one at a time, only for the channels touched since the last flush, so it sees
+# each of them between two mutations while writers of the others carry on.
+#
+# A backend provides:
+#   load()        -> {"channels": {name: channel_data}}
+#   capture(data, changed, channel_lock)
+#                 -> what has to be written. Called with `lock` held; reads a
+#                    channel under channel_lock(name) and must only copy, never do
+#                    I/O. changed: names of the channels changed in place since the
+#                    last capture (None: all of them). Channels added, removed or
+#                    replaced by a new object are found by comparing identities.
+#   write(work)   -> writes what capture() returned, without the store lock
+#   close()
+
+
+class JsonFileBackend:
+    """One JSON document (channels.json) holding every channel with its full history."""
+
+    def __init__(self, path):
+        self.path = path
+        self._captured = {} # Channel name -> (live channel data, copy of it as last captured)
+
+    def load(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            if "channels" not in data or not isinstance(data.get("channels"), dict):
+                log_error(f"Invalid structure in {self.path}. Resetting.")
+                return {"channels": {}}
+            log_info(f"Loaded {len(data['channels'])} channel(s) from {self.path} into memory.")
+            return data
+        except FileNotFoundError:
+            log_info(f"{self.path} not found. Creating default structure.")
+            return {"channels": {}}
+        except json.JSONDecodeError as e:
+            log_error(f"Error decoding JSON from {self.path}: {e}. Returning default.")
+            return {"channels": {}}
+
+    def capture(self, data, changed=None, channel_lock=None):
+        """Copies the containers of changed channels; stored message dicts are never mutated afterwards."""
+        captured = {}
+        for name, channel_data in data.get("channels", {}).items():
+            previous = self._captured.get(name)
+            if previous is not None and previous[0] is channel_data and changed is not None and name not in changed:
+                captured[name] = previous # Unchanged: reuse the copy of the last capture
+                continue
+            with channel_lock(name) if channel_lock is not None else nullcontext():
+                copy = dict(channel_data)
+                for key in ("messages", "participants"):
+                    if isinstance(copy.get(key), list):
+                        copy[key] = list(copy[key])
+            captured[name] = (channel_data, copy)
+        self._captured = captured
+        snapshot = dict(data)
+        snapshot["channels"] = {name: copy for name, (_, copy) in captured.items()}
+        return snapshot
+
+    def write(self, snapshot):
+        payload = json.dumps(snapshot, ensure_ascii=False)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno()) # Durable before it replaces the old file
+        os.replace(temp_path, self.path) # Readers never see a half-written file
+
+    def close(self):
+        pass
+
+
+class ChannelStore:
+    def __init__(self, backend, flush_interval=1.0, dirty_threshold=1000,
+                 group_commit=False, commit_interval=0.005, commit_batch_size=256):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.dirty_threshold = dirty_threshold
+        # Group commit: changes registered with when_durable() are acknowledged once a
+        # write containing them is durable. The writer collects them for up to
+        # commit_interval seconds or until commit_batch_size are waiting, then commits
+        # them together with a single write.
+        self.group_commit = group_commit
+        self.commit_interval = commit_interval
+        self.commit_batch_size = commit_batch_size
+        self.lock = threading.RLock()   # Guards the set of channels in self.data
+        self._channel_locks = {}        # Channel name -> lock guarding that channel's data
+        self._channel_locks_guard = threading.Lock()
+        self.data = None                # {"channels": {name: channel_data}} once loaded
+        self.dirty = 0                  # Mutations not yet written
+        self._changed = None            # Channels touched since the last capture (None: all)
+        self.flushes = 0
+        self._generation = 0            # Mutations so far; mark_dirty() hands out the new value
+        self._committed = 0             # Every mutation up to this generation is on disk
+        self._acks = []                 # (ticket, registered at, callback) waiting for durability
+        self._flush_lock = threading.Lock() # One capture/write round at a time
+        self._wakeup = threading.Condition(threading.Lock())
+        self._writer = None
+        self._closed = False
+        # Commit metrics
+        self.committed_mutations = 0
+        self.max_batch = 0
+        self.commit_latencies = deque(maxlen=4096) # Seconds a caller waited for durability
+        self.write_seconds = 0.0
+
+    # --- Access ---
+    def load(self):
+        """Returns the live state, loading it the first time. See the locking notes above."""
+        if self.data is None:
+            with self.lock:
+                if self.data is None:
+                    self.data = self.backend.load()
+                    self._start_writer()
+        return self.data
+
+    def channel_lock(self, name):
+        """The lock serializing changes to channel `name` (take self.lock first if both are needed)."""
+        lock = self._channel_locks.get(name)
+        if lock is None:
+            with self._channel_locks_guard:
+                lock = self._channel_locks.setdefault(name, threading.Lock())
+        return lock
+
+    def _all_channel_locks(self):
+        stack = ExitStack()
+        with self._channel_locks_guard:
+            locks = [self._channel_locks[name] for name in sorted(self._channel_locks)]
+        for lock in locks:
+            stack.enter_context(lock)
+        return stack
+
+    def replace(self, data):
+        """Swaps in a whole new state (e.g. a caller built a fresh structure)."""
+        with self.lock, self._all_channel_locks():
+            self.load() # The backend must know what is on disk before it is replaced
+            self.data = data
+            with self._wakeup:
+                self._changed = None
+            return self.mark_dirty()
+
+    def touch(self, name):
+        """Records that channel name is about to change in place. Call it with the channel lock held, before mark_dirty()."""
+        with self._wakeup:
+            if self._changed is not None:
+                self._changed.add(name)
+
+    def mark_dirty(self, count=1):
+        """Records count mutations; the writer persists them in the background.
+
+        Returns a ticket for when_durable(). Call it after the mutation, before
+        releasing the lock that guarded it.
+        """
+        with self._wakeup:
+            self.dirty += count
+            self._generation += count
+            if self.dirty >= self.dirty_threshold:
+                self._wakeup.notify_all()
+            return self._generation
+
+    def when_durable(self, ticket, callback):
+        """Calls callback() once the mutation that returned ticket is on disk (group commit).
+
+        The callback runs on the writer thread, so it must not block. Without group
+        commit it runs at once, on the calling thread.
+        """
+        with self._wakeup:
+            if self.group_commit and self._committed < ticket:
+                self._acks.append((ticket, time.monotonic(), callback))
+                if len(self._acks) == 1 or len(self._acks) >= self.commit_batch_size:
+                    self._wakeup.notify_all() # Start (or close) a batch
+                return
+        callback()
+
+    # --- Persistence ---
+    def flush(self):
+        """Persists the current state if anything changed. Safe to call from any thread."""
+        with self._flush_lock:
+            with self._wakeup:
+                pending = self.dirty
+                generation = self._generation
+                changed, self._changed = self._changed, set()
+                self.dirty = 0
+            if not pending or self.data is None:
+                self._restore_changed(changed)
+                return False
+            try:
+                started = time.monotonic()
+                with self.lock:
+                    work = self.backend.capture(self.data, changed, self.channel_lock)
+                self.backend.write(work)
+                with self._wakeup:
+                    now = time.monotonic()
+                    self.flushes += 1
+                    self.write_seconds += now - started
+                    self.committed_mutations += pending
+                    self.max_batch = max(self.max_batch, pending)
+                    self._committed = max(self._committed, generation)
+                    durable = [ack for ack in self._acks if ack[0] <= self._committed]
+                    if durable:
+                        self._acks = [ack for ack in self._acks if ack[0] > self._committed]
+                        self.commit_latencies.extend(now - registered for _, registered, _ in durable)
+                self._acknowledge(durable)
+                return True
+            except Exception as e:
+                log_error(f"Error persisting channels: {e}", exc_info=True)
+                with self._wakeup:
+                    self.dirty += pending # Retry on the next round
+                self._restore_changed(changed)
+                return False
+
+    def _restore_changed(self, changed):
+        with self._wakeup:
+            if changed is None:
+                self._changed = None
+            elif self._changed is not None:
+                self._changed |= changed
+
+    def _acknowledge(self, acks):
+        for _, _, callback in acks:
+            try:
+                callback()
+            except Exception as e:
+                log_error(f"Error acknowledging a durable channel change: {e}", exc_info=True)
+
+    def commit_stats(self):
+        """Batch size and commit latency counters."""
+        with self._wakeup:
+            latencies = sorted(self.commit_latencies)
+            flushes = self.flushes
+
+            def percentile(fraction):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000 if latencies else 0.0
+            return {
+                "commits": flushes,
+                "mutations": self.committed_mutations,
+                "avg_batch": self.committed_mutations / flushes if flushes else 0.0,
+                "max_batch": self.max_batch,
+                "avg_write_ms": self.write_seconds * 1000 / flushes if flushes else 0.0,
+                "latency_p50_ms": percentile(0.50),
+                "latency_p99_ms": percentile(0.99),
+                "latency_max_ms": latencies[-1] * 1000 if latencies else 0.0,
+            }
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_behind, name="ChannelStoreWriter", daemon=True)
+            self._writer.start()
+
+    def _write_behind(self):
+        while not self._closed:
+            with self._wakeup:
+                if not self._acks:
+                    self._wakeup.wait(self.flush_interval)
+                if self._acks:
+                    # Give concurrent writers commit_interval to join this batch
+                    deadline = time.monotonic() + self.commit_interval
+                    while len(self._acks) < self.commit_batch_size and not self._closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._wakeup.wait(remaining)
+            self.flush()
+
+    def close(self):
+        """Stops the writer and persists outstanding changes."""
+        self._closed = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        self.flush()
+        self.backend.close()
@@ -0,0 +1,145 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from channel_store import ChannelStore, JsonFileBackend
+
+
+class FailingBackend(JsonFileBackend):
+    """JsonFileBackend whose writes fail until allowed."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.allowed = threading.Event()
+        self.attempts = 0
+
+    def write(self, snapshot):
+        self.attempts += 1
+        if not self.allowed.is_set():
+            raise OSError("disk unavailable")
+        super().write(snapshot)
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "channels.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def store(self, backend=None, **options):
+        store = ChannelStore(backend or JsonFileBackend(self.path), flush_interval=3600, dirty_threshold=1 << 30,
+                             **options)
+        self.addCleanup(store.close)
+        store.load()
+        return store
+
+    def change(self, store, name, message):
+        """A writer's in-place change, as channel_manager.locked_channel makes it."""
+        with store.channel_lock(name):
+            store.touch(name)
+            store.data["channels"][name]["messages"].append(message)
+            return store.mark_dirty()
+
+    def on_disk(self):
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)["channels"]
+
+
+class TestChannelStore(StoreTestCase):
+    def test_flush_locks_only_changed_channels(self):
+        store = self.store()
+        for name in ("busy", "quiet"):
+            store.data["channels"][name] = {"participants": [], "messages": []}
+        store.mark_dirty()
+        store.flush()
+        self.change(store, "quiet", {"message": "hello"})
+        with store.channel_lock("busy"): # A writer of an unchanged channel holds its lock throughout
+            flusher = threading.Thread(target=store.flush)
+            flusher.start()
+            flusher.join(5)
+            self.assertFalse(flusher.is_alive())
+        self.assertEqual(self.on_disk()["quiet"]["messages"], [{"message": "hello"}])
+
+    def test_unchanged_channels_are_written_from_their_last_copy(self):
+        store = self.store()
+        channels = store.data["channels"]
+        for name in ("a", "b"):
+            channels[name] = {"participants": [], "messages": []}
+        store.mark_dirty()
+        for i in range(3):
+            self.change(store, "a", {"n": i})
+            store.flush()
+        self.change(store, "b", {"n": "b"})
+        with store.lock: # Added and removed channels need no touch()
+            channels["c"] = {"participants": ["x"], "messages": [{"n": "c"}]}
+            del channels["a"]
+            store.mark_dirty()
+        store.flush()
+        self.assertEqual(self.on_disk(), channels)
+        store.close()
+        self.assertEqual(JsonFileBackend(self.path).load()["channels"], channels)
+
+class TestGroupCommit(StoreTestCase):
+    def group_store(self, backend=None, commit_interval=0.005, commit_batch_size=256):
+        store = self.store(backend, group_commit=True, commit_interval=commit_interval,
+                           commit_batch_size=commit_batch_size)
+        store.data["channels"]["General"] = {"participants": [], "messages": []}
+        store.mark_dirty()
+        store.flush()
+        return store
+
+    def test_acks_are_held_back_until_a_write_succeeds(self):
+        backend = FailingBackend(self.path)
+        backend.allowed.set()
+        store = self.group_store(backend)
+        backend.allowed.clear()
+        acknowledged = threading.Event()
+        store.when_durable(self.change(store, "General", {"message": "hello"}), acknowledged.set)
+        self.assertFalse(acknowledged.wait(0.2))
+        self.assertGreater(backend.attempts, 2) # Retried by the writer meanwhile
+        self.assertEqual(self.on_disk()["General"]["messages"], [])
+        backend.allowed.set()
+        self.assertTrue(acknowledged.wait(5))
+        self.assertEqual(self.on_disk()["General"]["messages"], [{"message": "hello"}])
+
+    def test_full_batch_is_committed_without_waiting_for_the_interval(self):
+        store = self.group_store(commit_interval=30, commit_batch_size=3)
+        acknowledged = []
+        done = threading.Event()
+
+        def ack(n):
+            acknowledged.append(n)
+            if len(acknowledged) == 3:
+                done.set()
+        flushes = store.flushes
+        for n in range(3):
+            store.when_durable(self.change(store, "General", {"n": n}), lambda n=n: ack(n))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(sorted(acknowledged), [0, 1, 2])
+        self.assertEqual(store.flushes, flushes + 1) # One write for the whole batch
+
+    def test_batch_is_committed_once_the_interval_ends(self):
+        store = self.group_store(commit_interval=0.1)
+        acknowledged = threading.Event()
+        started = time.monotonic()
+        store.when_durable(self.change(store, "General", {"n": 1}), acknowledged.set)
+        self.assertTrue(acknowledged.wait(5))
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_durable_changes_are_acknowledged_at_once(self):
+        store = self.group_store()
+        ticket = self.change(store, "General", {"n": 1})
+        store.flush()
+        acknowledged = []
+        store.when_durable(ticket, lambda: acknowledged.append(threading.current_thread()))
+        self.assertEqual(acknowledged, [threading.current_thread()])
+
+
+if __name__ == "__main__":
+    unittest.main()
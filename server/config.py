@@ -0,0 +1,116 @@
+import os
+import importlib.util
+
+# Server configuration. Every value can be overridden with an environment variable
+# so the server can be tuned without editing code.
+
+# Địa chỉ và cổng lắng nghe
+SERVER_HOST = os.environ.get("CHAT_SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("CHAT_SERVER_PORT", "5000"))
+
+# Connection handling mode:
+#   "selector" - all client sockets are multiplexed on a few event-loop threads
+#   "threaded" - legacy mode, one handler thread per connected client
+SERVER_MODE = os.environ.get("CHAT_SERVER_MODE", "selector")
+
+# Number of event-loop threads used in "selector" mode
+LOOP_THREADS = int(os.environ.get("CHAT_LOOP_THREADS", "4"))
+
+# Size of a single recv() call on client sockets
+RECV_BUFFER_SIZE = 65536
+
+# Worker threads running the requests that carry a "request_id" (server/dispatch.py),
+# so one connection's requests can run concurrently. 0 runs them in order on the
+# connection's reader, like requests without an id.
+REQUEST_WORKERS = int(os.environ.get("CHAT_REQUEST_WORKERS", "8"))
+
+# Wire protocols the server accepts during the auth handshake, in preference order.
+# "bin1" is the length-prefixed MessagePack framing, "json" the newline-delimited JSON.
+# bin1 is preferred only when the msgpack C extension is installed; the pure-Python
+# codec is smaller on the wire but slower than the json module for large histories.
+_DEFAULT_PROTOCOLS = "bin1,json" if importlib.util.find_spec("msgpack") else "json,bin1"
+WIRE_PROTOCOLS = [p.strip() for p in os.environ.get("CHAT_WIRE_PROTOCOLS", _DEFAULT_PROTOCOLS).split(",") if p.strip()]
+
+# Outbound queues (server/outbound.py). Pushes are only queued while a connection
+# holds fewer than OUTBOUND_MAX_FRAMES frames and OUTBOUND_MAX_BYTES bytes.
+OUTBOUND_MAX_FRAMES = int(os.environ.get("CHAT_OUTBOUND_MAX_FRAMES", "1000"))
+OUTBOUND_MAX_BYTES = int(os.environ.get("CHAT_OUTBOUND_MAX_BYTES", str(1024 * 1024)))
+# Replies are never dropped, but a connection with more than this queued is closed
+OUTBOUND_HARD_LIMIT_BYTES = int(os.environ.get("CHAT_OUTBOUND_HARD_LIMIT_BYTES", str(64 * 1024 * 1024)))
+
+# What happens to a push for a client whose queue is full (a slow consumer):
+#   "drop"       - the push is discarded
+#   "coalesce"   - queued pushes with the same coalescing key (e.g. new messages of
+#                  one channel) are merged into one, e.g. a single resync notice
+#   "disconnect" - the connection is closed; the client reconnects and resyncs
+SLOW_CONSUMER_POLICY = os.environ.get("CHAT_SLOW_CONSUMER_POLICY", "coalesce")
+# Streamed replies (outbound.send_stream) are encoded frame by frame while less
+# than this many bytes wait to be written to the client
+OUTBOUND_STREAM_BUFFER_BYTES = int(os.environ.get("CHAT_OUTBOUND_STREAM_BUFFER_BYTES", str(256 * 1024)))
+
+# Channel store write-behind (server/channel_store.py). Channel state is kept in
+# memory and written to channels.json every CHANNELS_FLUSH_INTERVAL seconds, or
+# as soon as CHANNELS_FLUSH_DIRTY_THRESHOLD changes are pending.
+CHANNELS_FLUSH_INTERVAL = float(os.environ.get("CHAT_CHANNELS_FLUSH_INTERVAL", "1.0"))
+CHANNELS_FLUSH_DIRTY_THRESHOLD = int(os.environ.get("CHAT_CHANNELS_FLUSH_DIRTY_THRESHOLD", "1000"))
+
+# Where channel messages are persisted:
+#   "json" - server/channels.json, one document with every channel's full history
+#   "log"    - append-only segmented message log in MESSAGE_LOG_DIR (server/message_log.py).
+#              The first start in this mode imports an existing channels.json once.
+#   "sqlite" - tables in SQLITE_DB_FILE (server/repository.py), channels.json imported once
+CHANNEL_STORAGE = os.environ.get("CHAT_CHANNEL_STORAGE", "json")
+# Where registered users are stored: "json" (server/users.json) or "sqlite" (imported
+# from users.json once). Defaults to sqlite when the channels are stored there.
+USER_STORAGE = os.environ.get("CHAT_USER_STORAGE", "sqlite" if CHANNEL_STORAGE == "sqlite" else "json")
+SQLITE_DB_FILE = os.environ.get("CHAT_SQLITE_DB_FILE", "server/chat.db")
+MESSAGE_LOG_DIR = os.environ.get("CHAT_MESSAGE_LOG_DIR", "server/channel_log")
+# A channel's active segment is closed once it reaches this size
+MESSAGE_LOG_SEGMENT_BYTES = int(os.environ.get("CHAT_MESSAGE_LOG_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+# One sparse index entry about every this many bytes of records
+MESSAGE_LOG_INDEX_INTERVAL = int(os.environ.get("CHAT_MESSAGE_LOG_INDEX_INTERVAL", "4096"))
+
+# Group commit (server/channel_store.py). With GROUP_COMMIT on, save_message and
+# save_system_message reply only once the message is durable. Messages stored while
+# a write is running are committed together by the next one; the writer can also
+# hold a batch open GROUP_COMMIT_INTERVAL_MS (or until GROUP_COMMIT_BATCH_SIZE are
+# waiting) for more to join. Off: replies are sent before the write-behind flush.
+# Defaults to off for json storage, where every commit rewrites the whole file.
+GROUP_COMMIT = os.environ.get("CHAT_GROUP_COMMIT", "0" if CHANNEL_STORAGE == "json" else "1").lower() \
+    not in ("0", "false", "no", "off")
+GROUP_COMMIT_INTERVAL_MS = float(os.environ.get("CHAT_GROUP_COMMIT_INTERVAL_MS", "0"))
+GROUP_COMMIT_BATCH_SIZE = int(os.environ.get("CHAT_GROUP_COMMIT_BATCH_SIZE", "256"))
+
+# Paged history reads (get_history, server/history.py): page size when the request
+# gives no "limit", and the largest page served
+HISTORY_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_MAX_PAGE_SIZE", "500"))
+# Messages per history_chunk frame of a streamed sync_from_server reply
+HISTORY_CHUNK_MESSAGES = int(os.environ.get("CHAT_HISTORY_CHUNK_MESSAGES", "256"))
+# With CHANNEL_STORAGE = "log", streamed chunks are built from the stored records
+# (mapped segment files, no JSON decode / encode) for the part of the history on disk
+HISTORY_ZERO_COPY = os.environ.get("CHAT_HISTORY_ZERO_COPY", "1").lower() not in ("0", "false", "no", "off")
+
+# Cache of encoded sync_from_server / get_user_status replies (server/response_cache.py).
+# 0 disables it. Larger replies than RESPONSE_CACHE_MAX_ENTRY_BYTES are never cached.
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("CHAT_RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("CHAT_RESPONSE_CACHE_MAX_ENTRY_BYTES", str(8 * 1024 * 1024)))
+
+# Logging (server/logger.py, common/log_writer.py). Lines are queued and written by a
+# background thread every LOG_FLUSH_INTERVAL seconds; logs/server.log is rotated once
+# it exceeds LOG_MAX_BYTES, keeping LOG_BACKUPS archives (0: the file is truncated).
+LOG_MAX_BYTES = int(os.environ.get("CHAT_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("CHAT_LOG_BACKUPS", "5"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("CHAT_LOG_FLUSH_INTERVAL", "0.2"))
+# Records below LOG_LEVEL (DEBUG, INFO, WARNING, ERROR) are dropped before being
+# formatted. LOG_FORMAT "json" writes one JSON object per line with the record's
+# fields (user, channel, action, latency_ms, ...). LOG_SAMPLE keeps one in N records
+# of frequent events ("event=N,..."). Writing {"level": ..., "format": ..., "sample":
+# {...}} to LOG_CONFIG_FILE changes these settings while the server runs.
+LOG_LEVEL = os.environ.get("CHAT_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("CHAT_LOG_FORMAT", "text")
+LOG_SAMPLE = {event.strip(): int(rate) for event, _, rate in
+              (item.partition("=") for item in
+               os.environ.get("CHAT_LOG_SAMPLE", "get_user_status=100,sync_from_server=100").split(","))
+              if event.strip() and rate.strip()}
+LOG_CONFIG_FILE = os.environ.get("CHAT_LOG_CONFIG_FILE", "logs/server_log_config.json")
@@ -0,0 +1,79 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logger import log_error
+
+# Concurrent request execution.
+# Requests that carry a "request_id" do not have to be answered in order: their
+# replies echo the id (outbound.replying_to). The connection's reader hands them
+# to a RequestDispatcher and goes on decoding, so a bulk transfer (a large
+# sync_from_server) no longer holds back the interactive requests behind it.
+#
+# Ordering that clients rely on is kept with lanes. A lane is a key (a connection
+# and a channel) whose requests run one at a time, in the order they arrived:
+#   - writes (storing a message, joining, creating a channel, ...) always go through
+#     their lane, so the writes of one connection to one channel keep their order;
+#   - reads of a channel go through the lane only while writes are queued or running
+#     in it, so they see the connection's earlier writes but never hold back later ones;
+#   - requests without a lane run as soon as a worker is free.
+
+
+class RequestDispatcher:
+    """Runs handler(*args) on a pool of worker threads, ordered per lane."""
+
+    def __init__(self, handler, workers):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="RequestWorker")
+        self._lanes = {} # Key: lane key, Value: deque of args waiting behind the running request
+        self._lock = threading.Lock()
+        # Counters
+        self.submitted = 0
+        self.laned = 0      # Requests that waited in a lane behind another one
+        self.failed = 0
+        self.outstanding = 0 # Executor tasks queued or running
+
+    def submit(self, lane, write, *args):
+        """Schedules handler(*args). lane is None (no ordering) or a hashable key."""
+        with self._lock:
+            self.submitted += 1
+            queued = self._lanes.get(lane) if lane is not None else None
+            if queued is not None:
+                queued.append(args)
+                self.laned += 1
+                return
+            if lane is not None and write:
+                self._lanes[lane] = deque()
+            else:
+                lane = None
+            self.outstanding += 1
+        future = self.executor.submit(self._run_lane if lane is not None else self._run, lane, args)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self.outstanding -= 1
+
+    def _run(self, lane, args):
+        try:
+            self.handler(*args)
+        except Exception as e: # The handler replies to its own errors; this is a bug
+            self.failed += 1
+            log_error(f"Request worker failed: {e}", exc_info=True)
+
+    def _run_lane(self, lane, args):
+        while True:
+            self._run(lane, args)
+            with self._lock:
+                queued = self._lanes[lane]
+                if not queued:
+                    del self._lanes[lane]
+                    return
+                args = queued.popleft()
+
+    def stats(self):
+        with self._lock:
+            return {"submitted": self.submitted, "laned": self.laned, "failed": self.failed,
+                    "busy_lanes": len(self._lanes), "outstanding": self.outstanding}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,135 @@
+import selectors
+import socket
+import threading
+from collections import deque
+from logger import log_info, log_error
+from config import RECV_BUFFER_SIZE
+from common.protocol import WireDecoder
+
+# Event-loop ("selector") server core.
+# Instead of one blocking handler thread per client, every client socket is
+# registered on one of a few ConnectionLoop threads. Each loop waits on its
+# selector and only calls recv() on sockets that are readable, so thousands of
+# idle clients cost one selector entry each instead of one thread stack each.
+
+
+class ClientConnection:
+    """Per-socket state kept by an event loop."""
+    __slots__ = ("sock", "address", "addr_str", "decoder")
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.addr_str = f"{address[0]}:{address[1]}"
+        self.decoder = WireDecoder() # Partial requests survive between reads
+
+
+class ConnectionLoop(threading.Thread):
+    """A single event-loop thread multiplexing many client sockets."""
+
+    def __init__(self, index, on_data, on_close, on_open=None):
+        super().__init__(name=f"EventLoop-{index}", daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.on_data = on_data      # on_data(client_socket, addr_str, decoder, data)
+        self.on_close = on_close    # on_close(client_socket, addr_str)
+        self.on_open = on_open      # on_open(client_socket, address), before the first read
+        self.connection_count = 0
+        self._count_lock = threading.Lock() # connection_count is raised by the acceptor, lowered here
+        self._pending = deque()     # (socket, address) handed over by the acceptor
+        # Socket pair used to wake the selector when a new connection is handed over
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+
+    def add_connection(self, client_socket, address):
+        """Hands a freshly accepted socket to this loop (called from the acceptor thread)."""
+        with self._count_lock:
+            self.connection_count += 1
+        self._pending.append((client_socket, address))
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass # Wakeup byte already pending, loop will see the new socket anyway
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    self._register_pending()
+                else:
+                    self._read(key.data)
+
+    def _register_pending(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._pending:
+            client_socket, address = self._pending.popleft()
+            connection = ClientConnection(client_socket, address)
+            try:
+                if self.on_open is not None:
+                    self.on_open(client_socket, address)
+                client_socket.setblocking(False) # Outbound frames are written without blocking too
+                self.selector.register(client_socket, selectors.EVENT_READ, connection)
+                log_info(f"Handling connection from {connection.addr_str} on {self.name}")
+            except (ValueError, OSError) as e:
+                log_error(f"Failed to register socket from {connection.addr_str}: {e}")
+                self._close(connection)
+
+    def _read(self, connection):
+        try:
+            data = connection.sock.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return # Spurious wakeup, nothing to read yet
+        except ConnectionResetError:
+            log_info(f"Connection reset by {connection.addr_str}")
+            self._close(connection)
+            return
+        except OSError as e:
+            log_error(f"Socket error reading from {connection.addr_str}: {e}")
+            self._close(connection)
+            return
+
+        if not data:
+            log_info(f"Connection closed gracefully by {connection.addr_str}")
+            self._close(connection)
+            return
+
+        try:
+            self.on_data(connection.sock, connection.addr_str, connection.decoder, data)
+        except Exception as e:
+            log_error(f"Unhandled error processing data from {connection.addr_str}: {e}", exc_info=True)
+
+    def _close(self, connection):
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass # Never registered or already removed
+        with self._count_lock:
+            self.connection_count -= 1
+        try:
+            self.on_close(connection.sock, connection.addr_str)
+        except Exception as e:
+            log_error(f"Error cleaning up connection {connection.addr_str}: {e}", exc_info=True)
+
+
+class EventLoopServer:
+    """Accepts clients on the calling thread and spreads them over ConnectionLoop threads."""
+
+    def __init__(self, server_socket, on_data, on_close, loop_threads=4, on_open=None):
+        self.server_socket = server_socket
+        self.loops = [ConnectionLoop(i, on_data, on_close, on_open) for i in range(max(1, loop_threads))]
+
+    def serve_forever(self):
+        for loop in self.loops:
+            loop.start()
+        log_info(f"Event-loop server running with {len(self.loops)} loop thread(s).")
+        while True:
+            client_socket, address = self.server_socket.accept()
+            log_info(f"New connection attempt from {address}")
+            # Least-loaded loop gets the new client
+            loop = min(self.loops, key=lambda l: l.connection_count)
+            loop.add_connection(client_socket, address)
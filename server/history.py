@@ -0,0 +1,115 @@
+import bisect
+import threading
+
+# Paged reads of channel history (get_history).
+# A page is addressed by sequence numbers or by timestamps:
+#   - seq bounds use the message list itself as the index: it is kept in seq order,
+#     so the position of a seq is found directly (contiguous numbering) or by binary
+#     search, and a page is one slice.
+#   - timestamp bounds use a per-channel index of (timestamp, seq) sorted by
+#     timestamp. Messages merged by sync_to_server keep their client timestamps, so
+#     storage order is not time order. The index is built on the first timestamp
+#     query of a channel and then only catches up with the messages appended since.
+# Either way a page costs O(log n + page). Like other readers, nothing here takes
+# channel locks: the message list only grows, and its length is read once per call.
+
+
+def _seq_of(msg):
+    return msg.get("seq", 0) if isinstance(msg, dict) else 0
+
+def seq_position(messages_list, length, seq):
+    """Position of the first of the first `length` messages with a seq >= seq."""
+    if 1 <= seq <= length and _seq_of(messages_list[seq - 1]) == seq:
+        return seq - 1 # Contiguous numbering
+    lo, hi = 0, length
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _seq_of(messages_list[mid]) < seq:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _page_bounds(start, end, limit, forward):
+    """(first, last, has_more) of a page of at most limit items within [start, end)."""
+    if forward:
+        last = min(end, start + limit)
+        return start, last, last < end
+    first = max(start, end - limit)
+    return first, end, first > start
+
+
+class TimestampIndex:
+    """Timestamps and seqs of one channel's messages, sorted by (timestamp, seq)."""
+
+    def __init__(self, messages_list):
+        self.messages = messages_list # The channel's live list; a new list means a new channel
+        self.timestamps = []
+        self.seqs = []
+        self.covered = 0 # Messages of the list already in the index
+        self.lock = threading.Lock()
+
+    def catch_up(self, length):
+        with self.lock:
+            for msg in self.messages[self.covered:length]:
+                if not isinstance(msg, dict):
+                    continue
+                # Messages arrive in seq order, so inserting after equal timestamps keeps ties in seq order
+                timestamp = str(msg.get("timestamp", ""))
+                position = bisect.bisect_right(self.timestamps, timestamp)
+                self.timestamps.insert(position, timestamp)
+                self.seqs.insert(position, msg.get("seq", 0))
+            self.covered = max(self.covered, length)
+
+    def page(self, before, after, limit):
+        """Seqs of the page, in timestamp order, and whether more lie beyond it."""
+        with self.lock:
+            start = bisect.bisect_right(self.timestamps, after) if after is not None else 0
+            end = bisect.bisect_left(self.timestamps, before) if before is not None else len(self.timestamps)
+            first, last, has_more = _page_bounds(start, max(start, end), limit, after is not None)
+            return self.seqs[first:last], has_more
+
+
+_timestamp_indexes = {} # channel name -> TimestampIndex
+_indexes_lock = threading.Lock()
+
+def timestamp_index(channel_name, messages_list):
+    with _indexes_lock:
+        index = _timestamp_indexes.get(channel_name)
+        if index is None or index.messages is not messages_list: # Created, or deleted and recreated
+            index = _timestamp_indexes[channel_name] = TimestampIndex(messages_list)
+    return index
+
+def forget_channel(channel_name):
+    """Drops the timestamp index of a deleted channel."""
+    with _indexes_lock:
+        _timestamp_indexes.pop(channel_name, None)
+
+
+def history_page(channel_name, messages_list, before=None, after=None, limit=50):
+    """One page of a channel's history: (messages, has_more, reaches_end).
+
+    before / after are both seqs (int) or both timestamps (ISO strings), either may
+    be None. With after the page starts right after it and pages go forward;
+    otherwise the page ends right before `before` (or at the newest message) and
+    pages go backward. Messages come in seq order for seq bounds and in timestamp
+    order for timestamp bounds. reaches_end is True when the page ends at the newest
+    message, so its last seq can serve as a sync_from_server cursor.
+    """
+    length = len(messages_list) # Writers may append meanwhile; the page is taken as of now
+    if isinstance(before, str) or isinstance(after, str):
+        index = timestamp_index(channel_name, messages_list)
+        index.catch_up(length)
+        seqs, has_more = index.page(before, after, limit)
+        page = []
+        for seq in seqs:
+            position = seq_position(messages_list, length, seq)
+            if position < length and _seq_of(messages_list[position]) == seq:
+                page.append(messages_list[position])
+        return page, has_more, False
+
+    start = seq_position(messages_list, length, after + 1) if after is not None else 0
+    end = seq_position(messages_list, length, before) if before is not None else length
+    first, last, has_more = _page_bounds(start, max(start, end), limit, after is not None)
+    page = [msg for msg in messages_list[first:last] if isinstance(msg, dict)]
+    return page, has_more, last == length
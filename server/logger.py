@@ -1,34 +1,56 @@
+import atexit
 import os
-from datetime import datetime
+from config import LOG_MAX_BYTES, LOG_BACKUPS, LOG_FLUSH_INTERVAL
+from config import LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE, LOG_CONFIG_FILE
+from common.log_writer import LogWriter, Logger, DEBUG, INFO, WARNING, ERROR
 
 # Đường dẫn file log
 LOG_DIR = "logs"
 LOG_FILE = os.path.join(LOG_DIR, "server.log")
-MAX_LOG_SIZE = 10 * 1024 * 1024  # 10 MB
 
 # Đảm bảo thư mục logs tồn tại
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
+# Lines are written (and printed) in batches by a background thread
+# (common/log_writer.py); logging only queues them. server.log is rotated to
+# server.log.1 ... server.log.<LOG_BACKUPS> once it exceeds LOG_MAX_BYTES.
+_writer = LogWriter(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, LOG_FLUSH_INTERVAL)
+atexit.register(_writer.close)
+# Records below LOG_LEVEL return before formatting: pass "%s" arguments instead of
+# building f-strings on hot paths. Keyword arguments become structured fields;
+# records with event=... are sampled per LOG_SAMPLE. LOG_CONFIG_FILE changes all
+# of this at runtime.
+_logger = Logger(_writer, LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE, LOG_CONFIG_FILE)
+
+def log_debug(message, *args, **fields):
+    if _logger.threshold <= DEBUG:
+        _logger.log(DEBUG, "DEBUG", message, args, False, fields)
+
 # Hàm ghi log thông tin
-def log_info(message):
-    with open(LOG_FILE, "a") as log_file:
-        log_file.write(f"[INFO] {datetime.now()} - {message}\n")
-    print(f"[INFO] {message}")
-    clear_logs()
+def log_info(message, *args, **fields):
+    if _logger.threshold <= INFO:
+        _logger.log(INFO, "INFO", message, args, False, fields)
+
+def log_warning(message, *args, **fields):
+    if _logger.threshold <= WARNING:
+        _logger.log(WARNING, "WARNING", message, args, False, fields)
 
 # Hàm ghi log lỗi
-def log_error(message):
-    with open(LOG_FILE, "a") as log_file:
-        log_file.write(f"[ERROR] {datetime.now()} - {message}\n")
-    print(f"[ERROR] {message}")
-    clear_logs()
-def log_warning(message):
-    """Logs a warning message using log_info with a prefix."""
-    log_info(f"[WARNING] ChannelManager: {message}")
-# Hàm xóa log khi vượt quá giới hạn
-def clear_logs():
-    if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > MAX_LOG_SIZE:
-        with open(LOG_FILE, "w") as log_file:
-            log_file.write(f"[INFO] {datetime.now()} - Log cleared due to size limit\n")
-        print("[INFO] Log file cleared due to size limit")
\ No newline at end of file
+def log_error(message, *args, exc_info=False, **fields):
+    _logger.log(ERROR, "ERROR", message, args, exc_info, fields)
+
+def log_enabled(level=DEBUG):
+    """True if records of level are written. Guard arguments that are costly to compute."""
+    return _logger.threshold <= level
+
+def configure_logging(level=None, log_format=None, sample=None):
+    """Changes the log level, format ("text" / "json") or sampling without a restart."""
+    _logger.configure(level, log_format, sample)
+
+def flush_logs(timeout=5.0):
+    """Waits until everything logged so far is in the file (e.g. before os._exit)."""
+    return _writer.flush(timeout)
+
+def log_stats():
+    return dict(_writer.stats(), **_logger.settings())
@@ -1,35 +1,60 @@
 import socket
+import select
 import threading
 import sys
-import json
 import os
 import datetime
+import signal
+import time
+# Make the shared protocol package (common/) importable when run as a script
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _REPO_ROOT not in sys.path:
+    sys.path.append(_REPO_ROOT)
+from common.framing import FrameTooLarge
+from common.protocol import WireDecoder, negotiate
 from tracker import handle_tracker_request
 # Import channel_manager to access constants/functions if needed for startup checks
 from channel_manager import (
     handle_channel_request, CHANNELS_FILE,
-    save_channels as save_channels_external,
-    save_message, save_system_message # Thêm save_system_message
+    load_channels, save_channels as save_channels_external, flush_channels,
+    save_system_message # Thêm save_system_message
 )
-from utils import parse_json
-from logger import log_info, log_error
-from shared import channel_users, user_status, user_roles, connected_clients # Import user_roles
-
-# Use dictionaries to map sockets to user info
-# user_roles is already in shared.py, we'll use that directly.
-# user_channel is deprecated by connected_clients
+from broadcast import unsubscribe_client, broadcast_presence, broadcast_new_message
+from outbound import send_message, replying_to, forget as forget_outbound
+from logger import log_info, log_error, log_warning, log_debug, log_enabled, flush_logs, log_stats
+from config import SERVER_HOST, SERVER_PORT, SERVER_MODE, LOOP_THREADS, WIRE_PROTOCOLS, RECV_BUFFER_SIZE, CHANNEL_STORAGE
+from config import USER_STORAGE, SQLITE_DB_FILE, REQUEST_WORKERS
+from repository import JsonUserRepository, UserRegistry, sqlite_repository
+from event_loop import EventLoopServer
+from presence import update_user_presence, remove_user, channel_presence, clear_presence
+from shared import channel_subscribers
+from response_cache import send_cached_response, response_cache
+from sessions import sessions
+from dispatch import RequestDispatcher
+
+# Per-connection state (username, role, status, protocol, subscription) is kept in
+# one Session per socket, see sessions.py
 
 # Đường dẫn file lưu thông tin người dùng
 USER_DATA_FILE = "server/users.json"
 
+def create_user_repository(storage=USER_STORAGE):
+    """Registered users, stored as chosen by USER_STORAGE ("json" or "sqlite")."""
+    if storage == "sqlite":
+        return sqlite_repository(SQLITE_DB_FILE, legacy_users_path=USER_DATA_FILE) # Imports users.json once
+    if storage != "json":
+        log_error(f"Unknown user storage '{storage}', using 'json'.")
+    return JsonUserRepository(USER_DATA_FILE)
+
+# Users are indexed in memory at startup; only registrations reach the repository
+
+users_repository = UserRegistry(create_user_repository())
+
 # --- Server Initialization ---
-def start_server(host="0.0.0.0", port=5000):
-    global user_status, channel_users, connected_clients, user_roles
+def start_server(host=SERVER_HOST, port=SERVER_PORT, mode=SERVER_MODE):
     # Clear in-memory state on start
-    user_status.clear()
-    user_roles.clear()
-    connected_clients.clear()
-    channel_users.clear() # Clear channel user lists too
+    sessions.clear()
+    clear_presence() # Clear channel user lists too
 
     # Ensure essential files exist
     ensure_data_files_exist()
@@ -37,18 +62,28 @@ def start_server(host="0.0.0.0", port=5000):
     # Refresh user status from users.json (mark all as offline initially)
     refresh_all_users_offline() # Changed function name for clarity
 
+    # Channel state is read into memory once; handlers work on it from here on
+    load_channels()
+
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Allow address reuse
     try:
         server_socket.bind((host, port))
-        server_socket.listen(5)
-        log_info(f"Server started on {host}:{port}")
+        server_socket.listen(128)
+        log_info(f"Server started on {host}:{port} (mode: {mode})")
 
-        while True:
-            client_socket, address = server_socket.accept()
-            log_info(f"New connection attempt from {address}")
-            # Start thread to handle the client connection lifecycle
-            threading.Thread(target=handle_client, args=(client_socket, address), daemon=True).start()
+        if mode == "selector":
+            # Multiplex all client sockets on a few event-loop threads
+            EventLoopServer(server_socket, process_client_data, close_client_connection, LOOP_THREADS,
+                            on_open=sessions.open).serve_forever()
+        else:
+            while True:
+                client_socket, address = server_socket.accept()
+                log_info(f"New connection attempt from {address}")
+                client_socket.setblocking(False) # Outbound frames are written without blocking (outbound.py)
+                sessions.open(client_socket, address)
+                # Start thread to handle the client connection lifecycle
+                threading.Thread(target=handle_client, args=(client_socket, address), daemon=True).start()
     except OSError as e:
         log_error(f"Server failed to start on {host}:{port}. Error: {e}. Is the port already in use?")
     except KeyboardInterrupt:
@@ -58,79 +93,41 @@ def start_server(host="0.0.0.0", port=5000):
 
 def ensure_data_files_exist():
     """Creates default user and channel files if they don't exist."""
-    # Ensure users.json exists
-    if not os.path.exists(USER_DATA_FILE):
-         log_info(f"{USER_DATA_FILE} not found. Creating default.")
-         os.makedirs(os.path.dirname(USER_DATA_FILE), exist_ok=True)
-         save_users({"users": []}) # Save empty user list
-
-    # Ensure channels.json exists
-    if not os.path.exists(CHANNELS_FILE):
+    # Ensure users.json exists (or the user tables, with SQLite)
+    users_repository.ensure_exists()
+
+    # Ensure channels.json exists (the message log keeps its own files)
+    if CHANNEL_STORAGE == "json" and not os.path.exists(CHANNELS_FILE):
          log_info(f"{CHANNELS_FILE} not found. Creating default.")
          os.makedirs(os.path.dirname(CHANNELS_FILE), exist_ok=True)
          # Use the imported save_channels function from channel_manager
          save_channels_external({"channels": {}})
 
 def refresh_all_users_offline():
-    """Loads users from file and sets their initial RAM status to offline."""
-    global user_status
-    users_data = load_users()
-    for user in users_data.get("users", []):
-        username = user.get("username")
-        if username:
-            user_status[username] = "offline" # Mark everyone offline in RAM initially
-            # user_roles[username] = "authenticated" # Assume users in file are authenticated
-    log_info(f"Initialized RAM user statuses from file (all set to offline).")
+    """Loads the user registry. Users without a session count as offline."""
+    registered = len(users_repository.usernames())
+    log_info(f"Initialized user registry with {registered} user(s) (all offline until they log in).")
 
 
 # --- Client Connection Handling ---
 def handle_client(client_socket, address):
-    """Manages a single client connection, processing incoming requests."""
+    """Manages a single client connection on its own thread (threaded mode)."""
     addr_str = f"{address[0]}:{address[1]}" # For logging
     log_info(f"Handling connection from {addr_str}")
+    decoder = WireDecoder() # Keeps partial requests between recv() calls
     try:
         while True:
             try:
-                data = client_socket.recv(4096) # Increased buffer size
+                # The socket is non-blocking (see outbound.py), so wait for data first
+                select.select([client_socket], [], [])
+                data = client_socket.recv(RECV_BUFFER_SIZE)
                 if not data:
                     log_info(f"Connection closed gracefully by {addr_str}")
                     break # Exit loop if client disconnected
+                process_client_data(client_socket, addr_str, decoder, data)
 
-                data_str = data.decode('utf-8', errors='ignore')
-                log_info(f"Received raw data from {addr_str}: {data_str[:200]}...") # Log truncated data
-
-                # Handle potentially multiple JSON objects concatenated by client/network issues
-                requests = []
-                decoder = json.JSONDecoder()
-                pos = 0
-                while pos < len(data_str):
-                    # Skip leading whitespace/newlines
-                    while pos < len(data_str) and data_str[pos].isspace():
-                        pos += 1
-                    if pos == len(data_str): break # End of data
-
-                    try:
-                        req, json_len = decoder.raw_decode(data_str[pos:])
-                        if isinstance(req, dict):
-                            requests.append(req)
-                        else:
-                            log_error(f"Received non-dict JSON from {addr_str}: {req}")
-                        pos += json_len
-                    except json.JSONDecodeError as e:
-                        log_error(f"Invalid JSON segment from {addr_str} at pos {pos}: {e}. Data: '{data_str[pos:pos+50]}...'")
-                        # Attempt to recover or break? Break for now.
-                        break # Stop processing this chunk on error
-
-                if not requests:
-                    log_warning(f"No valid JSON request found in data from {addr_str}. Data: {data_str}")
-                    # Optionally send an error response if this is unexpected
-                    # send_error_response(client_socket, "Invalid request format", addr_str)
-                    continue # Skip to next recv
-
-                # Process each valid request found in the buffer
-                for request in requests:
-                    route_request(client_socket, request) # Route each request
-
+            except (BlockingIOError, InterruptedError):
+                continue # Spurious wakeup
             except ConnectionResetError:
                 log_info(f"Connection reset by {addr_str}")
                 break # Exit loop
@@ -138,50 +135,138 @@ def handle_client(client_socket, address):
                  log_warning(f"Socket timeout for {addr_str}. Connection might be unstable.")
                  # Continue listening or break? Continue for now.
                  continue
-            except Exception as loop_e: # Catch errors within the loop
-                 log_error(f"Error processing data from {addr_str}: {loop_e}", exc_info=True)
-                 # Maybe send an error response to the client if possible
-                 send_error_response(client_socket, "Internal server error processing request", addr_str)
-                 # Decide whether to continue or break the loop on error
-                 # continue # Try to continue processing further requests
 
     except Exception as outer_e: # Catch errors outside the loop (e.g., initial recv)
         log_error(f"Unhandled error in handle_client for {addr_str}: {outer_e}", exc_info=True)
     finally:
-        # --- Cleanup on Disconnection ---
-        log_info(f"Cleaning up connection for {addr_str}")
-        # Use the socket to find the username for disconnection cleanup
-        username_to_disconnect = connected_clients.get(client_socket)
-        if username_to_disconnect:
-            handle_client_disconnection(client_socket, username_to_disconnect)
-        else:
-             log_info(f"Socket from {addr_str} disconnected (was not authenticated or already cleaned up).")
+        close_client_connection(client_socket, addr_str)
 
-        # Remove from connected_clients map regardless
-        connected_clients.pop(client_socket, None)
+def process_client_data(client_socket, addr_str, decoder, data):
+    """Feeds received bytes to the connection's decoder and routes every complete request.
+    Shared by the threaded handler and the event-loop server."""
+    try:
+        if log_enabled(): # Decoding the data is not free, skip it unless debugging
+            log_debug("Received raw data from %s: %s...", addr_str, data[:200].decode('utf-8', errors='ignore'))
+        session = sessions.get(client_socket)
+        if session is not None:
+            session.bytes_received += len(data)
+        decoder.feed(data)
+
+        # Process each complete request; an incomplete tail stays buffered in the decoder
+        while True:
+            try:
+                frame = decoder.next_frame()
+            except FrameTooLarge as e:
+                log_error(f"Dropping oversized request from {addr_str}: {e}")
+                send_error_response(client_socket, "Request too large", addr_str)
+                continue
+            if frame is None:
+                break
+            try:
+                request = decoder.decode(frame)
+            except ValueError as e:
+                log_error(f"Invalid {decoder.protocol} request from {addr_str}: {e}. Data: '{frame[:50]}...'")
+                send_error_response(client_socket, "Invalid request format", addr_str)
+                continue
+            if not isinstance(request, dict):
+                log_error(f"Received non-dict request from {addr_str}: {request}")
+                continue
+            dispatch_request(client_socket, request) # Route each request
+            # An auth request may have switched the protocol; frame the remaining bytes accordingly
+            decoder.set_protocol(sessions.protocol_of(client_socket))
+
+    except Exception as loop_e: # Catch errors while processing this chunk
+         log_error(f"Error processing data from {addr_str}: {loop_e}", exc_info=True)
+         # Maybe send an error response to the client if possible
+         send_error_response(client_socket, "Internal server error processing request", addr_str)
+
+def close_client_connection(client_socket, addr_str):
+    """Cleanup on disconnection: presence, RAM mappings and the socket itself."""
+    log_info(f"Cleaning up connection for {addr_str}")
+    # Use the socket to find the username for disconnection cleanup
+    username_to_disconnect = sessions.username_of(client_socket)
+    unsubscribe_client(client_socket) # No pushes to a closing socket (incl. its own presence diffs)
+    if username_to_disconnect:
+        handle_client_disconnection(client_socket, username_to_disconnect)
+    else:
+         log_info(f"Socket from {addr_str} disconnected (was not authenticated or already cleaned up).")
 
-        try:
-             client_socket.close()
-             log_info(f"Closed socket for {addr_str}")
-        except Exception as close_e:
-             log_error(f"Error closing socket for {addr_str}: {close_e}")
+    # Remove the session regardless
+    sessions.close(client_socket)
+    outbound_stats = forget_outbound(client_socket)
+    if outbound_stats and (outbound_stats["dropped_frames"] or outbound_stats["coalesced_frames"]):
+        log_warning(f"Outbound queue of {addr_str} ({username_to_disconnect or 'unauthenticated'}): "
+                    f"peak depth {outbound_stats['peak_depth']}, dropped {outbound_stats['dropped_frames']}, "
+                    f"coalesced {outbound_stats['coalesced_frames']} frames")
+
+    try:
+         client_socket.close()
+         log_info(f"Closed socket for {addr_str}")
+    except Exception as close_e:
+         log_error(f"Error closing socket for {addr_str}: {close_e}")
 
 # --- Request Routing ---
+# Channel actions that change a channel; a connection's writes to one channel run in order
+CHANNEL_WRITE_ACTIONS = {"create_channel", "delete_channel", "join_channel", "save_message", "sync_to_server"}
+
+def request_lane(client_socket, data):
+    """(lane, write) of a request for the dispatcher: its connection and channel, if it has one."""
+    request_type = data.get("type")
+    if request_type == "channel":
+        channel_name = data.get("channel_name")
+        write = data.get("action") in CHANNEL_WRITE_ACTIONS
+    elif request_type == "livestream":
+        channel_name, write = data.get("channel_name"), True # Stores a system message
+    elif request_type == "get_user_status":
+        channel_name, write = data.get("channel"), False
+    else:
+        return None, False
+    if not isinstance(channel_name, str):
+        return None, False
+    return (client_socket, channel_name), write
+
+def handle_dispatched_request(client_socket, data):
+    """Runs a request with a request_id on a worker; its replies echo the id."""
+    if sessions.get(client_socket) is None:
+        return # Connection closed while the request was queued
+    with replying_to(client_socket, data["request_id"]):
+        route_request(client_socket, data)
+
+# Requests with a request_id run on worker threads, see dispatch.py
+request_dispatcher = RequestDispatcher(handle_dispatched_request, REQUEST_WORKERS) if REQUEST_WORKERS > 0 else None
+
+def dispatch_request(client_socket, data):
+    """Routes one decoded request: now, in arrival order, or on a worker if it carries a request_id.
+
+    Auth requests always run now: they can switch the wire protocol of the bytes behind them.
+    """
+    request_id = data.get("request_id")
+    if request_id is None:
+        route_request(client_socket, data)
+    elif request_dispatcher is None or data.get("type") == "auth":
+        with replying_to(client_socket, request_id):
+            route_request(client_socket, data)
+    else:
+        lane, write = request_lane(client_socket, data)
+        request_dispatcher.submit(lane, write, client_socket, data)
+
 def route_request(client_socket, data):
     """Routes incoming request data to the appropriate handler based on 'type'."""
-    global connected_clients, user_roles # Ensure user_roles is accessible
-    addr_info = client_socket.getpeername() if client_socket and client_socket.fileno() != -1 else "Unknown Address"
+    started = time.perf_counter()
+    session = sessions.get(client_socket) or sessions.open(client_socket, "Unknown Address")
+    addr_info = session.address
     try:
         request_type = data.get("type")
+        session.requests += 1
 
         # Get authenticated user based on the socket connection
-        authenticated_user = connected_clients.get(client_socket)
-        user_role = user_roles.get(authenticated_user) # Get user role (None if not found)
+        authenticated_user = session.username
+        user_role = session.role # Get user role (None if not logged in)
 
         # --- Authentication Check for most requests ---
         # Most request types require an authenticated user (can be 'guest' or 'authenticated')
         if request_type != "auth" and not authenticated_user:
-             log_warning(f"Unauthorized request type '{request_type}' from unauthenticated socket {addr_info}. Data: {data}")
+             log_warning("Unauthorized request type '%s' from unauthenticated socket %s. Data: %s", request_type, addr_info, data)
              send_error_response(client_socket, "Authentication required", addr_info)
              return # Stop processing
 
@@ -191,7 +276,7 @@ def route_request(client_socket, data):
 
         elif request_type == "tracker":
             # Tracker might have its own auth or be public? Assuming public for now.
-            response = handle_tracker_request(client_socket, data)
+            handle_tracker_request(client_socket, data)
             # Tracker handler should send its own response if needed
 
         elif request_type == "channel":
@@ -208,28 +293,37 @@ def route_request(client_socket, data):
                  send_error_response(client_socket, "Channel name required for get_user_status", addr_info)
                  return
 
-            # Get users for the specific channel from RAM
-            channel_data = channel_users.get(channel_name, {})
-            all_online = list(set(channel_data.get("online", []))) # Ensure unique
-            all_offline = list(set(channel_data.get("offline", []))) # Ensure unique
-
-            # --- MODIFICATION START: Filter out guests based on role ---
-            filtered_online = [user for user in all_online if user_roles.get(user) != "guest"]
-            filtered_offline = [user for user in all_offline if user_roles.get(user) != "guest"]
-            # --- MODIFICATION END ---
-
-            response = {
-                "status": "success",
-                "online": filtered_online, # Send filtered list
-                "offline": filtered_offline # Send filtered list
-            }
-            send_response_helper(client_socket, response, addr_info) # Use helper
-            log_info(f"Sent user status for '{channel_name}' to {authenticated_user or addr_info}: Online({len(filtered_online)}), Offline({len(filtered_offline)}) (Guests excluded)")
+            push = session.channel == channel_name
+            def build():
+                # Get users for the specific channel from RAM (sets, so already unique)
+                all_online, all_offline = channel_presence(channel_name)
+
+                # --- MODIFICATION START: Filter out guests based on role ---
+                filtered_online = [user for user in all_online if sessions.role_of(user) != "guest"]
+                filtered_offline = [user for user in all_offline if sessions.role_of(user) != "guest"]
+                # --- MODIFICATION END ---
+
+                return {
+                    "status": "success",
+                    "online": filtered_online, # Send filtered list
+                    "offline": filtered_offline, # Send filtered list
+                    # Changes to this list are pushed as presence diffs to connections following the channel
+                    "push": push
+                }
+            # Encoded once per presence change of the channel (response_cache.py)
+            send_cached_response(client_socket, channel_name, ("presence", push), build)
         elif request_type == "livestream":
                 handle_livestream_request(client_socket, data)
         else:
-            log_error(f"Invalid request type '{request_type}' from {authenticated_user or addr_info}. Data: {data}")
+            log_error("Invalid request type '%s' from %s. Data: %s", request_type, authenticated_user or addr_info, data)
             send_error_response(client_socket, f"Invalid request type: {request_type}", addr_info)
+            return
+
+        # One structured record per handled request; frequent actions are sampled (LOG_SAMPLE)
+        action = data.get("action") if request_type in ("channel", "auth", "livestream", "tracker") else request_type
+        log_info("Handled %s request from %s", action, session.username or addr_info,
+                 event=action, user=session.username, channel=data.get("channel_name") or data.get("channel"),
+                 latency_ms=round((time.perf_counter() - started) * 1000, 3))
 
     except Exception as e:
         log_error(f"Error routing request from {addr_info}: {e}", exc_info=True)
@@ -239,8 +333,8 @@ def route_request(client_socket, data):
 
 def handle_auth_request(client_socket, data):
     """Handles login, registration, guest login, and status updates."""
-    global connected_clients, user_roles, user_status # Need to modify globals
-    addr_info = client_socket.getpeername() if client_socket and client_socket.fileno() != -1 else "Unknown Address"
+    session = sessions.get(client_socket) or sessions.open(client_socket, "Unknown Address")
+    addr_info = session.address
     response = None # Initialize response
     try:
         action = data.get("action")
@@ -248,12 +342,10 @@ def handle_auth_request(client_socket, data):
         if action == "login":
             username = data.get("username")
             password = data.get("password")
-            if authenticate_user(username, password): # This now also updates file status to online
+            if authenticate_user(username, password):
                 response = {"status": "success", "message": f"Welcome back, {username}!", "role": "authenticated"}
-                # Update RAM state
-                user_status[username] = "online"
-                user_roles[username] = "authenticated"
-                connected_clients[client_socket] = username # Map socket to username AFTER successful auth
+                # Update RAM state: map the session to the username AFTER successful auth
+                sessions.bind(session, username, "authenticated", "online")
                 log_info(f"User '{username}' authenticated successfully from {addr_info}.")
                 # Update user's presence in relevant channel lists (call helper)
                 update_user_channel_presence(username, "online")
@@ -274,11 +366,9 @@ def handle_auth_request(client_socket, data):
                 guest_username = f"{visitor_name}" # Consider making this more robust
                 # Check if guest_username conflicts? For now, allow.
                 response = {"status": "success", "message": f"Welcome, {guest_username}!", "role": "guest"}
-                # Update RAM state for guest
-                user_status[guest_username] = "online" # Guests are online when connected
-                user_roles[guest_username] = "guest" # GÁN VAI TRÒ GUEST
-                log_info(f"Assigned role '{user_roles.get(guest_username)}' to user '{guest_username}'.") # THÊM LOG KIỂM TRA
-                connected_clients[client_socket] = guest_username # Map socket to guest username
+                # Update RAM state for guest: guests are online when connected (GÁN VAI TRÒ GUEST)
+                sessions.bind(session, guest_username, "guest", "online")
+                log_info(f"Assigned role '{session.role}' to user '{guest_username}'.") # THÊM LOG KIỂM TRA
                 log_info(f"User '{guest_username}' connected as guest from {addr_info}.")
                 # Update guest's presence in relevant channel lists (call helper)
                 update_user_channel_presence(guest_username, "online")
@@ -289,7 +379,7 @@ def handle_auth_request(client_socket, data):
              username_to_update = data.get("username")
              new_status = data.get("status")
              # Security: Verify the request comes from the correct authenticated user's socket
-             authenticated_user = connected_clients.get(client_socket)
+             authenticated_user = session.username
 
              if not authenticated_user:
                  response = {"status": "error", "message": "Authentication required to update status"}
@@ -297,7 +387,7 @@ def handle_auth_request(client_socket, data):
              elif authenticated_user != username_to_update:
                  response = {"status": "error", "message": "Authentication mismatch for status update"}
                  log_error(f"Status update mismatch: Socket {addr_info} (Auth: {authenticated_user}) tried to update status for '{username_to_update}'")
-             elif user_roles.get(authenticated_user) == "guest":
+             elif session.role == "guest":
                   response = {"status": "error", "message": "Guests cannot change status"}
                   log_warning(f"Guest '{authenticated_user}' attempted to change status from {addr_info}.")
              elif new_status not in {"online", "offline", "invisible"}:
@@ -309,141 +399,69 @@ def handle_auth_request(client_socket, data):
         else:
             response = {"status": "error", "message": f"Invalid auth action: {action}"}
 
+        # --- Wire protocol negotiation ---
+        # The reply still goes out in the current protocol; the switch applies to the next frame
+        new_protocol = None
+        if response and "protocols" in data:
+            new_protocol = negotiate(data.get("protocols"), WIRE_PROTOCOLS)
+            response["protocol"] = new_protocol
+
         # Send response if one was generated
         if response:
             send_response_helper(client_socket, response, addr_info)
+        if new_protocol:
+            session.protocol = new_protocol
+            log_info(f"Connection {addr_info} uses wire protocol '{new_protocol}'.")
 
     except Exception as e:
         log_error(f"Error handling auth request for {addr_info}: {e}", exc_info=True)
         send_error_response(client_socket, "Internal server error during authentication", addr_info)
 
 # --- User Data Persistence ---
-def load_users():
-    """Loads user data from the JSON file."""
-    try:
-        # Ensure file exists before reading
-        if not os.path.exists(USER_DATA_FILE):
-             log_warning(f"{USER_DATA_FILE} not found during load. Returning empty.")
-             return {"users": []}
-        with open(USER_DATA_FILE, "r") as f:
-            try:
-                 users_data = json.load(f)
-                 # Basic validation
-                 if not isinstance(users_data, dict) or not isinstance(users_data.get("users"), list):
-                      log_error(f"Invalid format in {USER_DATA_FILE}. Returning empty.")
-                      return {"users": []}
-                 return users_data
-            except json.JSONDecodeError as e:
-                 log_error(f"Error decoding JSON from {USER_DATA_FILE}: {e}. Returning empty.")
-                 return {"users": []}
-    except Exception as e:
-        log_error(f"Unexpected error loading users from {USER_DATA_FILE}: {e}", exc_info=True)
-        return {"users": []}
-
-def save_users(users_data):
-    """Saves user data to the JSON file."""
-    try:
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(USER_DATA_FILE), exist_ok=True)
-        with open(USER_DATA_FILE, "w") as file:
-            json.dump(users_data, file, indent=4)
-    except Exception as e:
-        log_error(f"Error saving users to {USER_DATA_FILE}: {e}", exc_info=True)
-        # Depending on severity, might want to raise the exception
-
 def authenticate_user(username, password):
-    """Checks credentials against users.json and updates status to 'online' in file on success."""
+    """Checks credentials in the user registry."""
     if not username or not password: return False
-    users_data = load_users()
-    user_found = False
-    for user in users_data.get("users", []):
-        # !! IMPORTANT: In a real app, NEVER store plain passwords. Use hashing (e.g., bcrypt).
-        if user.get("username") == username and user.get("password") == password:
-            # Update status to 'online' in the structure before saving
-            user["status"] = "online"
-            user_found = True
-            break
-
-    if user_found:
-        try:
-            save_users(users_data) # Save the updated status to file
-            return True
-        except Exception as e:
-            log_error(f"Failed to save user status to file during authentication for '{username}': {e}")
-            # Decide if auth should still succeed. For now, yes.
-            return True
-    else:
+    try:
+        return users_repository.authenticate(username, password)
+    except Exception as e:
+        log_error(f"Failed to check credentials for '{username}': {e}", exc_info=True)
         return False
 
 def register_user(username, password):
-    """Registers a new user, saving to users.json with 'offline' status."""
+    """Registers a new user (persisted by the user repository) with 'offline' status."""
     if not username or not password:
         return {"status": "error", "message": "Username and password are required"}
     # Add more validation (length, characters, password complexity) here
 
-    users_data = load_users()
-    if not isinstance(users_data.get("users"), list):
-         log_error(f"Correcting invalid 'users' list format in {USER_DATA_FILE} during registration.")
-         users_data["users"] = []
-
-    # Check if username already exists
-    if any(user.get("username") == username for user in users_data["users"]):
-        log_warning(f"Registration failed: Username '{username}' already exists.")
-        return {"status": "error", "message": "Username already exists"}
-
-    # Add new user (store hashed password in real app)
-    users_data["users"].append({
-        "username": username,
-        "password": password, # HASH THIS PASSWORD
-        "status": "offline"  # Initial status is offline
-    })
-
     try:
-        save_users(users_data)
+        # Add new user (store hashed password in real app)
+        if not users_repository.register(username, password):
+            log_warning(f"Registration failed: Username '{username}' already exists.")
+            return {"status": "error", "message": "Username already exists"}
         log_info(f"User '{username}' registered successfully.")
         return {"status": "success", "message": "User registered successfully"}
     except Exception as e:
-        log_error(f"Failed to save new user '{username}' to file: {e}")
-        # Consider cleanup if save fails?
+        log_error(f"Failed to save new user '{username}': {e}")
         return {"status": "error", "message": "Failed to save user data during registration"}
 
 # --- Status and Presence Management ---
 def change_user_status(username, new_status):
-    """Updates user status in RAM (user_status), file (users.json), and updates channel presence lists."""
-    global user_status # Ensure access to global
+    """Updates user status in RAM (the user's session) and updates channel presence lists."""
     try:
         log_info(f"Attempting to change status for '{username}' to '{new_status}'...")
-        previous_ram_status = user_status.get(username)
-
-        # --- Update users.json ---
-        users_data = load_users()
-        user_found_in_file = False
-        if isinstance(users_data.get("users"), list):
-            for user in users_data["users"]:
-                if user.get("username") == username:
-                    user["status"] = new_status
-                    user_found_in_file = True
-                    break
-        else:
-             log_error(f"Invalid format in {USER_DATA_FILE} during status change for '{username}'.")
-
-        if not user_found_in_file and user_roles.get(username) != "guest":
-             log_warning(f"User '{username}' not found in {USER_DATA_FILE} during status change (might be guest or error).")
-             # Proceed with RAM update but be aware of inconsistency
-
-        if user_found_in_file or user_roles.get(username) != "guest": # Save if found or if not a guest
-             try:
-                 save_users(users_data)
-                 log_info(f"Updated status for '{username}' to '{new_status}' in {USER_DATA_FILE}.")
-             except Exception as e:
-                 log_error(f"Failed to save status update for '{username}' to {USER_DATA_FILE}: {e}")
-                 # Proceed with RAM update anyway? Yes.
-
-        # --- Update RAM (user_status) ---
-        user_status[username] = new_status
+        previous_ram_status = sessions.status_of(username)
+
+        if not users_repository.is_registered(username) and sessions.role_of(username) != "guest":
+            log_warning(f"User '{username}' not found in user storage during status change (might be guest or error).")
+            # Proceed with RAM update but be aware of inconsistency
+
+        # --- Update RAM (session status) ---
+        session = sessions.by_username(username)
+        if session is not None:
+            session.status = new_status
         log_info(f"Updated RAM status for '{username}' from '{previous_ram_status}' to '{new_status}'.")
 
-        # --- Update RAM (channel_users presence) ---
+        # --- Update RAM (channel presence) ---
         update_user_channel_presence(username, new_status)
 
         # --- Broadcast Status Change (Optional) ---
@@ -457,10 +475,9 @@ def change_user_status(username, new_status):
 def handle_livestream_request(client_socket, data):
     """Handles requests related to livestreaming (e.g., start notification)."""
     # Sửa: Thêm save_system_message vào global nếu cần (không cần vì đã import)
-    global connected_clients, channel_users
-    addr_info = client_socket.getpeername() if client_socket and client_socket.fileno() != -1 else "Unknown Address"
+    addr_info = sessions.address_of(client_socket)
     action = data.get("action")
-    streamer_username = connected_clients.get(client_socket) # Get username associated with this socket
+    streamer_username = sessions.username_of(client_socket) # Get username associated with this socket
 
     # --- Authentication Check ---
     if not streamer_username:
@@ -468,7 +485,7 @@ def handle_livestream_request(client_socket, data):
         send_error_response(client_socket, "Authentication required for livestream actions", addr_info)
         return
     # Optional: Check if guest users can stream
-    # if user_roles.get(streamer_username) == "guest":
+    # if sessions.role_of(streamer_username) == "guest":
     #     log_warning(f"Guest user '{streamer_username}' attempted livestream action '{action}'.")
     #     send_error_response(client_socket, "Guests cannot perform livestream actions", addr_info)
     #     return
@@ -500,39 +517,20 @@ def handle_livestream_request(client_socket, data):
                 "timestamp": datetime.datetime.utcnow().isoformat() + "Z"
             }
 
+            # --- Broadcast to Channel Members ---
+            # Same push as any new channel message: encoded once, queued for every
+            # connection following the channel (except the streamer's)
+            def broadcast_notification():
+                recipients = broadcast_new_message(channel_name, message_content_to_save, exclude_socket=client_socket)
+                log_info(f"Livestream notification from '{streamer_username}' pushed to {recipients} connection(s) in '{channel_name}'.")
+
             # --- Save Notification to Channel History ---
-            # Gọi hàm save_system_message từ channel_manager
-            if save_system_message(channel_name, message_content_to_save):
-                log_info(f"Livestream start notification saved for channel '{channel_name}'.")
-            else:
+            # Gọi hàm save_system_message từ channel_manager. Pushed once durable
+            # (group commit), without blocking this thread meanwhile
+            if not save_system_message(channel_name, message_content_to_save, on_saved=broadcast_notification):
                 # Log lỗi nhưng vẫn tiếp tục broadcast nếu có thể
                 log_error(f"Failed to save livestream start notification for channel '{channel_name}'.")
-
-            # --- Create Broadcast Message ---
-            # This is the full message sent to clients in real-time
-            broadcast_message = {
-                "type": "channel", # Keep type as channel so client sync picks it up
-                "action": "new_message", # Simulate a new message arrival
-                "message_data": message_content_to_save # Embed the saved content
-            }
-
-            # --- Broadcast to Channel Members ---
-            target_users = set()
-            # Combine online and offline users of the channel, as anyone joined should get notified
-            channel_data = channel_users.get(channel_name, {})
-            target_users.update(channel_data.get("online", []))
-            target_users.update(channel_data.get("offline", []))
-
-            log_debug(f"Broadcasting livestream start from '{streamer_username}' in '{channel_name}' to users: {target_users}")
-
-            # Iterate through all connected sockets
-            for target_socket, target_username in connected_clients.items():
-                # Check if the user is in the target channel AND is NOT the streamer themselves
-                if target_username in target_users and target_username != streamer_username:
-                    target_addr = target_socket.getpeername() if target_socket and target_socket.fileno() != -1 else "Unknown"
-                    log_info(f"Sending livestream notification to {target_username} ({target_addr})")
-                    # Gửi tin nhắn broadcast đã tạo
-                    send_response_helper(target_socket, broadcast_message, target_addr)
+                broadcast_notification()
 
             # Optionally send a confirmation back to the streamer?
             # send_response_helper(client_socket, {"status": "success", "message": "Livestream notification sent"}, addr_info)
@@ -557,94 +555,37 @@ def handle_livestream_request(client_socket, data):
         log_error(f"Invalid livestream action '{action}' from {streamer_username} ({addr_info}).")
         send_error_response(client_socket, f"Invalid livestream action: {action}", addr_info)
 def update_user_channel_presence(username, current_status):
-    """Updates the online/offline lists in channel_users based on user's status."""
-    global channel_users
+    """Moves the user between the online/offline lists of the channels they are in (presence.py)."""
     is_present_online = current_status == "online" # Only 'online' counts as present
-    # log_debug(f"Updating channel presence for '{username}' (Status: {current_status}, PresentOnline: {is_present_online})")
-
-    for channel_name, channel_data in channel_users.items():
-        online_list = channel_data.setdefault("online", [])
-        offline_list = channel_data.setdefault("offline", [])
-
-        # Remove from both lists first for clean transition
-        was_online = False
-        if username in online_list:
-            online_list.remove(username)
-            was_online = True
-
-        was_offline = False
-        if username in offline_list:
-            offline_list.remove(username)
-            was_offline = True
-
-        # Add to the correct list based on new presence
-        if is_present_online:
-            if username not in online_list: # Avoid duplicates
-                 online_list.append(username)
-                 if not was_online: log_debug(f"'{username}' added to online list for '{channel_name}'.")
-            # else: was already online, no change needed after removal/add
-        else: # offline or invisible
-            if username not in offline_list: # Avoid duplicates
-                 offline_list.append(username)
-                #  if not was_offline: log_debug(f"'{username}' added to offline list for '{channel_name}'.")
-            # else: was already offline, no change needed after removal/add
-
-        # Log if presence state changed
-        # if was_online != is_present_online:
-        #      log_info(f"Presence updated for '{username}' in channel '{channel_name}': {'Online' if is_present_online else 'Offline'}")
+    # Push a diff to the channel's subscribers only where the user moved lists
+    for channel_name in update_user_presence(username, is_present_online):
+        broadcast_presence(channel_name, username, "online" if is_present_online else "offline")
 
 
 def handle_client_disconnection(client_socket, username):
     """Handles cleanup when a known client disconnects."""
-    # Sửa: Thêm global channel_users và user_status để sửa đổi trực tiếp
-    global user_roles, channel_users, user_status
-    addr_info = client_socket.getpeername() if client_socket and client_socket.fileno() != -1 else "Unknown Address"
+    session = sessions.get(client_socket)
+    addr_info = sessions.address_of(client_socket)
     try:
         log_info(f"Handling disconnection for user '{username}' from {addr_info}...")
 
-        # --- 1. Update status to 'offline' in users.json ---
-        users_data = load_users()
-        user_found_in_file = False
-        if isinstance(users_data.get("users"), list):
-            for user in users_data["users"]:
-                if user.get("username") == username:
-                    if user.get("status") != "offline": # Only save if status changes
-                        user["status"] = "offline"
-                        user_found_in_file = True
-                        try:
-                            save_users(users_data)
-                            log_info(f"Updated status to 'offline' for '{username}' in {USER_DATA_FILE}.")
-                        except Exception as e_save:
-                            log_error(f"Failed to save offline status for disconnected user '{username}' to {USER_DATA_FILE}: {e_save}")
-                    else:
-                        user_found_in_file = True # Found, but already offline in file
-                    break
-        if not user_found_in_file and user_roles.get(username) != "guest":
-             log_warning(f"Disconnected user '{username}' not found in {USER_DATA_FILE} (might be guest or error).")
+        # --- 1. Check the user is registered (the status lives in the session, step 3) ---
+        if not users_repository.is_registered(username) and sessions.role_of(username) != "guest":
+             log_warning(f"Disconnected user '{username}' not found in user storage (might be guest or error).")
 
         # --- 2. Remove user COMPLETELY from channel presence lists (RAM) ---
         log_info(f"Removing disconnected user '{username}' from all channel presence lists.")
-        for channel_name, channel_data in channel_users.items():
-            removed_online = False
-            removed_offline = False
-            if username in channel_data.get("online", []):
-                channel_data["online"].remove(username)
-                removed_online = True
-            if username in channel_data.get("offline", []):
-                channel_data["offline"].remove(username)
-                removed_offline = True
-            # if removed_online or removed_offline:
-            #      log_debug(f"Removed '{username}' from presence lists for channel '{channel_name}'.")
-
-        # --- 3. Update RAM status (user_status) ---
+        for channel_name in remove_user(username): # Only the channels the user was listed in
+            broadcast_presence(channel_name, username, "left")
+
+        # --- 3. Update RAM status (session) ---
         # Vẫn cập nhật RAM status để phản ánh trạng thái logic cuối cùng
-        if user_status.get(username) != "offline":
-            user_status[username] = "offline"
+        if session is not None and session.status != "offline":
+            session.status = "offline"
             log_info(f"Set RAM status to 'offline' for disconnected user '{username}'.")
 
         # --- 4. Remove from other RAM mappings ---
-        # connected_clients removal happens in handle_client finally block
-        user_roles.pop(username, None) # Remove role mapping
+        # The session itself is closed by close_client_connection
 
         # --- Broadcast User List Update (Optional) ---
         # broadcast_user_list_update_for_user(username) # Implement if needed
@@ -658,8 +599,16 @@ def handle_client_disconnection(client_socket, username):
 def shutdown_server(server_socket):
     """Gracefully shuts down the server."""
     log_info("Initiating server shutdown...")
+    log_info(f"Sessions at shutdown: {sessions.stats()}")
+    log_info(f"Response cache stats: {response_cache.stats()}")
+    if request_dispatcher is not None:
+        log_info(f"Request workers stats: {request_dispatcher.stats()}")
+        request_dispatcher.shutdown()
     # Set all connected users to offline before closing sockets
-    for sock, user in list(connected_clients.items()):
+    for session in sessions.all():
+         sock, user = session.sock, session.username
+         if user is None:
+             continue # Never logged in
          log_info(f"Marking user '{user}' as offline due to server shutdown.")
          # Use the change_user_status function for consistency
          change_user_status(user, "offline")
@@ -670,10 +619,9 @@ def shutdown_server(server_socket):
          except Exception as e:
              log_error(f"Error closing client socket for '{user}' during shutdown: {e}")
 
-    connected_clients.clear() # Clear the map
-    user_roles.clear()
-    user_status.clear()
-    channel_users.clear()
+    sessions.clear() # Clear the registry
+    channel_subscribers.clear()
+    clear_presence()
 
     try:
         if server_socket:
@@ -682,7 +630,12 @@ def shutdown_server(server_socket):
     except Exception as e:
         log_error(f"Error closing server socket: {e}")
 
+    # Persist channel changes the write-behind thread has not written yet
+    flush_channels()
+
+    log_info(f"Logger stats: {log_stats()}")
     log_info("Server shutdown complete.")
+    flush_logs() # os._exit skips atexit, so write the queued lines now
     # Use os._exit(0) for a more immediate exit if threads might hang
     os._exit(0) # Force exit after cleanup
 
@@ -696,8 +649,7 @@ def send_response_helper(client_socket, response_data, addr_info=""):
         if not isinstance(response_data, dict):
              log_error(f"Invalid response data type: {type(response_data)}. Data: {response_data}")
              response_data = {"status": "error", "message": "Internal server error: Invalid response format"}
-        json_string = json.dumps(response_data) + "\n"
-        client_socket.sendall(json_string.encode('utf-8'))
+        send_message(client_socket, response_data)
         # log_debug(f"Sent response to {addr_info}: {response_data}") # Use debug if too verbose
     except Exception as e:
         log_error(f"Failed to send response to {addr_info}: {e}. Data: {response_data}")
@@ -706,15 +658,11 @@ def send_error_response(client_socket, message, addr_info=""):
     """Sends a standardized error response."""
     send_response_helper(client_socket, {"status": "error", "message": message}, addr_info)
 
-def log_warning(message):
-    """Logs a warning message."""
-    log_info(f"[WARNING] {message}") # Use log_info with prefix for now
-
-def log_debug(message):
-    """Logs a debug message (can be disabled later)."""
-    # print(f"[DEBUG] {message}") # Simple print for debug
-    log_info(f"[DEBUG] {message}") # Or use info level
+def handle_sigterm(signum, frame):
+    """Treats SIGTERM like Ctrl+C so shutdown_server() runs and flushes pending channel changes."""
+    raise KeyboardInterrupt()
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_sigterm)
     start_server()
\ No newline at end of file
@@ -0,0 +1,390 @@
+import bisect
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+from contextlib import nullcontext
+from logger import log_info, log_error
+from channel_store import JsonFileBackend
+from common.framing import LENGTH_PREFIX
+
+# Append-only segmented message log (CHANNEL_STORAGE = "log").
+# Every channel has a directory of segment files. A record is a 4-byte big-endian
+# length followed by one message as compact UTF-8 JSON, so storing a message
+# writes only that record, whatever the size of the history. Once the active
+# segment reaches segment_bytes a new one is started, named after the seq of its
+# first record.
+#
+# Segments are scanned once when the log is opened (a partial record left by a
+# crash is truncated) and a sparse index is built: about every index_interval
+# bytes one entry (record number, segment, offset).
+#
+# The log is optimized for writing: the server still keeps every channel's
+# messages in memory (loaded here once) and answers get_history (history.py)
+# and sync_from_server from that list. The one read served from disk
+# is the large streamed catch-up: payload_chunks bisects the index to the first
+# wanted record, maps the segments and hands out the stored JSON payloads as
+# memoryviews, which the server joins straight into history_chunk frames (one
+# copy, no decode / encode).
+#
+# Channel metadata (owner, host, participants, ...) is kept in meta.json next to
+# the channel directories. It is rewritten atomically only when a channel's
+# metadata or log directory changed, so storing a message does not touch it;
+# last_seq is not kept there but read from the last record of the log.
+
+META_FILE = "meta.json"
+SEGMENT_SUFFIX = ".log"
+
+
+def encode_record(message):
+    payload = json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return LENGTH_PREFIX.pack(len(payload)) + payload
+
+
+def iter_records(data, offset=0):
+    """Yields (offset, payload) for every complete record in data from offset on."""
+    header = LENGTH_PREFIX.size
+    end = len(data)
+    while offset + header <= end:
+        (length,) = LENGTH_PREFIX.unpack_from(data, offset)
+        if offset + header + length > end:
+            break
+        yield offset, data[offset + header:offset + header + length]
+        offset += header + length
+
+
+class Segment:
+    __slots__ = ("path", "base_seq", "size")
+
+    def __init__(self, path, base_seq, size=0):
+        self.path = path
+        self.base_seq = base_seq
+        self.size = size # Bytes of complete records, all flushed to the file
+
+
+class ChannelLog:
+    """The segments of one channel plus their sparse index."""
+
+    def __init__(self, directory, segment_bytes, index_interval):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.lock = threading.Lock()
+        self.segments = []
+        # Sparse index, one entry per indexed record, both lists sorted
+        self.index_positions = []     # (segment number, offset)
+        self.index_records = []       # Record number (0-based, over the whole log)
+        self.count = 0
+        self._unindexed_bytes = 0
+        self._active = None           # Append handle of the last segment
+
+    # --- Opening ---
+    def open(self):
+        """Scans the existing segments, builds the index and returns every stored message."""
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        messages = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            segment = Segment(path, int(name[:-len(SEGMENT_SUFFIX)]))
+            self.segments.append(segment)
+            with open(path, "rb") as file:
+                data = file.read()
+            for offset, payload in iter_records(data):
+                message = json.loads(payload)
+                self._note_record(offset, LENGTH_PREFIX.size + len(payload))
+                messages.append(message)
+                segment.size = offset + LENGTH_PREFIX.size + len(payload)
+            if segment.size < len(data):
+                log_error(f"Truncating {len(data) - segment.size} trailing byte(s) of partial record in {path}.")
+                with open(path, "r+b") as file:
+                    file.truncate(segment.size)
+        if self.segments:
+            self._active = open(self.segments[-1].path, "ab")
+        return messages
+
+    def _note_record(self, offset, length):
+        """Counts one record of the last segment and indexes it if due. Called with the lock held or before sharing."""
+        if offset == 0 or self._unindexed_bytes >= self.index_interval:
+            self.index_positions.append((len(self.segments) - 1, offset))
+            self.index_records.append(self.count)
+            self._unindexed_bytes = 0
+        self._unindexed_bytes += length
+        self.count += 1
+
+    # --- Writing ---
+    def append(self, messages):
+        """Appends messages (already numbered) as records and flushes them to the file."""
+        with self.lock:
+            pending = bytearray()
+            for message in messages:
+                record = encode_record(message)
+                segment = self.segments[-1] if self.segments else None
+                if segment is None or segment.size + len(pending) >= self.segment_bytes:
+                    self._write(pending)
+                    pending = bytearray()
+                    seq = message.get("seq") if isinstance(message, dict) else None
+                    self._roll(seq if isinstance(seq, int) else self.count + 1)
+                    segment = self.segments[-1]
+                self._note_record(segment.size + len(pending), len(record))
+                pending += record
+            self._write(pending)
+
+    def _write(self, data):
+        if data:
+            self._active.write(data)
+            self._active.flush()
+            os.fsync(self._active.fileno()) # Durable once append() returns
+            self.segments[-1].size += len(data)
+
+    def _roll(self, base_seq):
+        if self._active is not None:
+            self._active.close()
+        path = os.path.join(self.directory, f"{base_seq:020d}{SEGMENT_SUFFIX}")
+        self.segments.append(Segment(path, base_seq))
+        self._active = open(path, "ab")
+
+    def close(self):
+        with self.lock:
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+
+    def destroy(self):
+        """Closes and deletes the whole channel log."""
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # --- Reading ---
+    def payload_chunks(self, first_record, end_record, per_chunk):
+        """Payloads of records [first_record, end_record) as lists of at most per_chunk memoryviews.
+
+        The segments are mapped before this returns (OSError if they are gone), so
+        the log may be appended to or deleted while the chunks are consumed. Each
+        list is valid only until the next one is requested.
+        """
+        with self.lock:
+            if not 0 <= first_record < end_record <= self.count:
+                raise ValueError(f"Records {first_record}..{end_record} not in log of {self.count}")
+            entry = bisect.bisect_right(self.index_records, first_record) - 1
+            segment_number, offset = self.index_positions[entry]
+            skip = first_record - self.index_records[entry]
+            segments = [(s.path, s.size) for s in self.segments[segment_number:]]
+        maps = []
+        try:
+            for path, size in segments:
+                if size:
+                    with open(path, "rb") as file:
+                        maps.append(mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ))
+        except BaseException:
+            for mapped in maps:
+                mapped.close()
+            raise
+        return self._iter_payloads(maps, offset, skip, end_record - first_record, per_chunk)
+
+    @staticmethod
+    def _iter_payloads(maps, offset, skip, count, per_chunk):
+        unpack = LENGTH_PREFIX.unpack_from
+        header = LENGTH_PREFIX.size
+        views = []
+        chunk = []
+        try:
+            for mapped in maps:
+                view = memoryview(mapped)
+                views.append(view)
+                size = len(mapped)
+                while skip and offset < size: # Records between the index entry and the first wanted one
+                    offset += header + unpack(mapped, offset)[0]
+                    skip -= 1
+                while offset < size and count:
+                    start = offset + header
+                    offset = start + unpack(mapped, offset)[0]
+                    chunk.append(view[start:offset])
+                    count -= 1
+                    if len(chunk) == per_chunk:
+                        yield chunk
+                        for payload in chunk:
+                            payload.release()
+                        chunk = []
+                offset = 0
+            if chunk:
+                yield chunk
+        finally:
+            # Views must be released before their map is closed
+            for payload in chunk:
+                payload.release()
+            for view in views:
+                view.release()
+            for mapped in maps:
+                mapped.close()
+
+
+class MessageLogBackend:
+    """ChannelStore backend keeping each channel's history in a ChannelLog."""
+
+    def __init__(self, directory, legacy_json_path=None, segment_bytes=8 * 1024 * 1024, index_interval=4096):
+        self.directory = directory
+        self.legacy_json_path = legacy_json_path
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.logs = {}        # Key: channel name, Value: ChannelLog
+        self._log_dirs = {}   # Key: channel name, Value: directory name inside self.directory
+        self._next_log_id = 1
+        # What is on disk. Key: channel name, Value: (channel_data, messages list, records written)
+        self._persisted = {}
+        self._meta = {}       # Key: channel name, Value: its metadata as last written to meta.json
+        self._meta_stale = False # meta.json must be rewritten (a previous rewrite may have failed)
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.directory, META_FILE)
+
+    def logged_records(self, channel_name, messages_list):
+        """(log, n): the log of a channel holds messages_list[:n] as its first n records.
+
+        (None, 0) when messages_list is not the list that was written (e.g. the
+        channel was recreated) or nothing was written yet.
+        """
+        persisted = self._persisted.get(channel_name)
+        if persisted is None or persisted[1] is not messages_list:
+            return None, 0
+        log = self.logs.get(channel_name)
+        return (log, persisted[2]) if log is not None else (None, 0)
+
+    # --- Loading ---
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self.meta_path):
+            return self._migrate()
+        with open(self.meta_path, "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        self._next_log_id = meta.get("next_log_id", 1)
+        channels = {}
+        for name, entry in meta.get("channels", {}).items():
+            log = self._open_log(name, entry["log"])
+            messages = log.open()
+            self._meta[name] = self._channel_meta(entry.get("data", {})) # Older files also hold last_seq
+            channel_data = dict(self._meta[name])
+            channel_data["messages"] = messages
+            last = messages[-1] if messages else None
+            channel_data["last_seq"] = last.get("seq", len(messages)) if isinstance(last, dict) else len(messages)
+            channels[name] = channel_data
+            self._persisted[name] = (channel_data, messages, len(messages))
+        log_info(f"Loaded {len(channels)} channel(s) from message log {self.directory}.")
+        return {"channels": channels}
+
+    def _migrate(self):
+        """One-shot import of channels.json into the log, the first time the log is used."""
+        if not self.legacy_json_path or not os.path.exists(self.legacy_json_path):
+            self._write_meta()
+            return {"channels": {}}
+        data = JsonFileBackend(self.legacy_json_path).load()
+        total = 0
+        for name, channel_data in data["channels"].items():
+            messages = channel_data.get("messages")
+            if not isinstance(messages, list):
+                messages = channel_data["messages"] = []
+            if "last_seq" not in channel_data:
+                # Same numbering as channel_manager.ensure_message_seqs
+                for index, message in enumerate(messages):
+                    if isinstance(message, dict):
+                        message["seq"] = index + 1
+                channel_data["last_seq"] = len(messages)
+            log = self._open_log(name, self._new_log_dir(name))
+            log.open()
+            log.append(messages)
+            self._persisted[name] = (channel_data, messages, len(messages))
+            self._meta[name] = self._channel_meta(channel_data)
+            total += len(messages)
+        self._write_meta()
+        log_info(f"Migrated {len(data['channels'])} channel(s) and {total} message(s) from "
+                 f"{self.legacy_json_path} to message log {self.directory}; the JSON file is no longer read.")
+        return data
+
+    def _new_log_dir(self, name):
+        log_dir = f"{self._next_log_id:06d}-{re.sub(r'[^A-Za-z0-9_-]', '_', name)[:40]}"
+        self._next_log_id += 1
+        return log_dir
+
+    def _open_log(self, name, log_dir):
+        self._log_dirs[name] = log_dir
+        log = ChannelLog(os.path.join(self.directory, log_dir), self.segment_bytes, self.index_interval)
+        self.logs[name] = log
+        return log
+
+    # --- Write-behind ---
+    def capture(self, data, changed_channels=None, channel_lock=None):
+        channels = data.get("channels", {})
+        # Channels deleted, or replaced by a new object (deleted and created again)
+        dropped = [name for name, (channel_data, messages, _) in self._persisted.items()
+                   if channels.get(name) is not channel_data or channel_data.get("messages") is not messages]
+        appends = []
+        changed = {} # Channels whose metadata differs from meta.json
+        for name, channel_data in channels.items():
+            persisted = self._persisted.get(name)
+            if persisted is not None and name not in dropped and changed_channels is not None \
+                    and name not in changed_channels:
+                continue # Not changed since the last capture
+            with channel_lock(name) if channel_lock is not None else nullcontext():
+                messages = channel_data.get("messages")
+                if not isinstance(messages, list):
+                    continue
+                written = persisted[2] if persisted and name not in dropped else 0
+                if persisted is None or name in dropped or len(messages) > written:
+                    appends.append((name, channel_data, messages, written, messages[written:]))
+                meta = self._channel_meta(channel_data)
+            if name in dropped or meta != self._meta.get(name):
+                changed[name] = meta
+        return dropped, appends, changed
+
+    @staticmethod
+    def _channel_meta(channel_data):
+        """Copy of what meta.json keeps of a channel: everything but its messages and last_seq."""
+        return {key: list(value) if isinstance(value, list) else value
+                for key, value in channel_data.items() if key not in ("messages", "last_seq")}
+
+    def write(self, work):
+        dropped, appends, changed = work
+        if dropped or changed:
+            self._meta_stale = True
+        for name in dropped:
+            self._persisted.pop(name, None)
+            self._log_dirs.pop(name, None)
+            log = self.logs.pop(name, None)
+            if log is not None:
+                log.destroy()
+        for name, channel_data, messages, written, new_messages in appends:
+            log = self.logs.get(name)
+            if log is None:
+                log = self._open_log(name, self._new_log_dir(name))
+                log.open()
+                self._meta_stale = True
+            log.append(new_messages)
+            self._persisted[name] = (channel_data, messages, written + len(new_messages))
+        if self._meta_stale:
+            # Only after the records, so meta.json never names a log that is not on disk
+            self._write_meta(changed)
+
+    def _write_meta(self, changed=None):
+        """Rewrites meta.json, after merging changed (channel name -> metadata) into what was written."""
+        meta = dict(self._meta)
+        meta.update(changed or {})
+        meta = {name: data for name, data in meta.items() if name in self._log_dirs} # Not the deleted channels
+        document = {
+            "next_log_id": self._next_log_id,
+            "channels": {name: {"log": self._log_dirs[name], "data": data} for name, data in meta.items()},
+        }
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(document, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.meta_path)
+        self._meta = meta
+        self._meta_stale = False
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
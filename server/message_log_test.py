@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from message_log import ChannelLog, MessageLogBackend, META_FILE, SEGMENT_SUFFIX
+
+
+def make_messages(first_seq, count):
+    return [{"username": "alice", "message": f"Message {seq}", "timestamp": f"2024-01-01T00:00:{seq % 60:02d}Z",
+             "seq": seq} for seq in range(first_seq, first_seq + count)]
+
+
+class TestChannelLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open_log(self, segment_bytes=1024, index_interval=256):
+        log = ChannelLog(self.directory, segment_bytes, index_interval)
+        self.addCleanup(log.close)
+        return log, log.open()
+
+    def segment_names(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def read_records(self, log, first, end, per_chunk=7):
+        return [json.loads(bytes(payload)) for payloads in log.payload_chunks(first, end, per_chunk)
+                for payload in payloads]
+
+    def test_segments_roll_and_are_named_after_their_first_seq(self):
+        log, _ = self.open_log()
+        messages = make_messages(1, 200)
+        log.append(messages[:120])
+        log.append(messages[120:])
+        names = self.segment_names()
+        self.assertGreater(len(names), 1)
+        self.assertEqual(names[0], f"{1:020d}{SEGMENT_SUFFIX}")
+        for segment in log.segments:
+            self.assertLess(segment.size, 1024 + 100) # A segment rolls once it reaches segment_bytes
+        bases = [int(name[:-len(SEGMENT_SUFFIX)]) for name in names]
+        self.assertEqual(bases, [segment.base_seq for segment in log.segments])
+        log.close()
+
+        reopened, stored = self.open_log()
+        self.assertEqual(stored, messages)
+        self.assertEqual(reopened.count, 200)
+        reopened.append(make_messages(201, 1)) # Appends go to the last segment
+        self.assertEqual(self.segment_names()[-1], names[-1])
+
+    def test_torn_tail_is_truncated_on_reopen(self):
+        log, _ = self.open_log()
+        messages = make_messages(1, 50)
+        log.append(messages)
+        last = log.segments[-1]
+        path, size = last.path, last.size
+        log.close()
+        with open(path, "ab") as f:
+            f.write(b"\x00\x00\x01\x00{\"username\": \"bob\"") # Header announces more than was written
+
+        reopened, stored = self.open_log()
+        self.assertEqual(stored, messages)
+        self.assertEqual(os.path.getsize(path), size)
+        reopened.append(make_messages(51, 2))
+        reopened.close()
+        _, stored = self.open_log()
+        self.assertEqual(stored, make_messages(1, 52))
+
+    def test_index_lookups_start_anywhere(self):
+        log, _ = self.open_log(segment_bytes=2048, index_interval=300)
+        messages = make_messages(1, 300)
+        log.append(messages)
+        self.assertGreater(len(log.segments), 2)
+        self.assertGreater(len(log.index_records), len(log.segments)) # Several entries per segment
+        self.assertEqual(log.index_records, sorted(log.index_records))
+        for first in (0, 1, 37, 149, 150, 299):
+            for end in (first + 1, min(300, first + 60), 300):
+                self.assertEqual(self.read_records(log, first, end), messages[first:end], (first, end))
+
+    def test_index_is_rebuilt_on_reopen(self):
+        log, _ = self.open_log(segment_bytes=2048, index_interval=300)
+        log.append(make_messages(1, 300))
+        index = (list(log.index_records), list(log.index_positions))
+        log.close()
+        reopened, _ = self.open_log(segment_bytes=2048, index_interval=300)
+        self.assertEqual((reopened.index_records, reopened.index_positions), index)
+        self.assertEqual(self.read_records(reopened, 250, 300), make_messages(251, 50))
+
+    def test_lookup_outside_the_log_is_refused(self):
+        log, _ = self.open_log()
+        log.append(make_messages(1, 10))
+        for first, end in ((0, 11), (5, 5), (-1, 3)):
+            with self.assertRaises(ValueError):
+                log.payload_chunks(first, end, 10)
+
+
+class TestMessageLogBackend(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log_directory = os.path.join(self.directory, "channel_log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def backend(self):
+        backend = MessageLogBackend(self.log_directory, os.path.join(self.directory, "channels.json"),
+                                    segment_bytes=1024, index_interval=256)
+        self.addCleanup(backend.close)
+        return backend, backend.load()
+
+    def meta_mtime(self):
+        return os.stat(os.path.join(self.log_directory, META_FILE)).st_mtime_ns
+
+    def test_migrates_channels_json_once(self):
+        with open(os.path.join(self.directory, "channels.json"), "w", encoding="utf-8") as f:
+            json.dump({"channels": {"General": {"owner": "system", "participants": ["alice"],
+                                                "messages": [{"username": "alice", "message": "hi"}]}}}, f)
+        backend, data = self.backend()
+        general = data["channels"]["General"]
+        self.assertEqual((general["last_seq"], general["messages"][0]["seq"]), (1, 1))
+        backend.close()
+        os.remove(os.path.join(self.directory, "channels.json"))
+        _, data = self.backend()
+        self.assertEqual(data["channels"]["General"]["participants"], ["alice"])
+        self.assertEqual(data["channels"]["General"]["last_seq"], 1)
+
+    def test_appends_leave_meta_alone_and_last_seq_comes_from_the_log(self):
+        backend, data = self.backend()
+        channel = data["channels"]["General"] = {"owner": "system", "participants": [], "messages": [],
+                                                 "last_seq": 0}
+        backend.write(backend.capture(data))
+        before = self.meta_mtime()
+        os.utime(os.path.join(self.log_directory, META_FILE), ns=(0, 0))
+        for message in make_messages(1, 40):
+            channel["messages"].append(message)
+            channel["last_seq"] = message["seq"]
+            backend.write(backend.capture(data))
+        self.assertEqual(self.meta_mtime(), 0) # Not rewritten
+        self.assertNotEqual(before, 0)
+        channel["participants"].append("bob")
+        backend.write(backend.capture(data))
+        self.assertNotEqual(self.meta_mtime(), 0)
+        backend.close()
+
+        _, data = self.backend()
+        self.assertEqual(data["channels"]["General"]["last_seq"], 40)
+        self.assertEqual(data["channels"]["General"]["participants"], ["bob"])
+        self.assertEqual(data["channels"]["General"]["messages"], make_messages(1, 40))
+
+
+if __name__ == "__main__":
+    unittest.main()
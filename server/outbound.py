@@ -0,0 +1,402 @@
+import selectors
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+from logger import log_info, log_error, log_warning
+from sessions import sessions
+from config import OUTBOUND_MAX_FRAMES, OUTBOUND_MAX_BYTES, OUTBOUND_HARD_LIMIT_BYTES, SLOW_CONSUMER_POLICY
+from config import OUTBOUND_STREAM_BUFFER_BYTES
+from common.protocol import encode_message, add_fields
+
+# Outgoing frames for client sockets.
+# Every connection has one bounded OutboundQueue. Writers (the thread handling the
+# client's own request, or any thread pushing to it) append a frame and try to
+# write it straight away with a non-blocking send(). Whatever the socket does not
+# take is left queued and finished by the OutboundPump thread once the socket is
+# writable again, so no writer ever blocks on a client with a full TCP window.
+#
+# Replies are always queued. Pushes are only queued while the connection is under
+# OUTBOUND_MAX_FRAMES / OUTBOUND_MAX_BYTES; beyond that SLOW_CONSUMER_POLICY
+# decides between dropping, coalescing and disconnecting.
+#
+# Large replies can be streamed (send_stream): the queue holds an iterator and
+# encodes its next frame only while less than OUTBOUND_STREAM_BUFFER_BYTES are
+# waiting, so a transfer of any size keeps about that much in memory and never
+# blocks the thread that started it. Replies queued meanwhile are sent after the
+# stream, pushes are not held back.
+#
+# Requests may carry a "request_id" (handled concurrently, see dispatch.py). The
+# replies to them echo it: while a thread handles such a request (replying_to()),
+# every reply it queues for that socket is tagged with the id. Tagged replies are
+# matched by the client, so they are not held back behind streams either.
+
+POLICY_DROP = "drop"
+POLICY_COALESCE = "coalesce"
+POLICY_DISCONNECT = "disconnect"
+POLICIES = (POLICY_DROP, POLICY_COALESCE, POLICY_DISCONNECT)
+
+
+class _Frame:
+    __slots__ = ("data", "key")
+
+    def __init__(self, data, key=None):
+        self.data = data # Encoded bytes, shared between recipients
+        self.key = key   # Coalescing key for pushes, None for replies
+
+
+class OutboundQueue:
+    """Frames waiting to be written to one client socket, plus its counters."""
+
+    def __init__(self, sock, policy=SLOW_CONSUMER_POLICY):
+        self.sock = sock
+        self.policy = policy if policy in POLICIES else POLICY_COALESCE
+        self.lock = threading.Lock()
+        self.frames = deque()
+        self.offset = 0          # Bytes of frames[0] already written
+        self.queued_bytes = 0
+        self.watching = False    # Registered with the pump for write readiness
+        self.closed = False
+        self.streams = deque()   # Iterators of encoded frames, drained in order (send_stream)
+        # Counters
+        self.peak_depth = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self.coalesced_frames = 0
+        self.streamed_frames = 0
+
+    def depth(self):
+        return len(self.frames)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": len(self.frames),
+                "queued_bytes": self.queued_bytes - self.offset,
+                "peak_depth": self.peak_depth,
+                "sent_frames": self.sent_frames,
+                "sent_bytes": self.sent_bytes,
+                "dropped_frames": self.dropped_frames,
+                "coalesced_frames": self.coalesced_frames,
+                "streamed_frames": self.streamed_frames,
+                "policy": self.policy,
+            }
+
+    def _full(self):
+        return len(self.frames) >= OUTBOUND_MAX_FRAMES or self.queued_bytes >= OUTBOUND_MAX_BYTES
+
+    def _coalesce(self, key):
+        """Removes queued (not yet started) frames with this key. Returns how many."""
+        removed = 0
+        kept = deque()
+        for index, frame in enumerate(self.frames):
+            if frame.key == key and not (index == 0 and self.offset):
+                self.queued_bytes -= len(frame.data)
+                removed += 1
+            else:
+                kept.append(frame)
+        self.frames = kept
+        return removed
+
+    def put(self, data, push=False, key=None, coalesced_data=None, ordered=True):
+        """Queues one frame and writes as much as the socket accepts right now.
+
+        A reply with ordered=False may overtake running streams. Returns False if the
+        frame was not queued (dropped, or connection closing). Caller must not hold self.lock.
+        """
+        disconnect = False
+        with self.lock:
+            if self.closed:
+                return False
+            if self.streams and not push and ordered:
+                self.streams.append(iter((data,))) # Replies keep their order behind a running stream
+                self._flush()
+                return True
+            if push and self._full():
+                if self.policy == POLICY_DISCONNECT:
+                    disconnect = True
+                elif self.policy == POLICY_COALESCE and key is not None:
+                    # Merge into one frame; the replacement may exceed the soft limit,
+                    # there is at most one of it per key
+                    self.coalesced_frames += self._coalesce(key) + 1
+                    data = coalesced_data if coalesced_data is not None else data
+                else:
+                    self.dropped_frames += 1
+                    return False
+            if not disconnect:
+                self.frames.append(_Frame(data, key))
+                self.queued_bytes += len(data)
+                if len(self.frames) > self.peak_depth:
+                    self.peak_depth = len(self.frames)
+                if self.queued_bytes - self.offset > OUTBOUND_HARD_LIMIT_BYTES:
+                    disconnect = True # Not even reading its replies
+                else:
+                    self._flush()
+        if disconnect:
+            self.abort(f"outbound queue over limit ({self.depth()} frames, policy {self.policy})")
+            return False
+        return True
+
+    def put_stream(self, frames):
+        """Queues an iterator of encoded frames, pulled as the socket drains. Caller must not hold self.lock."""
+        with self.lock:
+            if self.closed:
+                return False
+            self.streams.append(iter(frames))
+            self._flush()
+        return True
+
+    def _refill(self):
+        """Moves frames from the running streams to the queue while it is below the stream buffer."""
+        while self.streams and self.queued_bytes - self.offset < OUTBOUND_STREAM_BUFFER_BYTES:
+            try:
+                data = next(self.streams[0], None)
+            except Exception as e:
+                log_error(f"Dropping a failed outbound stream: {e}", exc_info=True)
+                data = None
+            if data is None:
+                self.streams.popleft()
+                continue
+            self.frames.append(_Frame(data))
+            self.queued_bytes += len(data)
+            self.streamed_frames += 1
+
+    def _flush(self):
+        """Writes queued frames until the socket would block. Called with self.lock held.
+
+        A stream is written about OUTBOUND_STREAM_BUFFER_BYTES at a time, then left
+        to the pump, so the lock is released in between and other writers (e.g. a
+        reply overtaking the stream) are not kept waiting until a fast reader got all of it.
+        """
+        self._refill()
+        frames = self.frames
+        budget = OUTBOUND_STREAM_BUFFER_BYTES
+        try:
+            while frames:
+                data = frames[0].data
+                sent = self.sock.send(memoryview(data)[self.offset:] if self.offset else data)
+                self.offset += sent
+                self.sent_bytes += sent
+                if self.offset < len(data):
+                    break # Socket buffer full
+                frames.popleft()
+                self.queued_bytes -= len(data)
+                self.offset = 0
+                self.sent_frames += 1
+                if self.streams:
+                    budget -= len(data)
+                    if budget <= 0:
+                        break # The pump goes on once the socket is writable
+                    self._refill()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            # Peer gone; the reading side notices and cleans the connection up
+            self.closed = True
+            self.frames.clear()
+            self.streams.clear()
+            self.queued_bytes = self.offset = 0
+            log_info(f"Dropping outbound data for closed socket: {e}")
+            return
+        pending = frames or self.streams
+        if pending and not self.watching:
+            self.watching = True
+            _pump.watch(self)
+        elif not pending and self.watching:
+            self.watching = False
+            _pump.unwatch(self)
+
+    def on_writable(self):
+        with self.lock:
+            if not self.closed:
+                self._flush()
+
+    def abort(self, reason):
+        """Closes the connection of a slow consumer. Its reader then runs the normal cleanup."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.dropped_frames += len(self.frames)
+            self.frames.clear()
+            self.streams.clear()
+            self.queued_bytes = self.offset = 0
+        log_warning(f"Disconnecting slow consumer: {reason}")
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class OutboundPump(threading.Thread):
+    """Finishes partially written queues when their sockets become writable."""
+
+    def __init__(self):
+        super().__init__(name="OutboundPump", daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self._requests = deque() # ("watch" | "unwatch", queue), applied on the pump thread
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+
+    def watch(self, queue):
+        self._request("watch", queue)
+
+    def unwatch(self, queue):
+        self._request("unwatch", queue)
+
+    def _request(self, action, queue):
+        self._requests.append((action, queue))
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    self._apply_requests()
+                else:
+                    try:
+                        key.data.on_writable()
+                    except Exception as e:
+                        log_error(f"Outbound pump failed writing to a client: {e}", exc_info=True)
+
+    def _apply_requests(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._requests:
+            action, queue = self._requests.popleft()
+            try:
+                if action == "watch":
+                    if queue.watching and not queue.closed:
+                        self.selector.register(queue.sock, selectors.EVENT_WRITE, queue)
+                else:
+                    self.selector.unregister(queue.sock)
+            except (KeyError, ValueError, OSError):
+                pass # Already (un)registered or socket closed meanwhile
+
+
+_pump = OutboundPump()
+_pump.start()
+
+_queues = {} # Key: client_socket, Value: OutboundQueue
+_queues_guard = threading.Lock()
+
+
+def _queue_for(client_socket):
+    queue = _queues.get(client_socket)
+    if queue is None:
+        with _queues_guard:
+            queue = _queues.get(client_socket)
+            if queue is None:
+                queue = OutboundQueue(client_socket)
+                _queues[client_socket] = queue
+    return queue
+
+
+_reply_context = threading.local() # .current: (client_socket, request_id) of the request being handled
+
+
+@contextmanager
+def replying_to(client_socket, request_id):
+    """Tags the replies queued for client_socket on this thread with request_id meanwhile."""
+    previous = getattr(_reply_context, "current", None)
+    _reply_context.current = (client_socket, request_id)
+    try:
+        yield
+    finally:
+        _reply_context.current = previous
+
+
+def reply_later(callback):
+    """Wraps callback, run later (e.g. on another thread), to reply like the current request."""
+    current = getattr(_reply_context, "current", None)
+    if current is None:
+        return callback
+
+    def tagged(*args, **kwargs):
+        with replying_to(*current):
+            return callback(*args, **kwargs)
+    return tagged
+
+
+def _request_id(client_socket):
+    current = getattr(_reply_context, "current", None)
+    return current[1] if current is not None and current[0] is client_socket else None
+
+
+def send_frame(client_socket, data, push=False, key=None, coalesced_data=None):
+    """Queues already encoded bytes for client_socket. See OutboundQueue.put."""
+    request_id = None if push else _request_id(client_socket)
+    if request_id is not None:
+        data = add_fields(data, {"request_id": request_id}, sessions.protocol_of(client_socket))
+    return _queue_for(client_socket).put(data, push, key, coalesced_data, ordered=request_id is None)
+
+
+def send_message(client_socket, message, push=False, key=None, coalesce_with=None):
+    """Encodes message in the socket's negotiated protocol and queues it as one frame.
+
+    push=True marks server-initiated frames, which are subject to the slow-consumer
+    policy. key groups pushes that may be coalesced; coalesce_with is the message
+    that replaces them (the push itself when None).
+    """
+    protocol = sessions.protocol_of(client_socket)
+    request_id = None if push else _request_id(client_socket)
+    if request_id is not None:
+        message = dict(message, request_id=request_id)
+    data = encode_message(message, protocol)
+    coalesced_data = encode_message(coalesce_with, protocol) if coalesce_with is not None else None
+    return _queue_for(client_socket).put(data, push, key, coalesced_data, ordered=request_id is None)
+
+
+def send_stream(client_socket, messages):
+    """Streams an iterable of messages to client_socket, each encoded only when the queue has room.
+
+    Items that are bytes are sent as already encoded frames. Dict items with a
+    "status" are replies and echo the current request_id. The iterable is consumed
+    on whichever thread flushes the queue (this one or the OutboundPump), so it must
+    not block or take locks other threads hold while sending.
+    """
+    protocol = sessions.protocol_of(client_socket)
+    request_id = _request_id(client_socket)
+
+    def encode(message):
+        if request_id is not None and "status" in message:
+            message = dict(message, request_id=request_id)
+        return encode_message(message, protocol)
+    return _queue_for(client_socket).put_stream(
+        message if isinstance(message, bytes) else encode(message) for message in messages)
+
+
+def stats(client_socket):
+    """Counters of one connection's queue, or None if it never sent anything."""
+    queue = _queues.get(client_socket)
+    return queue.stats() if queue is not None else None
+
+
+def all_stats():
+    with _queues_guard:
+        queues = list(_queues.items())
+    return {sock: queue.stats() for sock, queue in queues}
+
+
+def forget(client_socket):
+    """Drops the queue of a closed connection. Returns its final counters (or None)."""
+    with _queues_guard:
+        queue = _queues.pop(client_socket, None)
+    if queue is None:
+        return None
+    with queue.lock:
+        queue.closed = True
+        queue.streams.clear()
+        if queue.watching:
+            queue.watching = False
+            _pump.unwatch(queue)
+    return queue.stats()
@@ -0,0 +1,77 @@
+from shared import channel_users, user_channels, presence_lock
+from response_cache import bump_channel_version
+
+# Channel presence: which members of a channel are online or offline.
+# channel_users holds a set per list and user_channels is the reverse index
+# (user -> channels), so a status change or a disconnection touches only the
+# channels the user is in, and membership tests are O(1). Callers push the
+# resulting diffs with broadcast.broadcast_presence. Every change bumps the
+# channel's version so cached get_user_status replies are rebuilt.
+
+
+def _lists(channel_name):
+    lists = channel_users.get(channel_name)
+    if lists is None:
+        lists = channel_users[channel_name] = {"online": set(), "offline": set()}
+    return lists
+
+def _move(lists, username, online):
+    """Puts username in one list of a channel. Called with presence_lock held."""
+    target, other = (lists["online"], lists["offline"]) if online else (lists["offline"], lists["online"])
+    if username in target:
+        return False
+    other.discard(username)
+    target.add(username)
+    return True
+
+def set_channel_presence(channel_name, username, online):
+    """Lists username as online or offline in channel_name. Returns True if the user moved."""
+    with presence_lock:
+        user_channels.setdefault(username, set()).add(channel_name)
+        moved = _move(_lists(channel_name), username, online)
+        if moved:
+            bump_channel_version(channel_name)
+        return moved
+
+def update_user_presence(username, online):
+    """Moves username to the online or offline list of every channel it is in.
+
+    Returns the channels where the user changed lists.
+    """
+    with presence_lock:
+        moved = [channel_name for channel_name in user_channels.get(username, ())
+                 if _move(_lists(channel_name), username, online)]
+        for channel_name in moved:
+            bump_channel_version(channel_name)
+        return moved
+
+def remove_user(username):
+    """Takes username out of the lists of every channel. Returns the channels it was in."""
+    with presence_lock:
+        channels = user_channels.pop(username, set())
+        for channel_name in channels:
+            lists = channel_users.get(channel_name)
+            if lists is None:
+                continue
+            lists["online"].discard(username)
+            lists["offline"].discard(username)
+            if not lists["online"] and not lists["offline"]:
+                del channel_users[channel_name]
+            bump_channel_version(channel_name)
+        return list(channels)
+
+def channel_presence(channel_name):
+    """Copies of the channel's (online, offline) lists."""
+    with presence_lock:
+        lists = channel_users.get(channel_name)
+        if lists is None:
+            return [], []
+        return list(lists["online"]), list(lists["offline"])
+
+def clear_presence():
+    with presence_lock:
+        channel_names = list(channel_users)
+        channel_users.clear()
+        user_channels.clear()
+        for channel_name in channel_names:
+            bump_channel_version(channel_name)
@@ -0,0 +1,358 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import nullcontext
+from logger import log_info, log_error
+from channel_store import JsonFileBackend
+
+# Storage repositories shared by main.py (users) and channel_manager.py (channels).
+#
+# User repositories store credentials only:
+#   ensure_exists()              -> creates the empty store if needed
+#   register(username, password) -> bool, False if the name is taken
+#   usernames()                  -> list of registered names
+#   credentials()                -> {username: password}, read once by UserRegistry
+#
+# main.py wraps the chosen repository in a UserRegistry, so after startup the
+# repository only sees registrations. Logins are checked against the registry and
+# status lives in the session, so neither is written here.
+#
+# SqliteRepository is also a ChannelStore backend (load / capture / write, see
+# channel_store.py). With it every registration or stored message is a
+# single-row write in a WAL-mode database instead of a rewrite of a JSON file.
+
+
+class JsonUserRepository:
+    """users.json: every operation reads the file, and writes rewrite all of it."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock() # Read-modify-write of the whole file
+
+    def _load(self):
+        try:
+            if not os.path.exists(self.path):
+                log_info(f"{self.path} not found during load. Returning empty.")
+                return {"users": []}
+            with open(self.path, "r") as f:
+                users_data = json.load(f)
+            if not isinstance(users_data, dict) or not isinstance(users_data.get("users"), list):
+                log_error(f"Invalid format in {self.path}. Returning empty.")
+                return {"users": []}
+            return users_data
+        except json.JSONDecodeError as e:
+            log_error(f"Error decoding JSON from {self.path}: {e}. Returning empty.")
+            return {"users": []}
+
+    def _save(self, users_data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as file:
+            json.dump(users_data, file, indent=4)
+
+    def ensure_exists(self):
+        if not os.path.exists(self.path):
+            log_info(f"{self.path} not found. Creating default.")
+            self._save({"users": []})
+
+    def register(self, username, password):
+        with self._lock:
+            users_data = self._load()
+            if any(user.get("username") == username for user in users_data["users"]):
+                return False
+            # !! IMPORTANT: In a real app, NEVER store plain passwords. Use hashing (e.g., bcrypt).
+            users_data["users"].append({"username": username, "password": password})
+            self._save(users_data)
+            return True
+
+    def usernames(self):
+        return [user["username"] for user in self._load()["users"] if user.get("username")]
+
+    def credentials(self):
+        return {user["username"]: user.get("password", "") for user in self._load()["users"] if user.get("username")}
+
+
+class UserRegistry:
+    """Registered users indexed by name in memory, read once from a user repository.
+
+    Logins are dict lookups. Status is volatile and lives in the user's session
+    (everyone is offline after a restart anyway). Only credential changes, i.e.
+    registrations, are written through to the repository.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self._passwords = None          # Username -> password, once loaded
+        self._lock = threading.Lock()   # Loading and registering
+
+    def _users(self):
+        if self._passwords is None:
+            with self._lock:
+                if self._passwords is None:
+                    self._passwords = self.repository.credentials()
+                    log_info(f"Loaded {len(self._passwords)} registered user(s) into memory.")
+        return self._passwords
+
+    def ensure_exists(self):
+        self.repository.ensure_exists()
+
+    def authenticate(self, username, password):
+        # !! IMPORTANT: In a real app, NEVER store plain passwords. Use hashing (e.g., bcrypt).
+        stored = self._users().get(username)
+        return stored is not None and stored == password
+
+    def register(self, username, password):
+        users = self._users()
+        with self._lock:
+            if username in users or not self.repository.register(username, password):
+                return False
+            users[username] = password
+        return True
+
+    def is_registered(self, username):
+        return username in self._users()
+
+    def usernames(self):
+        return list(self._users())
+
+
+class SqliteRepository:
+    """users, channels, participants and messages tables in one SQLite database (WAL mode).
+
+    Each thread gets its own connection, so handler threads write concurrently;
+    SQLite serializes the writers and WAL lets readers run alongside them.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            status   TEXT NOT NULL DEFAULT 'offline' -- Unused (status lives in the session); kept for existing databases
+        );
+        CREATE TABLE IF NOT EXISTS channels (
+            name     TEXT PRIMARY KEY,
+            host     TEXT,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            extra    TEXT -- JSON of any other channel fields
+        );
+        CREATE TABLE IF NOT EXISTS participants (
+            channel  TEXT NOT NULL,
+            username TEXT NOT NULL,
+            UNIQUE (channel, username)
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            channel   TEXT NOT NULL,
+            seq       INTEGER NOT NULL,
+            timestamp TEXT,
+            username  TEXT,
+            data      TEXT NOT NULL, -- The whole message as JSON
+            PRIMARY KEY (channel, seq)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS messages_by_time ON messages (channel, timestamp);
+        CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY);
+    """
+
+    def __init__(self, path, legacy_channels_path=None):
+        self.path = path
+        self.legacy_channels_path = legacy_channels_path # channels.json imported by the first load()
+        self._local = threading.local()
+        # What is in the database. Key: channel name, Value: {"channel", "messages" (the
+        # list objects written from), "written" (message count), "participants", "meta"}
+        self._persisted = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL") # Durable at each WAL checkpoint, safe against corruption
+            self._local.db = db
+        return db
+
+    def _migrated(self, db, name):
+        """Records a one-shot migration. Returns False if it had already run."""
+        return db.execute("INSERT OR IGNORE INTO migrations (name) VALUES (?)", (name,)).rowcount == 1
+
+    # --- Users ---
+    def import_users(self, legacy_users_path):
+        """One-shot import of users.json, the first time the database stores users."""
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if self._migrated(db, "users_json") and os.path.exists(legacy_users_path):
+                users = JsonUserRepository(legacy_users_path)._load()["users"]
+                db.executemany("INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
+                               [(u["username"], u.get("password", ""))
+                                for u in users if u.get("username")])
+                log_info(f"Imported {len(users)} user(s) from {legacy_users_path} into {self.path}.")
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def ensure_exists(self):
+        pass # Tables are created when the repository is opened
+
+    def register(self, username, password):
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)", (username, password))
+        return cursor.rowcount == 1
+
+    def usernames(self):
+        return [row[0] for row in self._connection().execute("SELECT username FROM users")]
+
+    def credentials(self):
+        return dict(self._connection().execute("SELECT username, password FROM users"))
+
+    # --- Channels (ChannelStore backend) ---
+    def load(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if self._migrated(db, "channels_json") and self.legacy_channels_path \
+                    and os.path.exists(self.legacy_channels_path):
+                self._import_channels(db, JsonFileBackend(self.legacy_channels_path).load())
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        channels = {}
+        for name, host, last_seq, extra in db.execute("SELECT name, host, last_seq, extra FROM channels"):
+            channel_data = json.loads(extra) if extra else {}
+            channel_data.update({"host": host, "participants": [], "messages": [], "last_seq": last_seq})
+            channels[name] = channel_data
+        for channel, username in db.execute("SELECT channel, username FROM participants ORDER BY rowid"):
+            if channel in channels:
+                channels[channel]["participants"].append(username)
+        for channel, data in db.execute("SELECT channel, data FROM messages ORDER BY channel, seq"):
+            if channel in channels:
+                channels[channel]["messages"].append(json.loads(data))
+        for name, channel_data in channels.items():
+            self._persisted[name] = {
+                "channel": channel_data, "messages": channel_data["messages"], "written": len(channel_data["messages"]),
+                "participants": set(channel_data["participants"]),
+                "meta": {key: value for key, value in channel_data.items() if key not in ("messages", "participants")},
+            }
+        log_info(f"Loaded {len(channels)} channel(s) from {self.path}.")
+        return {"channels": channels}
+
+    def _import_channels(self, db, data):
+        """One-shot import of channels.json, numbering messages like channel_manager.ensure_message_seqs."""
+        total = 0
+        for name, channel_data in data["channels"].items():
+            messages = channel_data.get("messages") if isinstance(channel_data.get("messages"), list) else []
+            if "last_seq" not in channel_data:
+                for index, message in enumerate(messages):
+                    if isinstance(message, dict):
+                        message["seq"] = index + 1
+                channel_data["last_seq"] = len(messages)
+            self._write_channel(db, name, channel_data)
+            self._write_participants(db, name, channel_data.get("participants") or [])
+            self._write_messages(db, name, messages)
+            total += len(messages)
+        log_info(f"Imported {len(data['channels'])} channel(s) and {total} message(s) from "
+                 f"{self.legacy_channels_path} into {self.path}; the JSON file is no longer read.")
+
+    def capture(self, data, changed=None, channel_lock=None):
+        channels = data.get("channels", {})
+        # Channels deleted, or replaced by a new object (deleted and created again)
+        dropped = [name for name, persisted in self._persisted.items()
+                   if channels.get(name) is not persisted["channel"]
+                   or persisted["channel"].get("messages") is not persisted["messages"]]
+        changes = []
+        for name, channel_data in channels.items():
+            persisted = None if name in dropped else self._persisted.get(name)
+            if persisted and changed is not None and name not in changed:
+                continue # Not changed since the last capture
+            with channel_lock(name) if channel_lock is not None else nullcontext():
+                messages = channel_data.get("messages")
+                if not isinstance(messages, list):
+                    continue
+                written = persisted["written"] if persisted else 0
+                participants = list(channel_data.get("participants") or [])
+                meta = {key: value for key, value in channel_data.items() if key not in ("messages", "participants")}
+                new_messages = messages[written:]
+            if persisted and not new_messages and meta == persisted["meta"] \
+                    and persisted["participants"].issuperset(participants):
+                continue # Unchanged
+            changes.append((name, channel_data, messages, written, new_messages, participants, meta))
+        return dropped, changes
+
+    def write(self, work):
+        dropped, changes = work
+        db = self._connection()
+        if not getattr(self._local, "full_sync", False):
+            # Batches from the channel store are acknowledged as durable: sync the WAL on commit
+            db.execute("PRAGMA synchronous=FULL")
+            self._local.full_sync = True
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for name in dropped:
+                db.execute("DELETE FROM messages WHERE channel = ?", (name,))
+                db.execute("DELETE FROM participants WHERE channel = ?", (name,))
+                db.execute("DELETE FROM channels WHERE name = ?", (name,))
+            persisted = {}
+            for name, channel_data, messages, written, new_messages, participants, meta in changes:
+                previous = None if name in dropped else self._persisted.get(name)
+                known = previous["participants"] if previous else set()
+                if previous is None or meta != previous["meta"]:
+                    self._write_channel(db, name, meta)
+                self._write_participants(db, name, [p for p in participants if p not in known])
+                self._write_messages(db, name, new_messages)
+                persisted[name] = {"channel": channel_data, "messages": messages, "meta": meta,
+                                   "written": written + len(new_messages), "participants": known.union(participants)}
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        for name in dropped:
+            self._persisted.pop(name, None)
+        self._persisted.update(persisted)
+
+    def _write_channel(self, db, name, channel_data):
+        extra = {key: value for key, value in channel_data.items()
+                 if key not in ("host", "last_seq", "messages", "participants")}
+        db.execute("INSERT INTO channels (name, host, last_seq, extra) VALUES (?, ?, ?, ?) "
+                   "ON CONFLICT (name) DO UPDATE SET host = excluded.host, last_seq = excluded.last_seq, "
+                   "extra = excluded.extra",
+                   (name, channel_data.get("host"), channel_data.get("last_seq", 0),
+                    json.dumps(extra, ensure_ascii=False) if extra else None))
+
+    def _write_participants(self, db, name, usernames):
+        db.executemany("INSERT OR IGNORE INTO participants (channel, username) VALUES (?, ?)",
+                       [(name, username) for username in usernames])
+
+    def _write_messages(self, db, name, messages):
+        db.executemany(
+            "INSERT OR REPLACE INTO messages (channel, seq, timestamp, username, data) VALUES (?, ?, ?, ?, ?)",
+            [(name, message.get("seq"), message.get("timestamp"), message.get("username"),
+              json.dumps(message, ensure_ascii=False))
+             for message in messages if isinstance(message, dict) and isinstance(message.get("seq"), int)])
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+_sqlite_repository = None
+_sqlite_guard = threading.Lock()
+
+
+def sqlite_repository(path, legacy_users_path=None, legacy_channels_path=None):
+    """The process-wide SqliteRepository for path, shared by the user and channel code.
+
+    The legacy JSON files given are imported once (recorded in the migrations table).
+    """
+    global _sqlite_repository
+    with _sqlite_guard:
+        if _sqlite_repository is None:
+            _sqlite_repository = SqliteRepository(path)
+        if legacy_users_path:
+            _sqlite_repository.import_users(legacy_users_path)
+        if legacy_channels_path:
+            _sqlite_repository.legacy_channels_path = legacy_channels_path
+        return _sqlite_repository
@@ -0,0 +1,108 @@
+import itertools
+import threading
+from collections import OrderedDict
+from sessions import sessions
+from outbound import send_frame
+from config import RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRY_BYTES
+from common.protocol import encode_message
+
+# Encoded replies of hot channel reads (sync_from_server, get_user_status).
+# Every channel has a version that changes after each mutation of its messages,
+# participants or presence (bump_channel_version). A reply is cached as the bytes
+# sent on the wire, per (channel, view, wire protocol), together with the version
+# it was built at; it is served again, without encoding, for as long as the
+# channel keeps that version. Read the version before building a reply and bump
+# it after mutating: a cached reply is then never older than its version.
+#
+# Versions come from one global counter, so concurrent bumps of a channel never
+# collapse into one value. Entries are evicted least recently used first once
+# RESPONSE_CACHE_MAX_BYTES is reached; replies larger than
+# RESPONSE_CACHE_MAX_ENTRY_BYTES are not cached.
+
+_version_counter = itertools.count(1)
+_channel_versions = {} # Key: channel_name, Value: version (int)
+
+def channel_version(channel_name):
+    return _channel_versions.get(channel_name, 0)
+
+def bump_channel_version(channel_name):
+    """Invalidates the cached replies of channel_name. Call after the change is made."""
+    _channel_versions[channel_name] = next(_version_counter)
+
+
+class ResponseCache:
+    """Encoded replies by (channel, view, protocol), each valid for one channel version."""
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES, max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict() # (channel, view, protocol) -> (version, data)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0     # Bytes sent from the cache
+        self.stored_bytes = 0  # Bytes encoded and stored
+        self.evictions = 0
+
+    def get(self, channel_name, view, protocol, version):
+        key = (channel_name, view, protocol)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.hit_bytes += len(entry[1])
+            return entry[1]
+
+    def put(self, channel_name, view, protocol, version, data):
+        if len(data) > self.max_entry_bytes:
+            return
+        key = (channel_name, view, protocol)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[1])
+            self._entries[key] = (version, data)
+            self._bytes += len(data)
+            self.stored_bytes += len(data)
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries), "bytes": self._bytes,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "hit_bytes": self.hit_bytes, "stored_bytes": self.stored_bytes, "evictions": self.evictions,
+            }
+
+
+response_cache = ResponseCache()
+
+def send_cached_response(client_socket, channel_name, view, build):
+    """Sends the reply for view of channel_name: the cached bytes, or build() encoded and cached.
+
+    build() must depend only on the channel's state and view (not on the requester).
+    """
+    protocol = sessions.protocol_of(client_socket)
+    if RESPONSE_CACHE_MAX_BYTES <= 0:
+        return send_frame(client_socket, encode_message(build(), protocol))
+    version = channel_version(channel_name) # Before build(): see the note at the top
+    data = response_cache.get(channel_name, view, protocol, version)
+    if data is None:
+        data = encode_message(build(), protocol)
+        response_cache.put(channel_name, view, protocol, version, data)
+    return send_frame(client_socket, data)
@@ -0,0 +1,128 @@
+import threading
+import time
+from common.protocol import PROTOCOL_JSON
+
+# Session registry: the per-connection state of the server.
+# One Session per client socket, created when the connection is accepted and
+# indexed by socket and, once the client has logged in, by username. Request
+# handling, push fanout (broadcast.py), outbound framing and metrics all read the
+# same object, so a request costs one dict lookup instead of one per concern.
+# Attributes of a session are read without a lock (single assignments are
+# atomic); the indexes are changed under the registry lock.
+
+
+class Session:
+    """One client connection."""
+    __slots__ = ("sock", "address", "username", "role", "status", "protocol", "channel",
+                 "connected_at", "requests", "bytes_received")
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address                  # (host, port) from accept()
+        self.username = None                    # Set by a successful login / visitor login
+        self.role = None                        # "authenticated" or "guest"
+        self.status = "offline"                 # "online", "offline" or "invisible"
+        self.protocol = PROTOCOL_JSON           # Wire protocol negotiated during auth
+        # Channel whose pushes this connection receives. One, not a set: the client shows
+        # one channel at a time and drops pushes for any other (client/ui.py), so
+        # following every channel it visited would only widen the fanout.
+        self.channel = None
+        self.connected_at = time.time()
+        self.requests = 0
+        self.bytes_received = 0
+
+    @property
+    def addr_str(self):
+        return f"{self.address[0]}:{self.address[1]}" if isinstance(self.address, tuple) else str(self.address)
+
+    def stats(self):
+        return {
+            "address": self.addr_str, "username": self.username, "role": self.role, "status": self.status,
+            "protocol": self.protocol, "channel": self.channel, "requests": self.requests,
+            "bytes_received": self.bytes_received, "connected_for": time.time() - self.connected_at,
+        }
+
+
+class SessionRegistry:
+    """Thread-safe index of the open sessions by socket and by username."""
+
+    def __init__(self):
+        self._by_socket = {}
+        self._by_username = {}  # Latest session that logged in with the name
+        self._lock = threading.Lock()
+
+    def open(self, sock, address):
+        session = Session(sock, address)
+        with self._lock:
+            self._by_socket[sock] = session
+        return session
+
+    def get(self, sock):
+        return self._by_socket.get(sock)
+
+    def by_username(self, username):
+        return self._by_username.get(username)
+
+    def bind(self, session, username, role, status="online"):
+        """Marks session as logged in as username."""
+        with self._lock:
+            if session.username is not None and self._by_username.get(session.username) is session:
+                del self._by_username[session.username]
+            session.username, session.role, session.status = username, role, status
+            self._by_username[username] = session
+
+    def close(self, sock):
+        """Removes the session of sock from both indexes. Returns it (None if unknown)."""
+        with self._lock:
+            session = self._by_socket.pop(sock, None)
+            if session is not None and session.username is not None \
+                    and self._by_username.get(session.username) is session:
+                del self._by_username[session.username]
+        return session
+
+    def all(self):
+        with self._lock:
+            return list(self._by_socket.values())
+
+    def clear(self):
+        with self._lock:
+            self._by_socket.clear()
+            self._by_username.clear()
+
+    def __len__(self):
+        return len(self._by_socket)
+
+    # --- Shortcuts for code that only knows a socket or a name ---
+    def address_of(self, sock):
+        session = self._by_socket.get(sock)
+        return session.address if session is not None else "Unknown Address"
+
+    def protocol_of(self, sock):
+        session = self._by_socket.get(sock)
+        return session.protocol if session is not None else PROTOCOL_JSON
+
+    def username_of(self, sock):
+        session = self._by_socket.get(sock)
+        return session.username if session is not None else None
+
+    def status_of(self, username):
+        """Status of a logged-in user; "offline" for anyone without a session."""
+        session = self._by_username.get(username)
+        return session.status if session is not None else "offline"
+
+    def role_of(self, username):
+        session = self._by_username.get(username)
+        return session.role if session is not None else None
+
+    def stats(self):
+        sessions = self.all()
+        return {
+            "sessions": len(sessions),
+            "authenticated": sum(1 for s in sessions if s.role == "authenticated"),
+            "guests": sum(1 for s in sessions if s.role == "guest"),
+            "requests": sum(s.requests for s in sessions),
+            "bytes_received": sum(s.bytes_received for s in sessions),
+        }
+
+
+sessions = SessionRegistry()
@@ -5,25 +5,30 @@ active_channel_livestreams = {}
 livestream_lock = threading.Lock()
 # Shared data structures for the server
 
-# Dictionary to store user status (online, offline, invisible)
-# Key: username, Value: status string
-user_status = {}
+# Per-connection state (socket, username, role, status, wire protocol, subscribed
+# channel) lives in the session registry, see sessions.py
 
-# Dictionary to store user roles (authenticated, guest)
-# Key: username, Value: role string
-user_roles = {} # Add this dictionary
-
-# Dictionary to store channel information and users within them
+# Dictionary to store channel information and users within them (see presence.py)
 # Key: channel_name
-# Value: {"online": [user1, user2], "offline": [user3], "invisible": [user4]}
+# Value: {"online": {user1, user2}, "offline": {user3}}
 channel_users = {}
+# Reverse index of channel_users
+# Key: username, Value: set of channel names the user is listed in
+user_channels = {}
+presence_lock = threading.Lock()
 
 # --- NEW FOR CHANNEL HOSTING ---
 # Stores the designated owner of a channel
 # Loaded from channels.json (or a new file) on server startup, or populated on channel creation
 # Example: { "channel_name1": "owner_username1", "channel_name2": "owner_username2" }
 channel_owners = {}
-connected_clients = {}  # Dictionary: {client_socket: username}
+
+# Push subscriptions: every connection follows at most one channel (the one it
+# last joined or synced, Session.channel) and receives new messages of that
+# channel as pushes.
+# Key: channel_name, Value: set of Session objects
+channel_subscribers = {}
+subscriptions_lock = threading.Lock()
 
 # Stores active P2P endpoints for channels being hosted by their owners
 # Updated by 'announce'/'unannounce' requests from channel owner clients
@@ -1,6 +1,6 @@
-import json
 from utils import validate_ip, parse_json
 from logger import log_info, log_error
+from outbound import send_message
 # Danh sách các peer được theo dõi
 peer_list = []
 
@@ -12,7 +12,7 @@ def handle_tracker_request(client_socket, data):
         get_list(client_socket)
     else:
         response = {"status": "error", "message": "Invalid tracker request"}
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        send_message(client_socket, response)
         print("[ERROR] Invalid tracker request")
     
 # Hàm xử lý yêu cầu submit_info
@@ -38,11 +38,11 @@ def submit_info(client_socket, data):
         add_list(peer_info)
 
         response = {"status": "success", "message": "Peer added successfully"}
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        send_message(client_socket, response)
         log_info(f"Peer added: {peer_info}")
     except Exception as e:
         response = {"status": "error", "message": str(e)}
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        send_message(client_socket, response)
         log_error(f"Failed to add peer: {e}")
 # Hàm thêm peer vào danh sách
 def add_list(peer_info):
@@ -55,10 +55,10 @@ def get_list(client_socket):
     try:
         # Trả về danh sách các peer hiện tại
         response = {"status": "success", "peers": peer_list}
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        send_message(client_socket, response)
         print(f"[INFO] Sent peer list to client: {len(peer_list)} peers")
     except Exception as e:
         response = {"status": "error", "message": str(e)}
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        send_message(client_socket, response)
         print(f"[ERROR] Failed to send peer list: {e}")
 